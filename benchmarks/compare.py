@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Compares two result files of loopback.py, e.g. from before and after a change:
+#   python3 compare.py before.json after.json
+import argparse
+import json
+
+
+def flatten(results, prefix=""):
+    values = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            values.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=0.0,
+                        help="Only show metrics that changed by more than this many percent")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print("{} -> {}".format(before.get("revision"), after.get("revision")))
+    old, new = flatten(before), flatten(after)
+    for name in sorted(set(old) & set(new)):
+        if name == "timestamp":
+            continue
+        if old[name]:
+            change = (new[name] - old[name]) / abs(old[name]) * 100
+        else:
+            change = 0.0 if not new[name] else float("inf")
+        if abs(change) >= args.threshold:
+            print("{:<50} {:>14.6g} {:>14.6g} {:>+9.1f}%".format(name, old[name], new[name], change))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Telemetry fan-out: the loopback remote with a pilot client sending commands and N
+# observers subscribed next to it, for several N. The observers cycle through a mix
+# of rates, field subsets and delta encoding ("mixed"), or all use the same
+# subscription ("same", one encode per tick for all of them). Reports the publisher's
+# time per tick, encodes and sends, what the observers received, and whether the
+# pilot's telemetry and the control loop noticed.
+import argparse
+import contextlib
+import json
+import os
+import selectors
+import sys
+import time
+
+from loopback import LoopbackClient, LoopbackRemote, mock_pins, rate, thread_cpu_times, cpu_delta, wait_until
+
+import protocol
+from observer import Observer
+
+# hertz, fields (None: all), delta
+SUBSCRIPTIONS = [(50, None, False),
+                 (10, None, True),
+                 (5, ["motor_left", "servo_pitch", "wifi_rssi", "failsafe_active"], False),
+                 (25, ["target_throttle", "target_yaw", "target_climb", "applied_seq"], True)]
+
+
+def run_fanout(observers, mix, duration, command_hertz):
+    mock_pins()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote = LoopbackRemote()
+    pilot = LoopbackClient(remote.address)
+    pilot.start()
+    pilot.communicator.send_command(protocol.Command(0.0, 0.0, 0.0))
+    wait_until(lambda: pilot.first_telemetry is not None, 2.0)
+
+    subscriptions = SUBSCRIPTIONS if mix == "mixed" else SUBSCRIPTIONS[:1]
+    selector = selectors.DefaultSelector()
+    clients = []
+    for i in range(observers):
+        hertz, fields, delta = subscriptions[i % len(subscriptions)]
+        observer = Observer(remote.address, hertz, fields, delta, bind_address=("127.0.0.1", 0))
+        observer.bytes = 0
+        selector.register(observer.socket, selectors.EVENT_READ, observer)
+        clients.append(observer)
+
+    publisher = remote.control_server.publisher
+    pilot_before = pilot.telemetry_received
+    cpu_before = thread_cpu_times()
+    start = time.monotonic()
+    deadline = next_command = next_renew = start
+    step = 0
+    while deadline - start < duration:
+        now = time.monotonic()
+        if now >= next_renew:
+            next_renew = now + Observer.RENEW_INTERVAL
+            for observer in clients:
+                observer._subscribe(observer.hertz)
+        if now >= next_command:
+            step += 1
+            next_command += 1.0 / command_hertz
+            pilot.communicator.send_command(protocol.Command((step % 200 - 100) / 100.0, 0.0, 0.0))
+        for key, _ in selector.select(max(0.0, min(next_command, next_renew) - now)):
+            observer = key.data
+            data = observer.socket.recv(protocol.MAX_PACKET_SIZE)
+            observer.bytes += len(data)
+            header, fields = protocol.decode_fields(data)
+            observer.received += 1
+            observer.decoder.update(header, fields)
+        deadline = time.monotonic()
+    elapsed = time.monotonic() - start
+    cpu = cpu_delta(cpu_before, thread_cpu_times(), elapsed)
+    publisher_stats = publisher.to_json()
+
+    for observer in clients:
+        selector.unregister(observer.socket)
+        observer.close()
+    pilot.stop()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote.stop()
+
+    per_subscription = {}
+    for observer in clients:
+        name = "{} Hz {} {}".format(observer.hertz, bin(observer.mask).count("1"),
+                                    "delta" if observer.delta else "full")
+        entry = per_subscription.setdefault(name, {"observers": 0, "per_s": 0.0, "bytes_per_packet": 0.0,
+                                                   "lost": 0})
+        entry["observers"] += 1
+        entry["per_s"] += rate(observer.received, elapsed)
+        entry["bytes_per_packet"] += observer.bytes / observer.received if observer.received else 0.0
+        entry["lost"] += observer.decoder.lost
+    for entry in per_subscription.values():
+        entry["per_s"] /= entry["observers"]
+        entry["bytes_per_packet"] /= entry["observers"]
+
+    loop = remote.control.get_loop_stats()
+    return {"observers": observers,
+            "mix": mix,
+            "duration": elapsed,
+            "publisher": publisher_stats,
+            "encodes_per_tick": publisher_stats["encodes"] / publisher_stats["ticks"] if publisher_stats["ticks"] else 0.0,
+            "sends_per_s": rate(publisher_stats["sends"], elapsed),
+            "subscriptions": per_subscription,
+            "pilot_telemetry_per_s": rate(pilot.telemetry_received - pilot_before, elapsed),
+            "control_loop_max_jitter": loop["max_jitter"],
+            "control_loop_overruns": loop["overruns"],
+            "cpu_control_server": cpu.get("control-server", 0.0)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--observers", type=int, nargs="+", default=[0, 1, 4, 16, 64])
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--command-hertz", type=float, default=50)
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    runs = [run_fanout(n, mix, args.duration, args.command_hertz)
+            for mix in ("same", "mixed") for n in args.observers]
+    results = {"timestamp": time.time(), "runs": runs}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# Fleet load test: N loopback remotes in a separate process (so their threads do not
+# count), and the ground station's links to all of them in this one, either on one
+# thread (communicator.LinkLoop, as in client/fleet.py) or one Communicator thread per
+# craft as with one client per craft. Every craft gets commands at --command-hertz and
+# telemetry at 50 Hz. Reports the CPU of the link threads and the command round trip.
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from loopback import LoopbackRemote, rate, wait_until
+
+from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+import protocol
+from communicator import Communicator, LinkLoop
+
+
+class FleetRemote(LoopbackRemote):
+    def __init__(self):
+        # Own mock pins for every remote, they all use the same pin numbers
+        self.PIN_FACTORY = MockFactory(pin_class=MockPWMPin)
+        super().__init__()
+
+
+def serve(count):
+    # Runs the remotes until stdin closes, their ports go to stdout as one JSON line
+    with contextlib.redirect_stdout(sys.stderr):
+        remotes = [FleetRemote() for _ in range(count)]
+    print(json.dumps([remote.address[1] for remote in remotes]))
+    sys.stdout.flush()
+    sys.stdin.read()
+    with contextlib.redirect_stdout(sys.stderr):
+        for remote in remotes:
+            remote.stop()
+
+
+class SimulatedCraft:
+    def __init__(self, station, port):
+        self.station = station
+        self.telemetry_received = 0
+        self.communicator = Communicator(self, bind_address=("127.0.0.1", 0), remote_address=("127.0.0.1", port))
+
+    @property
+    def shutdown(self):
+        return self.station.shutdown
+
+    def on_telemetry(self, header, telemetry):
+        self.telemetry_received += 1
+
+
+def cpu_time(threads):
+    # Per-thread CPU clocks, far finer than the clock ticks in /proc
+    return sum(time.clock_gettime(time.pthread_getcpuclockid(thread.ident)) for thread in threads)
+
+
+class Station:
+    def __init__(self):
+        self.shutdown = False
+
+
+def run_links(ports, mode, duration, command_hertz):
+    station = Station()
+    crafts = [SimulatedCraft(station, port) for port in ports]
+    if mode == "fleet":
+        links = LinkLoop([craft.communicator for craft in crafts], station)
+        threads = [threading.Thread(target=links.run, name="links")]
+    else:
+        links = None
+        threads = [threading.Thread(target=craft.communicator.run, name="links-{}".format(i))
+                   for i, craft in enumerate(crafts)]
+    for craft in crafts:
+        craft.communicator.send_command(protocol.Command(0.0, 0.0, 0.0))
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: all(craft.telemetry_received for craft in crafts), 5.0)
+
+    received_before = sum(craft.telemetry_received for craft in crafts)
+    cpu_before = cpu_time(threads)
+    start = time.monotonic()
+    deadline = start
+    step = 0
+    while time.monotonic() - start < duration:
+        step += 1
+        for craft in crafts:
+            craft.communicator.send_command(protocol.Command((step % 200 - 100) / 100.0, 0.0, 0.0))
+        deadline += 1.0 / command_hertz
+        time.sleep(max(0.0, deadline - time.monotonic()))
+    elapsed = time.monotonic() - start
+    cpu = (cpu_time(threads) - cpu_before) / elapsed
+
+    station.shutdown = True
+    for craft in crafts:
+        craft.communicator.stop()
+    for thread in threads:
+        thread.join()
+
+    rtts = sorted(sample for craft in crafts for sample in craft.communicator.link_stats.rtt.samples)
+
+    def percentile(percent):
+        return rtts[min(len(rtts) - 1, int(len(rtts) * percent / 100.0))] if rtts else None
+
+    return {"crafts": len(crafts),
+            "mode": mode,
+            "cpu": cpu,
+            "cpu_per_craft": cpu / len(crafts),
+            "telemetry_per_s": rate(sum(craft.telemetry_received for craft in crafts) - received_before, elapsed),
+            "rtt_p50": percentile(50),
+            "rtt_p99": percentile(99),
+            "wakeups_per_s": None if links is None else rate(links.wakeups, elapsed),
+            "resent": sum(craft.communicator.stats.resent for craft in crafts)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--crafts", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--command-hertz", type=float, default=20)
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve)
+
+    runs = []
+    for count in args.crafts:
+        with open(os.devnull, "w") as devnull:
+            server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(count)],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull)
+            ports = json.loads(server.stdout.readline())
+            with contextlib.redirect_stdout(devnull):
+                for mode in ("threads", "fleet"):
+                    runs.append(run_links(ports, mode, args.duration, args.command_hertz))
+            server.stdin.close()
+            server.wait()
+
+    results = {"timestamp": time.time(), "command_hertz": args.command_hertz, "runs": runs}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
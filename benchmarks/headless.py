@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Headless client (client/headless.py) against the GUI client (client/control.py): each
+# is started in a fresh process against the loopback remote, timed from the process
+# start until the first telemetry is in (for the GUI also drawn once), and its resident
+# memory taken at that point. The GUI runs on SDL's dummy video driver, its VPN
+# is replaced by the loopback addresses. Then the headless client plays ramps at
+# increasing command rates in-process: how many ticks come late, how many packets
+# go out and whether the remote ends up at the script's last command.
+#
+# Only the standard library at the top: the child processes must not load the
+# remote's modules (loopback.py), they would count towards the client's memory.
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT = os.path.join(ROOT, "client")
+
+
+def resident_memory():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def child(mode, port, started):
+    # Runs in the child process, prints one JSON line last
+    sys.path.insert(0, CLIENT)
+    import_start = time.perf_counter()
+    if mode == "gui":
+        import control
+
+        class LoopbackTunnel(control.Tunnel):
+            # The remote on 127.0.0.1, the client's fixed control port on another loopback address
+            BIND_ADDRESS = "127.0.0.2"
+            REMOTE_ADDRESS = "127.0.0.1"
+
+            def start(self):
+                pass
+
+        control.Tunnel = LoopbackTunnel
+        imported = time.perf_counter()
+        client = control.AirshipController("127.0.0.1")
+        while client.telemetry is None:
+            time.sleep(0.001)
+        client._render()
+    else:
+        import headless
+        imported = time.perf_counter()
+        client = headless.HeadlessClient("127.0.0.1", tunnel=False, bind_address=("127.0.0.1", 0),
+                                         remote_address=("127.0.0.1", port))
+        client.start()
+        client.set_target(0.0, 0.0, 0.0)
+        client.wait_for_telemetry()
+    ready = time.time()
+    result = {"import": imported - import_start,
+              "ready": ready - started,
+              "resident_memory": resident_memory(),
+              "modules": len(sys.modules),
+              "pygame_loaded": "pygame" in sys.modules,
+              "cryptography_loaded": "cryptography" in sys.modules}
+    client.stop()
+    print(json.dumps(result))
+
+
+def run_startup(mode, port, runs):
+    environment = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy",
+                       PYGAME_HIDE_SUPPORT_PROMPT="1")
+    results = []
+    for _ in range(runs):
+        started = time.time()
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode,
+                                 "--port", str(port), "--started", repr(started)],
+                                env=environment, stdout=subprocess.PIPE, check=True, timeout=30).stdout
+        results.append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    def median(name):
+        return sorted(result[name] for result in results)[len(results) // 2]
+
+    summary = {name: median(name) for name in ("import", "ready", "resident_memory", "modules")}
+    summary.update(runs=runs, pygame_loaded=results[0]["pygame_loaded"],
+                   cryptography_loaded=results[0]["cryptography_loaded"])
+    return summary
+
+
+def run_scripts(remote_address, rates, seconds):
+    from headless import HeadlessClient, Segment
+
+    client = HeadlessClient("127.0.0.1", tunnel=False, bind_address=("127.0.0.1", 0),
+                            remote_address=remote_address)
+    client.start()
+    client.set_target(-1.0, 0.0, 0.0)
+    client.wait_for_telemetry(timeout=2.0)
+    results = {}
+    for hertz in rates:
+        # Up and down once, and a jump at the end to see where the remote ends up
+        script = [Segment(seconds / 2, 1.0, 0.5, -0.5, ramp=True),
+                  Segment(seconds / 2, -1.0, -0.5, 0.5, ramp=True),
+                  Segment(0.0, -0.25, 0.0, 0.0)]
+        result = client.play(script, hertz)
+        last = client.wait_for_telemetry(lambda t: (t.target_throttle, t.target_yaw) == (-0.25, 0.0), 2.0)
+        result.update(hertz=hertz,
+                      achieved_hertz=result["ticks"] / result["duration"],
+                      late_share=result["late"] / result["ticks"],
+                      reached_last_command=last is not None)
+        results[hertz] = result
+    results["communicator"] = client.communicator.stats.to_json()
+    client.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="Process starts per client, the median counts")
+    parser.add_argument("--rates", type=float, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--seconds", type=float, default=2.0, help="Length of each scripted ramp")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    parser.add_argument("--child", choices=["gui", "headless"], help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--started", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.port, args.started)
+        return
+
+    from loopback import LoopbackRemote, mock_pins
+
+    class FixedPortRemote(LoopbackRemote):
+        # The GUI client only talks to the standard control port
+        CONTROL_PORT = 8081
+
+    mock_pins()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote = FixedPortRemote()
+    port = remote.address[1]
+    gui = run_startup("gui", port, args.runs)
+    headless = run_startup("headless", port, args.runs)
+    results = {"timestamp": time.time(),
+               "gui": gui,
+               "headless": headless,
+               "ready_speedup": gui["ready"] / headless["ready"],
+               "memory_saved": gui["resident_memory"] - headless["resident_memory"],
+               "scripts": run_scripts(remote.address, args.rates, args.seconds)}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote.stop()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
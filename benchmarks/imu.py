@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# IMU pipeline (remote/imu.py) without hardware: FakeI2cBus replays generated motion
+# (or a recording, --recording) through the real MPU-6050 and BMP280 drivers. Reports
+# how fast the sampling thread can read through the driver into the ring buffer, the
+# rate and jitter it holds on its own thread at --hertz, the filter's cost per sample
+# for several batch sizes against one sample at a time, its error against the true
+# attitude, and whether the attitude reaches the client's telemetry.
+import argparse
+import contextlib
+import json
+import math
+import os
+import sys
+import time
+
+import numpy
+
+from loopback import LoopbackClient, LoopbackRemote, LoopbackSensors, mock_pins, rate, wait_until
+
+import protocol
+from imu import ComplementaryFilter, FakeI2cBus, Imu, as_batch, load_recording, synthesize
+
+
+class ImuRemote(LoopbackRemote):
+    recording = None
+    hertz = Imu.SAMPLE_HERTZ
+
+    def _create_sensors(self):
+        return LoopbackSensors(self, imu=Imu(FakeI2cBus(self.recording), hertz=self.hertz, metrics=self.metrics))
+
+
+def run_acquisition(recording, samples):
+    # The sampling thread's work alone, back to back
+    imu = Imu(FakeI2cBus(recording))
+    start = time.perf_counter()
+    for _ in range(samples):
+        imu._sample()
+    elapsed = time.perf_counter() - start
+    return {"samples": samples, "per_sample": elapsed / samples, "max_hertz": rate(samples, elapsed)}
+
+
+def run_threads(recording, hertz, duration):
+    imu = Imu(FakeI2cBus(recording), hertz=hertz)
+    imu.start()
+    time.sleep(duration)
+    imu.stop()
+    sampler = imu._sampler.stats
+    return {"hertz": hertz,
+            "achieved_hertz": rate(sampler.ticks, duration),
+            "sampler_mean_jitter": sampler.mean_jitter,
+            "sampler_max_jitter": sampler.max_jitter,
+            "sampler_overruns": sampler.overruns,
+            "sampler_skipped": sampler.skipped,
+            "ring_overruns": imu.ring.overruns,
+            "filter": imu.stats.to_json()}
+
+
+def run_filter(recording, batch_sizes):
+    batch = as_batch(recording)
+    hertz = float(recording["hertz"])
+    results = {}
+    for size in batch_sizes:
+        filter_ = ComplementaryFilter(hertz)
+        start = time.perf_counter()
+        for offset in range(0, len(batch), size):
+            filter_.update(batch[offset:offset + size])
+        results[size] = (time.perf_counter() - start) / len(batch)
+    return {"per_sample": results, "speedup_vs_single": {size: results[batch_sizes[0]] / cost
+                                                         for size, cost in results.items()}}
+
+
+def run_accuracy(recording, batch_size):
+    # Error of every batch's result against the truth at its last sample, after the
+    # first two seconds (the filter starts from the accelerometer alone)
+    batch = as_batch(recording)
+    hertz = float(recording["hertz"])
+    filter_ = ComplementaryFilter(hertz)
+    errors, altitude_errors = [], []
+    for offset in range(0, len(batch), batch_size):
+        attitude = filter_.update(batch[offset:offset + batch_size])
+        last = min(offset + batch_size, len(batch)) - 1
+        if last < 2 * hertz:
+            continue
+        errors.append([attitude.roll - math.degrees(recording["attitude"][last, 0]),
+                       attitude.pitch - math.degrees(recording["attitude"][last, 1])])
+        altitude_errors.append(attitude.altitude - recording["altitude"][last])
+    errors = numpy.abs(numpy.array(errors))
+    return {"roll_rms": float(numpy.sqrt(numpy.mean(errors[:, 0] ** 2))),
+            "pitch_rms": float(numpy.sqrt(numpy.mean(errors[:, 1] ** 2))),
+            "max_error": float(errors.max()),
+            "altitude_rms": float(numpy.sqrt(numpy.mean(numpy.square(altitude_errors))))}
+
+
+def run_telemetry(recording, hertz, duration):
+    ImuRemote.recording = recording
+    ImuRemote.hertz = hertz
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote = ImuRemote()
+    client = LoopbackClient(remote.address)
+    telemetry = []
+    client.on_telemetry = lambda header, t: telemetry.append(t)
+    client.start()
+    client.communicator.send_command(protocol.Command(0.0, 0.0, 0.0))
+    wait_until(lambda: telemetry, 2.0)
+    time.sleep(duration)
+    client.stop()
+    loop = remote.control.get_loop_stats()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote.stop()
+    fresh = [t for t in telemetry if not t.attitude_stale]
+    return {"telemetry": len(telemetry),
+            "with_attitude": len(fresh),
+            "distinct_attitudes": len({(t.roll, t.pitch) for t in fresh}),
+            "control_loop_max_jitter": loop["max_jitter"],
+            "control_loop_overruns": loop["overruns"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recording", help="npz from remote/imu.py record or synthesize, generated if not given")
+    parser.add_argument("--seconds", type=float, default=60, help="Length of the generated motion")
+    parser.add_argument("--hertz", type=float, default=Imu.SAMPLE_HERTZ)
+    parser.add_argument("--samples", type=int, default=50000)
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 50, 250])
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    recording = load_recording(args.recording) if args.recording else synthesize(args.seconds, args.hertz)
+    mock_pins()
+    results = {"timestamp": time.time(),
+               "acquisition": run_acquisition(recording, args.samples),
+               "threads": run_threads(recording, args.hertz, args.duration),
+               "filter": run_filter(recording, args.batch_sizes),
+               "telemetry": run_telemetry(recording, args.hertz, args.duration)}
+    if "attitude" in recording:
+        results["accuracy"] = run_accuracy(recording, int(args.hertz / Imu.FILTER_HERTZ))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# Runs the real remote (Remote, Control, ControlServer) and the client Communicator
+# against each other on localhost, with gpiozero's mock pins instead of the hardware
+# and without VPN, modprobe and raspivid. Results are written as JSON, compare two
+# runs with compare.py.
+import argparse
+import contextlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# remote/ has to come first: both halves have a control.py, the benchmark needs the remote one
+sys.path[:0] = [os.path.join(ROOT, "remote"), os.path.join(ROOT, "client")]
+
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+import protocol
+from communicator import Communicator
+from recorder import FlightRecorder
+from remote import Remote
+from secure import DIRECT, ClientChannel, ServerChannel, load_key, write_key
+from sensors import Sensors
+from shaper import LossyProxy
+
+
+class ConstantSource:
+    def __init__(self, value=-55):
+        self.value = value
+
+    def read(self):
+        return self.value
+
+
+class LoopbackSensors(Sensors):
+    def __init__(self, remote, imu=None):
+        super().__init__(remote, rssi_source=ConstantSource(), imu=imu)
+
+    @staticmethod
+    def _create_camera():
+        return 0
+
+    def _stream_video(self):
+        pass
+
+
+class LoopbackRemote(Remote):
+    BIND_ADDRESS = "127.0.0.1"
+    CONTROL_PORT = 0
+    # Use the mock pins set as gpiozero's default
+    PIN_FACTORY = None
+    # Any free port, several remotes may run side by side
+    METRICS_ADDRESS = ("127.0.0.1", 0)
+    # No I2C here, benchmarks/imu.py replays the IMU
+    IMU_BUS = None
+
+    def _start_vpn(self):
+        self.vpn = None
+
+    def _create_sensors(self):
+        return LoopbackSensors(self)
+
+    def _create_recorder(self):
+        self.log_directory = tempfile.TemporaryDirectory()
+        return FlightRecorder(os.path.join(self.log_directory.name, self.FLIGHT_LOG))
+
+    @property
+    def address(self):
+        return self.control_server.transport.get_extra_info("sockname")
+
+
+class DirectLoopbackRemote(LoopbackRemote):
+    CONTROL_TRANSPORT = DIRECT
+    DIRECT_BIND_ADDRESS = "127.0.0.1"
+
+    def __init__(self, key_file):
+        self.KEY_FILE = key_file
+        super().__init__()
+
+
+class LoopbackClient:
+    def __init__(self, remote_address, channel=None):
+        self.shutdown = False
+        self.telemetry_received = 0
+        self.first_telemetry = None
+        self.communicator = Communicator(self, bind_address=("127.0.0.1", 0), remote_address=remote_address,
+                                         channel=channel)
+        self.thread = threading.Thread(target=self.communicator.run, name="communicator")
+
+    def on_telemetry(self, header, telemetry):
+        if self.first_telemetry is None:
+            self.first_telemetry = time.monotonic()
+        self.telemetry_received += 1
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown = True
+        self.communicator.stop()
+        self.thread.join()
+
+
+def thread_cpu_times():
+    # utime + stime per thread name in seconds, from /proc
+    ticks = os.sysconf("SC_CLK_TCK")
+    times = {}
+    for thread in threading.enumerate():
+        try:
+            with open("/proc/self/task/{}/stat".format(thread.native_id)) as f:
+                fields = f.read().rpartition(")")[2].split()
+        except (OSError, TypeError):
+            continue
+        times[thread.name] = times.get(thread.name, 0.0) + (int(fields[11]) + int(fields[12])) / ticks
+    return times
+
+
+def cpu_delta(before, after, duration):
+    return {name: (after[name] - before.get(name, 0.0)) / duration for name in after}
+
+
+def rate(count, duration):
+    return count / duration if duration else 0.0
+
+
+def mock_pins():
+    Device.pin_factory = MockFactory(pin_class=MockPWMPin)
+
+
+def run_session(command_hertz, duration, key_file=None):
+    # With key_file the control packets go over the authenticated direct channel
+    mock_pins()
+    if key_file is None:
+        remote = LoopbackRemote()
+        client = LoopbackClient(remote.address)
+    else:
+        remote = DirectLoopbackRemote(key_file)
+        client = LoopbackClient(remote.address, channel=ClientChannel(load_key(key_file)))
+    client.start()
+    # Bring-up: from the client starting to the first telemetry for its first command
+    client.communicator.send_command(protocol.Command(0.0, 0.0, 0.0))
+    wait_until(lambda: client.first_telemetry is not None, 2.0)
+
+    period = 1.0 / command_hertz
+    server_stats = remote.control_server.stats
+    packets_before = server_stats.packets
+    cpu_before = thread_cpu_times()
+    start = time.monotonic()
+    deadline = start
+    step = 0
+    while time.monotonic() - start < duration:
+        step += 1
+        client.communicator.send_command(protocol.Command((step % 200 - 100) / 100.0, 0.0, 0.0))
+        deadline += period
+        time.sleep(max(0.0, deadline - time.monotonic()))
+    elapsed = time.monotonic() - start
+    cpu = cpu_delta(cpu_before, thread_cpu_times(), elapsed)
+
+    client.stop()
+    remote.stop()
+
+    loop = remote.control.get_loop_stats()
+    link = client.communicator.link_stats
+    channel = client.communicator.channel
+    return {"duration": elapsed,
+            "bring_up": None if client.first_telemetry is None else client.first_telemetry - client.started,
+            "handshake_time": None if channel is None else channel.stats.handshake_time,
+            "commands_requested_per_s": rate(step, elapsed),
+            "commands_sent_per_s": rate(client.communicator.stats.sent, elapsed),
+            "server_packets_per_s": rate(server_stats.packets - packets_before, elapsed),
+            "server_commands_per_s": rate(server_stats.commands, elapsed),
+            "server_stale": server_stats.stale,
+            "server_mean_processing_time": server_stats.to_json()["mean_processing_time"],
+            "server_max_processing_time": server_stats.max_processing_time,
+            "telemetry_per_s": rate(client.telemetry_received, elapsed),
+            "telemetry_lost": link.telemetry_lost,
+            "control_loop": loop,
+            "actuators": remote.control.get_actuator_stats(),
+            "rtt": link.rtt.to_json(),
+            "latency": link.latency.to_json(),
+            "cpu_per_thread": cpu,
+            "communicator": client.communicator.stats.to_json()}
+
+
+# Commands in flight at most during the flood, well within the server's receive buffer
+FLOOD_WINDOW = 64
+# No progress for this long: what is still in flight counts as dropped, the window moves on
+FLOOD_STALL = 0.1
+
+
+def run_flood(packets, window=FLOOD_WINDOW):
+    # Raw decode/apply rate of the server, without the Communicator's pacing. The sender
+    # keeps the server busy without overflowing its socket, the rate is timed from the
+    # first to the last packet the server handled, drops are reported on their own
+    mock_pins()
+    remote = LoopbackRemote()
+    address = remote.address
+    server = remote.control_server
+    stats = server.stats
+    handled = {"first": None, "last": None}
+    handle = server.datagram_received
+
+    def timed(data, address):
+        if handled["first"] is None:
+            handled["first"] = time.perf_counter()
+        handle(data, address)
+        handled["last"] = time.perf_counter()
+
+    server.datagram_received = timed
+    codec = protocol.Codec()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    cpu_before = thread_cpu_times()
+    start = time.monotonic()
+    sent = given_up = 0
+    progress, progress_time = 0, start
+    while sent < packets or sent - stats.packets - given_up > 0:
+        now = time.monotonic()
+        if stats.packets != progress:
+            progress, progress_time = stats.packets, now
+        elif now - progress_time > FLOOD_STALL:
+            given_up = sent - stats.packets
+            progress_time = now
+        if sent < packets and sent - stats.packets - given_up < window:
+            sent += 1
+            sender.sendto(codec.encode_command(sent, protocol.Command(0.0, 0.0, 0.0)), address)
+        else:
+            # Hands the GIL to the server's event loop
+            time.sleep(0)
+    elapsed = time.monotonic() - start
+    cpu = cpu_delta(cpu_before, thread_cpu_times(), elapsed)
+    remote.stop()
+    sender.close()
+
+    duration = handled["last"] - handled["first"] if handled["first"] is not None else 0.0
+    return {"duration": duration,
+            "window": window,
+            "packets_sent": packets,
+            "packets_received": stats.packets,
+            "packets_dropped": packets - stats.packets,
+            "packets_per_s": rate(stats.packets, duration),
+            "mean_processing_time": stats.to_json()["mean_processing_time"],
+            "max_processing_time": stats.max_processing_time,
+            "cpu_per_thread": cpu}
+
+
+def run_crypto(packets):
+    # Seal and open cost per packet of the direct channel, for both packet types
+    key = os.urandom(256)
+    client, server = ClientChannel(key), ServerChannel(key)
+    client.open(server.open(client.hello())[1])
+    server.open(client.seal(b"first"))
+    codec = protocol.Codec()
+    results = {}
+    for name, data in [("command", bytes(codec.encode_command(1, protocol.Command(0.1, 0.2, 0.3)))),
+                       ("telemetry", bytes(codec.encode_telemetry(1, protocol.Telemetry(*[0] * len(protocol.Telemetry._fields)))))]:
+        start = time.perf_counter()
+        sealed = [client.seal(data) for _ in range(packets)]
+        seal = (time.perf_counter() - start) / packets
+        start = time.perf_counter()
+        for packet in sealed:
+            server.open(packet)
+        results[name] = {"size": len(data), "overhead": len(sealed[0]) - len(data),
+                         "seal_time": seal, "open_time": (time.perf_counter() - start) / packets}
+    start = time.perf_counter()
+    for _ in range(1000):
+        client.open(server.open(client.hello())[1])
+    results["handshake_cpu_time"] = (time.perf_counter() - start) / 1000
+    return results
+
+
+def wait_until(condition, timeout, step=0.002):
+    # Seconds until condition() held, None if it did not within timeout
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return time.monotonic() - start
+        time.sleep(step)
+    return None
+
+
+def run_failsafe(command_hertz, loss, duration, blackout):
+    # Commands through a lossy relay: first random loss (should not trigger the failsafe),
+    # then a blackout (has to trigger it), then the link comes back (has to recover)
+    mock_pins()
+    remote = LoopbackRemote()
+    proxy = LossyProxy(remote.address, loss=loss, seed=1)
+    proxy.start()
+    client = LoopbackClient(proxy.address)
+    client.start()
+    control = remote.control
+    monitor = control.link_monitor
+    period = 1.0 / command_hertz
+
+    def send_for(seconds):
+        end = time.monotonic() + seconds
+        step = 0
+        while time.monotonic() < end:
+            step += 1
+            client.communicator.send_command(protocol.Command(0.5, (step % 20 - 10) / 100.0, 0.0))
+            time.sleep(period)
+
+    send_for(1.0)
+    triggers_before = monitor.stats.triggers
+    send_for(duration)
+    false_triggers = monitor.stats.triggers - triggers_before
+
+    proxy.blackout = True
+    detected = wait_until(lambda: monitor.active, blackout)
+    motors_idle = wait_until(lambda: control.actuators.motor_left.value <= 0.1 + 1e-6, blackout)
+    proxy.blackout = False
+
+    sender = threading.Thread(target=send_for, args=(2.0,))
+    sender.start()
+    recovered = wait_until(lambda: not monitor.active, 2.0)
+    restored = wait_until(lambda: abs(control.actuators.motor_left.value - 0.175) < 1e-3, 2.0)
+    sender.join()
+
+    client.stop()
+    proxy.stop()
+    remote.stop()
+    return {"loss": loss,
+            "false_triggers": false_triggers,
+            "blackout_to_failsafe": detected,
+            "failsafe_to_idle": motors_idle,
+            "link_to_recovered": recovered,
+            "recovered_to_restored": restored,
+            "proxy_dropped": proxy.dropped,
+            "failsafe": control.get_failsafe_stats()}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds per session scenario")
+    parser.add_argument("--command-hertz", type=float, default=100.0, help="Rate of state changes in the session")
+    parser.add_argument("--flood-packets", type=int, default=20000)
+    parser.add_argument("--crypto-packets", type=int, default=20000)
+    parser.add_argument("--loss", type=float, default=0.2, help="Packet loss of the failsafe scenario")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+            tempfile.TemporaryDirectory() as directory:
+        key_file = os.path.join(directory, "secret.key")
+        write_key(key_file)
+        results = {"revision": git_revision(),
+                   "timestamp": time.time(),
+                   "python": platform.python_version(),
+                   "machine": platform.machine(),
+                   "session": run_session(args.command_hertz, args.duration),
+                   # Same session over the direct channel, compare rtt/latency with the above
+                   "session_direct": run_session(args.command_hertz, args.duration, key_file),
+                   "crypto": run_crypto(args.crypto_packets),
+                   "flood": run_flood(args.flood_packets),
+                   "failsafe": run_failsafe(50.0, args.loss, args.duration, 3.0)}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Overhead of the metrics (remote/metrics.py): the cost of one counter increment and
+# one histogram observation, what the instrumentation adds to a control loop tick
+# (Control._loop against the bare Control._tick, same remote and mock pins), and how
+# long a scrape of the loopback remote takes over HTTP and over the control channel,
+# while a client is flying it.
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import urllib.request
+
+from loopback import LoopbackClient, LoopbackRemote, mock_pins, wait_until
+
+import protocol
+from metrics import Registry
+from remote_metrics import MetricsClient
+
+
+def per_call(function, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls
+
+
+def run_primitives(calls):
+    registry = Registry()
+    counter = registry.counter("counter", "")
+    histogram = registry.histogram("histogram", "")
+    return {"counter_inc": per_call(counter.inc, calls),
+            "histogram_observe": per_call(lambda: histogram.observe(0.0003), calls),
+            # The lambda alone, to subtract from the observation
+            "call_overhead": per_call(lambda: None, calls)}
+
+
+def run_tick(ticks, rounds):
+    # Both interleaved over several rounds, the better round of each counts
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote = LoopbackRemote()
+    control = remote.control
+    # Stopped, so nothing else drives the outputs meanwhile
+    control._control_loop.stop()
+    bare, instrumented = [], []
+    for _ in range(rounds):
+        bare.append(per_call(control._tick, ticks))
+        instrumented.append(per_call(control._loop, ticks))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote.stop()
+    return {"ticks": ticks * rounds,
+            "bare_tick": min(bare),
+            "instrumented_tick": min(instrumented),
+            "overhead_per_tick": min(instrumented) - min(bare),
+            "overhead_share": (min(instrumented) - min(bare)) / min(bare)}
+
+
+def run_scrapes(scrapes, command_hertz):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote = LoopbackRemote()
+    client = LoopbackClient(remote.address)
+    client.start()
+    client.communicator.send_command(protocol.Command(0.0, 0.0, 0.0))
+    wait_until(lambda: client.first_telemetry is not None, 2.0)
+
+    url = "http://{}:{}/metrics".format(*remote.metrics_server.address)
+    query = MetricsClient(remote.address, bind_address=("127.0.0.1", 0))
+    http_times, channel_times = [], []
+    size = 0
+    answered = 0
+    for i in range(scrapes):
+        client.communicator.send_command(protocol.Command((i % 200 - 100) / 100.0, 0.0, 0.0))
+        start = time.perf_counter()
+        with urllib.request.urlopen(url) as response:
+            size = len(response.read())
+        http_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        if query.query() is not None:
+            answered += 1
+        channel_times.append(time.perf_counter() - start)
+        time.sleep(1.0 / command_hertz)
+    query.close()
+    loop = remote.control.get_loop_stats()
+    server = remote.control_server.stats.to_json()
+    snapshot = remote.metrics.to_json("control_")
+
+    client.stop()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote.stop()
+
+    def median(values):
+        return sorted(values)[len(values) // 2]
+
+    return {"scrapes": scrapes,
+            "http_scrape": median(http_times),
+            "http_scrape_max": max(http_times),
+            "http_bytes": size,
+            "channel_query": median(channel_times),
+            "channel_answered": answered,
+            "control_loop_max_duration": loop["max_duration"],
+            "control_loop_overruns": loop["overruns"],
+            "server_max_processing_time": server["max_processing_time"],
+            "control_tick_p99": snapshot["control_tick_seconds"]["p99"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=1000000)
+    parser.add_argument("--ticks", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--scrapes", type=int, default=200)
+    parser.add_argument("--command-hertz", type=float, default=50)
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    mock_pins()
+    results = {"timestamp": time.time(),
+               "primitives": run_primitives(args.calls),
+               "tick": run_tick(args.ticks, args.rounds),
+               "scrapes": run_scrapes(args.scrapes, args.command_hertz)}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import heapq
+import random
+import selectors
+import socket
+import threading
+import time
+
+
+# UDP relay on localhost that drops and delays packets: a random share of them is lost
+# (loss), all of them while a blackout is on, the rest is held back for delay seconds
+# plus a random 0..jitter. Like the queue of a real link, jitter does not reorder.
+# The client sends to proxy.address instead of the remote, replies go back to the
+# address the last client packet came from.
+class LossyProxy:
+    def __init__(self, target, loss=0.0, seed=None, delay=0.0, jitter=0.0):
+        self.target = target
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.blackout = False
+        self.forwarded = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._client = None
+        self._queue = []
+        self._queued = 0
+        self._last_release = 0.0
+
+        self._client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        self._client_socket.bind(("127.0.0.1", 0))
+        self._target_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._target_socket.bind(("127.0.0.1", 0))
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._run, name="lossy-proxy")
+        self._thread.daemon = True
+
+    @property
+    def address(self):
+        return self._client_socket.getsockname()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._shutdown = True
+        self._thread.join()
+        self._client_socket.close()
+        self._target_socket.close()
+
+    def _drop(self):
+        return self.blackout or (self.loss and self._random.random() < self.loss)
+
+    def _send_due(self):
+        # Sends what is due, returns the seconds until the next packet is
+        now = time.monotonic()
+        while self._queue and self._queue[0][0] <= now:
+            _, _, sender, data, destination = heapq.heappop(self._queue)
+            sender.sendto(data, destination)
+            self.forwarded += 1
+        return self._queue[0][0] - now if self._queue else 0.1
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._client_socket, selectors.EVENT_READ)
+        selector.register(self._target_socket, selectors.EVENT_READ)
+        while not self._shutdown:
+            for key, _ in selector.select(self._send_due()):
+                data, address = key.fileobj.recvfrom(65536)
+                if key.fileobj is self._client_socket:
+                    self._client = address
+                    destination, sender = self.target, self._target_socket
+                else:
+                    destination, sender = self._client, self._client_socket
+                if destination is None or self._drop():
+                    self.dropped += 1
+                    continue
+                if not self.delay and not self.jitter:
+                    sender.sendto(data, destination)
+                    self.forwarded += 1
+                    continue
+                release = time.monotonic() + self.delay + self._random.random() * self.jitter
+                release = self._last_release = max(release, self._last_release)
+                # The counter keeps equal release times in arrival order
+                self._queued += 1
+                heapq.heappush(self._queue, (release, self._queued, sender, data, destination))
+        selector.close()
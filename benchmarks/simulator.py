@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Airship simulator (remote/simulator.py): how much faster than real time a lock-step
+# flight of the full control stack runs (Control with the failsafe, gpiozero on mock
+# pins, the IMU drivers and filter), with and without the IMU, whether --speed pacing
+# holds the requested multiple, and how the batched physics scales with the number of
+# airships, against stepping them one AirshipBatch each.
+import argparse
+import json
+import sys
+import time
+
+from loopback import rate
+
+from simulator import AirshipBatch, BatchFlight, Script, SimulatedFlight, summary
+
+SCRIPT = [{"duration": 2, "throttle": -1.0},
+          {"duration": 10, "throttle": 0.6, "climb": 0.5},
+          {"duration": 5, "throttle": 0.6, "yaw": 0.5},
+          {"duration": 3, "throttle": 0.4, "link": False}]
+
+
+def run_lockstep(script, imu):
+    flight = SimulatedFlight(imu=imu)
+    start = time.perf_counter()
+    trace = flight.run(script)
+    elapsed = time.perf_counter() - start
+    flight.close()
+    result = summary(trace)
+    return {"simulated": script.duration,
+            "elapsed": elapsed,
+            "realtime_factor": script.duration / elapsed,
+            "ticks_per_second": rate(len(trace), elapsed),
+            "failsafe_ticks": result["failsafe_ticks"],
+            "max_altitude": result["max_altitude"],
+            "imu_pitch_error": result["imu_pitch_error"]}
+
+
+def run_paced(script, speed):
+    flight = SimulatedFlight(speed=speed)
+    start = time.perf_counter()
+    flight.run(script)
+    elapsed = time.perf_counter() - start
+    flight.close()
+    return {"speed": speed, "achieved_speed": script.duration / elapsed}
+
+
+def run_batch(script, counts):
+    results = {}
+    for count in counts:
+        flight = BatchFlight(count)
+        start = time.perf_counter()
+        flight.run(script)
+        elapsed = time.perf_counter() - start
+        steps = int(round(script.duration * BatchFlight.PHYSICS_HERTZ))
+        results[count] = {"elapsed": elapsed,
+                          "airship_steps_per_second": rate(count * steps, elapsed),
+                          "realtime_factor": script.duration * count / elapsed}
+    return results
+
+
+def run_vectorization(count, steps):
+    # The same airships stepped as one batch and one by one
+    dt = 1.0 / BatchFlight.PHYSICS_HERTZ
+    batch = AirshipBatch(count)
+    outputs = [0.18] * count, [0.18] * count, [0.3] * count
+    start = time.perf_counter()
+    for _ in range(steps):
+        batch.step(dt, *outputs)
+    batched = time.perf_counter() - start
+    singles = [AirshipBatch(1) for _ in range(count)]
+    start = time.perf_counter()
+    for _ in range(steps):
+        for airship in singles:
+            airship.step(dt, [0.18], [0.18], [0.3])
+    single = time.perf_counter() - start
+    return {"airships": count, "steps": steps, "batched": batched, "one_by_one": single, "speedup": single / batched}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", help="JSON list of segments, a climb, turn and link loss if not given")
+    parser.add_argument("--speeds", type=float, nargs="+", default=[5, 20])
+    parser.add_argument("--counts", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--airships", type=int, default=100, help="Batched against one by one")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    script = Script.load(args.script) if args.script else Script(SCRIPT)
+    results = {"timestamp": time.time(),
+               "lockstep": run_lockstep(script, True),
+               "lockstep_without_imu": run_lockstep(script, False),
+               "paced": [run_paced(script, speed) for speed in args.speeds],
+               "batch": run_batch(script, args.counts),
+               "vectorization": run_vectorization(args.airships, args.steps)}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Startup time of the remote with stubbed slow stages: starting openvpn, the tunnel
+# address showing up, modprobe and v4l2-ctl for the camera and connecting to pigpiod
+# sleep for the given seconds, everything else is the real loopback remote. Compares
+# the stages one after another (the old startup) with the parallel startup and reports
+# when commands are accepted ("serving" done) and when everything is up.
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+from loopback import LoopbackRemote, LoopbackSensors, mock_pins
+
+
+class StubbedSensors(LoopbackSensors):
+    def _create_camera(self):
+        time.sleep(self.remote.camera_delay)
+        return 0
+
+
+class StubbedRemote(LoopbackRemote):
+    vpn_delay = 0.0
+    tunnel_delay = 0.0
+    camera_delay = 0.0
+    actuator_delay = 0.0
+
+    def _start_vpn(self):
+        time.sleep(self.vpn_delay)
+        self.vpn = None
+
+    def _wait_for_tunnel(self):
+        time.sleep(self.tunnel_delay)
+
+    def _create_sensors(self):
+        return StubbedSensors(self)
+
+    def _start_control(self):
+        time.sleep(self.actuator_delay)
+        super()._start_control()
+
+
+def run_startup(parallel, delays):
+    mock_pins()
+    remote_class = type("Remote", (StubbedRemote,), dict(delays, PARALLEL_STARTUP=parallel))
+    start = time.monotonic()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        remote = remote_class()
+        constructed = time.monotonic() - start
+        report = remote.startup.to_json()
+        remote.stop()
+    return {"serving": remote.startup.ready("serving"),
+            "total": report["total"],
+            "constructed": constructed,
+            "stages": report["stages"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vpn", type=float, default=0.3, help="Seconds to start openvpn")
+    parser.add_argument("--tunnel", type=float, default=1.0, help="Seconds until the tunnel has its address")
+    parser.add_argument("--camera", type=float, default=1.5, help="Seconds for modprobe and the camera setup")
+    parser.add_argument("--actuators", type=float, default=0.2, help="Seconds to connect to pigpiod")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    delays = {"vpn_delay": args.vpn, "tunnel_delay": args.tunnel,
+              "camera_delay": args.camera, "actuator_delay": args.actuators}
+    results = {"timestamp": time.time(), "delays": delays}
+    for name, parallel in (("sequential", False), ("parallel", True)):
+        runs = [run_startup(parallel, delays) for _ in range(args.runs)]
+        results[name] = {"serving": min(run["serving"] for run in runs),
+                         "total": min(run["total"] for run in runs),
+                         "stages": runs[-1]["stages"]}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Streams a recorded H.264 file (Annex-B, e.g. from raspivid -o or v4l2-ctl
+# --stream-to) with the remote's RtpVideoStreamer through a lossy, delaying UDP relay
+# to the client's RtpVideoReceiver, at several loss rates with and without FEC.
+# Reports per frame latency and the share of frames that reached the decoder.
+# Without --source a synthetic stream of the same shape is used (not decodable,
+# the transport does not care).
+import argparse
+import contextlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# remote/ first, both halves have a control.py
+sys.path[:0] = [os.path.join(ROOT, "remote"), os.path.join(ROOT, "client")]
+
+from h264 import NalRingBuffer
+from linkstats import RollingHistogram
+from ratecontrol import RateController
+from rtp import Packetizer
+from sensors import Reading
+from shaper import LossyProxy
+from streaming import RtpVideoStreamer
+from video import RtpVideoReceiver
+
+
+def play(path, fps):
+    # Writes the file to stdout one access unit per frame period, like the camera would
+    ring = NalRingBuffer()
+    out = sys.stdout.buffer
+    period = 1.0 / fps
+    deadline = time.monotonic()
+    with open(path, "rb") as f:
+        while ring.receive(f.readinto):
+            for unit, _ in ring.units():
+                deadline += period
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                out.write(unit)
+                out.flush()
+        unit = ring.flush()
+        if unit is not None:
+            out.write(unit[0])
+            out.flush()
+    # A camera keeps the stream open, the streamer ends the capture
+    time.sleep(3600)
+
+
+def synthetic_stream(path, frames, fps, bitrate, seed=1):
+    # SPS/PPS/IDR once a second, P slices in between, sizes around the target bitrate
+    rng = random.Random(seed)
+    average = bitrate / 8 / fps
+    with open(path, "wb") as f:
+        for i in range(frames):
+            if i % fps == 0:
+                f.write(b"\x00\x00\x00\x01\x67" + rng.randbytes(10) + b"\x00\x00\x00\x01\x68" + rng.randbytes(4))
+                size, nal = int(average * 4), b"\x65\x88"
+            else:
+                size, nal = int(average * rng.uniform(0.5, 1.2)), b"\x41\x9a"
+            # No start codes inside the payload
+            f.write(b"\x00\x00\x00\x01" + nal + rng.randbytes(size).replace(b"\x00\x00", b"\x00\x03"))
+
+
+class FileCamera:
+    def __init__(self, path, fps):
+        self.path = path
+        self.fps = fps
+        self.mode = RateController().mode
+
+    def setup(self, mode):
+        return 0
+
+    def set_format(self, mode):
+        self.mode = mode
+
+    set_rate = set_format
+
+    def capture(self):
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--play", self.path,
+                                 "--fps", str(self.fps)], stdout=subprocess.PIPE)
+
+
+class FixedRssi:
+    def latest(self):
+        return Reading(-55, time.monotonic(), False)
+
+
+class TimedStreamer(RtpVideoStreamer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = {}
+
+    def _send(self, sock, unit, key):
+        self.sent[hash(bytes(unit))] = time.monotonic()
+        super()._send(sock, unit, key)
+
+
+class TimedReceiver(RtpVideoReceiver):
+    # Measures instead of decoding
+    def __init__(self, sent, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = sent
+        self.latency = RollingHistogram(10000)
+        self.frames = 0
+
+    def _feed(self, unit, key):
+        now = time.monotonic()
+        self.frames += 1
+        sent = self.sent.get(hash(bytes(unit)))
+        if sent is not None:
+            self.latency.add(now - sent)
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_transport(source, fps, frames, loss, fec_group, delay, jitter):
+    receiver_address = ("127.0.0.1", free_udp_port())
+    proxy = LossyProxy(receiver_address, loss=loss, seed=1, delay=delay, jitter=jitter)
+    proxy.start()
+    streamer = TimedStreamer(proxy.address, FixedRssi(), camera=FileCamera(source, fps),
+                             packetizer=Packetizer(fec_group=fec_group))
+    # Keep the mode fixed, this measures the transport
+    streamer.RATE_INTERVAL = float("inf")
+    receiver = TimedReceiver(streamer.sent, bind_address=receiver_address)
+    receiver_thread = threading.Thread(target=receiver.run, name="video")
+    receiver_thread.start()
+    time.sleep(0.1)
+
+    done = threading.Event()
+    sender_thread = threading.Thread(target=streamer.stream, args=(lambda: not done.is_set(),))
+    sender_thread.start()
+    start = time.monotonic()
+    # The file plays once, a little longer for the last frames to arrive
+    while len(streamer.sent) < frames and time.monotonic() - start < frames / fps * 2 + 5:
+        time.sleep(0.05)
+    time.sleep(0.3)
+    done.set()
+    sender_thread.join()
+    receiver.shutdown = True
+    receiver_thread.join()
+    proxy.stop()
+
+    stats = receiver.jitter_buffer.stats
+    return {"loss": loss,
+            "fec_group": fec_group,
+            "frames_sent": len(streamer.sent),
+            "frames_delivered": receiver.frames,
+            "delivered_ratio": receiver.frames / len(streamer.sent) if streamer.sent else 0.0,
+            "packets_sent": streamer.packets_sent,
+            "packets_dropped_by_sender": streamer.packets_dropped,
+            "latency": receiver.latency.to_json(),
+            "jitter_buffer": stats.to_json()}
+
+
+def count_frames(path):
+    ring = NalRingBuffer()
+    count = 0
+    with open(path, "rb") as f:
+        while ring.receive(f.readinto):
+            count += sum(1 for _ in ring.units())
+    return count + (ring.flush() is not None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", help="H.264 Annex-B file, a synthetic stream if not given")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--seconds", type=float, default=5.0, help="Length of the synthetic stream")
+    parser.add_argument("--bitrate", type=int, default=1200000, help="Bitrate of the synthetic stream")
+    parser.add_argument("--loss", type=float, nargs="+", default=[0.0, 0.01, 0.05])
+    parser.add_argument("--delay", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    parser.add_argument("--play", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.play:
+        return play(args.play, args.fps)
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = args.source
+        if source is None:
+            source = os.path.join(directory, "synthetic.h264")
+            synthetic_stream(source, int(args.seconds * args.fps), args.fps, args.bitrate)
+        frames = count_frames(source)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            runs = [run_transport(source, args.fps, frames, loss, fec_group, args.delay, args.jitter)
+                    for loss in args.loss for fec_group in (1, 8)]
+
+    results = {"timestamp": time.time(),
+               "source": args.source or "synthetic",
+               "frames": frames,
+               "delay": args.delay,
+               "jitter": args.jitter,
+               "runs": runs}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+import heapq
+import selectors
+import socket
+import threading
+import time
+
+import protocol
+from linkstats import LinkStats
+from secure import SecurityError
+
+
+class CommunicatorStats:
+    def __init__(self):
+        self.sent = 0
+        self.resent = 0
+        self.heartbeats = 0
+        self.coalesced = 0
+        self.received = 0
+        self.decode_errors = 0
+        self.handshakes_sent = 0
+
+    def to_json(self):
+        return {"sent": self.sent,
+                "resent": self.resent,
+                "heartbeats": self.heartbeats,
+                "coalesced": self.coalesced,
+                "received": self.received,
+                "decode_errors": self.decode_errors,
+                "handshakes_sent": self.handshakes_sent}
+
+
+# Sends the latest target state to the remote and receives telemetry.
+#
+# The loop only wakes up on a received packet, on send_state() or when the next
+# resend/heartbeat is due. Only the latest command is kept, so a burst of state
+# changes results in one packet. A new command is resent with a backoff that
+# starts at twice the smoothed RTT until the telemetry reports it as applied, after that
+# it is repeated as a heartbeat.
+#
+# With a secure.ClientChannel the packets go directly to the remote, sealed per
+# packet. Commands wait for the handshake, which is repeated whenever nothing
+# authenticated came back for HANDSHAKE_TIMEOUT, e.g. after the remote restarted.
+class Communicator:
+    CONTROL_PORT = 8081
+    HEARTBEAT_INTERVAL = 0.25
+    MIN_RESEND_INTERVAL = 0.02
+    INITIAL_RTT = 0.05
+    RTT_SMOOTHING = 0.125
+    HANDSHAKE_TIMEOUT = 0.5
+
+    def __init__(self, controller, encoding=protocol.BINARY, bind_address=None, remote_address=None,
+                 channel=None):
+        self.controller = controller
+        self.encoding = encoding
+        self.bind_address = bind_address
+        self.remote_address = remote_address
+        self.channel = channel
+
+        self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.control_socket.setblocking(False)
+        self._wakeup_receive, self._wakeup_send = socket.socketpair()
+        self._wakeup_receive.setblocking(False)
+        self._wakeup_send.setblocking(False)
+
+        self.codec = protocol.Codec()
+        self.stats = CommunicatorStats()
+        self.link_stats = LinkStats()
+        self.command_seq = 0
+        self.srtt = self.INITIAL_RTT
+        self._recv_buffer = bytearray(protocol.MAX_PACKET_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
+
+        # Latest-wins slot, written by send_state(), taken by the loop
+        self._lock = threading.Lock()
+        self._pending = None
+        self._wakeup_pending = False
+
+        self.command = None
+        self.command_timestamp = None
+        self.confirmed = False
+        self._command_first_seq = 0
+        self._command_time = 0.0
+        self._resend_interval = self.HEARTBEAT_INTERVAL
+        self._next_send = None
+        self._next_hello = 0.0
+        self._last_authenticated = None
+
+    def send_state(self, state):
+        self.send_command(state.to_command())
+
+    def send_command(self, command, timestamp=None):
+        # The timestamp of the state change travels with every (re)send of the command
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            if self._pending is not None:
+                self.stats.coalesced += 1
+            self._pending = (command, timestamp)
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
+        self._wakeup()
+
+    def stop(self):
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            # Either a wakeup is queued already or the loop has finished
+            pass
+
+    def _encode(self, command, timestamp):
+        self.command_seq += 1
+        if self.encoding == protocol.BINARY:
+            return self.codec.encode_command(self.command_seq, command, timestamp)
+        return protocol.command_to_json(self.command_seq, command, timestamp)
+
+    def _send(self, now):
+        if self.channel is not None and self.channel.session is None:
+            # Sent as soon as the handshake is done
+            self._next_send = None
+            return
+        try:
+            data = self._encode(self.command, self.command_timestamp)
+            if self.channel is not None:
+                data = self.channel.seal(data)
+            self.control_socket.sendto(data, self._remote_address())
+        except OSError as e:
+            print("Error while sending command: {}".format(e))
+        self.stats.sent += 1
+        self.link_stats.command_sent(self.command_seq, now)
+        if self.confirmed:
+            self.stats.heartbeats += 1
+            self._resend_interval = self.HEARTBEAT_INTERVAL
+        else:
+            self._resend_interval = min(self._resend_interval * 2, self.HEARTBEAT_INTERVAL)
+        self._next_send = now + self._resend_interval
+
+    def _take_pending(self, now):
+        try:
+            while self._wakeup_receive.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._wakeup_pending = False
+        if pending is None:
+            return
+
+        self.command, self.command_timestamp = pending
+        self.confirmed = False
+        self._command_first_seq = self.command_seq + 1
+        self._command_time = now
+        # Halved again by _send(), so the first resend is due after 2*srtt
+        self._resend_interval = max(self.srtt, self.MIN_RESEND_INTERVAL / 2)
+        self._send(now)
+
+    def _is_confirmed_by(self, telemetry):
+        # Any packet of the current command (or a newer one) has been applied
+        return (telemetry.applied_seq - self._command_first_seq) & 0xFFFFFFFF < 0x80000000
+
+    def _receive(self, now):
+        while True:
+            try:
+                size = self.control_socket.recv_into(self._recv_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. ICMP port unreachable while the remote is not up yet
+                print("Error while receiving telemetry: {}".format(e))
+                return
+            self._handle_telemetry(self._recv_view[:size], now)
+
+    def _handle_telemetry(self, data, now):
+        if self.channel is not None:
+            try:
+                data = self.channel.open(data, now)
+            except SecurityError as e:
+                self.stats.decode_errors += 1
+                print("Dropping telemetry: {}".format(e))
+                return
+            self._last_authenticated = now
+            if data is None:
+                # Handshake done, the current command goes out right away
+                if self.command is not None:
+                    self._send(now)
+                return
+        try:
+            header, telemetry = protocol.decode_telemetry(data)
+        except protocol.ProtocolError as e:
+            self.stats.decode_errors += 1
+            print("Dropping telemetry: {}".format(e))
+            return
+        self.stats.received += 1
+        self.link_stats.telemetry_received(header, telemetry, now)
+
+        if self.command is not None and not self.confirmed and self._is_confirmed_by(telemetry):
+            self.confirmed = True
+            # Karn's rule: every resend has its own seq, so the sample is taken from the
+            # packet that got applied, a lost first send does not count towards it
+            sent_time = self.link_stats.sent_time(telemetry.applied_seq)
+            if sent_time is not None:
+                self.srtt += self.RTT_SMOOTHING * (now - sent_time - self.srtt)
+            self._next_send = self._command_time + self.HEARTBEAT_INTERVAL
+
+        self.controller.on_telemetry(header, telemetry)
+
+    def open(self, selector):
+        # Binds and registers with the selector, False if the address is not there yet
+        # (the tunnel is still coming up). run() drives one link, a LinkLoop many.
+        try:
+            self.control_socket.bind(self._bind_address())
+        except OSError:
+            return False
+        selector.register(self.control_socket, selectors.EVENT_READ, self._receive)
+        selector.register(self._wakeup_receive, selectors.EVENT_READ, self._take_pending)
+        return True
+
+    def next_wakeup(self):
+        # When service() has something to do, None if only a packet or send_state() can
+        wakeup = self._next_send
+        if self.channel is not None:
+            wakeup = self._next_hello if wakeup is None else min(wakeup, self._next_hello)
+        return wakeup
+
+    def service(self, now):
+        if self.channel is not None:
+            self._handshake(now)
+        if self._next_send is not None and now >= self._next_send:
+            if not self.confirmed:
+                self.stats.resent += 1
+            self._send(now)
+
+    def close(self):
+        self.control_socket.close()
+        self._wakeup_receive.close()
+        self._wakeup_send.close()
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        while not self.open(selector):
+            if self.controller.shutdown:
+                return
+            time.sleep(0.5)
+        try:
+            while not self.controller.shutdown:
+                wakeup = self.next_wakeup()
+                timeout = None if wakeup is None else max(0.0, wakeup - time.monotonic())
+                for key, _ in selector.select(timeout):
+                    key.data(time.monotonic())
+                self.service(time.monotonic())
+        finally:
+            selector.close()
+            self.close()
+
+    def _handshake(self, now):
+        if now < self._next_hello:
+            return
+        self._next_hello = now + self.channel.HANDSHAKE_INTERVAL
+        if self._last_authenticated is not None and now - self._last_authenticated < self.HANDSHAKE_TIMEOUT:
+            return
+        try:
+            self.control_socket.sendto(self.channel.hello(now), self._remote_address())
+            self.stats.handshakes_sent += 1
+        except OSError as e:
+            print("Error while sending handshake: {}".format(e))
+
+    def _bind_address(self):
+        return self.bind_address or (self.controller.tunnel.BIND_ADDRESS, self.CONTROL_PORT)
+
+    def _remote_address(self):
+        return self.remote_address or (self.controller.tunnel.REMOTE_ADDRESS, self.CONTROL_PORT)
+
+
+# Many links on one thread: all Communicators share one selector, so N crafts cost
+# one wakeup per batch of ready sockets instead of N threads each waking up on its own.
+# Resend and heartbeat deadlines sit in a heap, only the links that got a packet or
+# are due are looked at, not all N every time.
+class LinkLoop:
+    RETRY_INTERVAL = 0.5
+
+    def __init__(self, communicators, controller):
+        self.communicators = list(communicators)
+        self.controller = controller
+        self.wakeups = 0
+
+        self._heap = []
+        self._scheduled = {}
+
+    def _schedule(self, index, communicator):
+        wakeup = communicator.next_wakeup()
+        if wakeup is not None and wakeup != self._scheduled.get(index):
+            self._scheduled[index] = wakeup
+            heapq.heappush(self._heap, (wakeup, index))
+
+    def _next_due(self):
+        # Drops entries that were rescheduled since they were pushed
+        while self._heap and self._scheduled.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        owners = {}
+        waiting = list(range(len(self.communicators)))
+        next_retry = 0.0
+        try:
+            while not self.controller.shutdown:
+                now = time.monotonic()
+                if waiting and now >= next_retry:
+                    next_retry = now + self.RETRY_INTERVAL
+                    for index in list(waiting):
+                        communicator = self.communicators[index]
+                        if communicator.open(selector):
+                            waiting.remove(index)
+                            owners[communicator.control_socket.fileno()] = index
+                            owners[communicator._wakeup_receive.fileno()] = index
+                            self._schedule(index, communicator)
+
+                wakeup = self._next_due()
+                if waiting:
+                    wakeup = next_retry if wakeup is None else min(wakeup, next_retry)
+                timeout = None if wakeup is None else max(0.0, wakeup - now)
+                touched = set()
+                for key, _ in selector.select(timeout):
+                    key.data(time.monotonic())
+                    touched.add(owners[key.fd])
+                self.wakeups += 1
+
+                now = time.monotonic()
+                while self._next_due() is not None and self._heap[0][0] <= now:
+                    _, index = heapq.heappop(self._heap)
+                    del self._scheduled[index]
+                    self.communicators[index].service(now)
+                    touched.add(index)
+                for index in touched:
+                    self._schedule(index, self.communicators[index])
+        finally:
+            selector.close()
+            for communicator in self.communicators:
+                communicator.close()
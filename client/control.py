@@ -1,60 +1,53 @@
 import pygame
-import subprocess
-import socket
-import select
 import threading
-import json
 import time
-import copy
-from PIL import Image
-
-FUNCTIONS = {
-    119: "throttle_more",   # w
-    115: "throttle_less",   # s
-     97: "yaw_left",        # a
-    100: "yaw_right",       # d
-    101: "climb_up",        # e
-    113: "climb_down",      # q
-    276: "yaw_left",        # ARROW_LEFT
-    275: "yaw_right",       # ARROW_RIGHT
-    273: "throttle_more",   # ARROW_UP
-    274: "throttle_less",   # ARROW_DOWN
-}
 
+import protocol
+from communicator import Communicator
+from hud import Hud
+from inputs import InputSampler
+from rtp import RTP, TCP
+from secure import ClientChannel, load_key
+from supervisor import Supervisor
+from tunnel import Tunnel
+from video import RtpVideoReceiver, VideoReceiver
 
 class State:
     def __init__(self, throttle, yaw, climb, font=None, *args, **kwargs):
         self.throttle = throttle
         self.yaw = yaw
         self.climb = climb
-
-        if font:
-            self.font = font
-        else:
-            self.font = pygame.font.Font(None, 20)
+        # Only needed for draw(), the HUD renders text() through its cache
+        self.font = font
 
     def to_json(self):
-        return {"throttle": self.throttle/100.0, "yaw": self.yaw/100.0, "climb": self.climb/100.0}
+        # Commands have a resolution of 1%, so ramping does not send a packet per sample
+        return {"throttle": round(self.throttle)/100.0, "yaw": round(self.yaw)/100.0, "climb": round(self.climb)/100.0}
 
-    def to_data(self):
-        return bytes(json.dumps(self.to_json()), 'utf-8')
+    def to_command(self):
+        return protocol.Command(**self.to_json())
 
     @staticmethod
-    def from_json_data(data):
-        return State(**json.loads(data.decode('utf-8')).get('target_state', {}))
+    def from_telemetry(telemetry):
+        return State(telemetry.target_throttle * 100, telemetry.target_yaw * 100, telemetry.target_climb * 100)
+
+    def text(self):
+        return "Throttle: {:.0f}  Yaw: {:.0f}  Pitch: {:.0f}".format(self.throttle, self.yaw, self.climb)
 
     def draw(self):
-        return self.font.render("Throttle: {}  Yaw: {}  Pitch: {}".format(self.throttle, self.yaw, self.climb),
-                                True, (255, 255, 255))
+        if self.font is None:
+            self.font = pygame.font.Font(None, 20)
+        return self.font.render(self.text(), True, (255, 255, 255))
 
     def __eq__(self, other):
         return self.throttle == other.throttle and self.yaw == other.yaw and self.climb == other.climb
 
 
 class TargetState(State):
-    THROTTLE_SPEED = 1
-    YAW_SPEED = 1
-    CLIMB_SPEED = 1
+    # Units per second while a key is held
+    THROTTLE_SPEED = 20
+    YAW_SPEED = 20
+    CLIMB_SPEED = 20
 
     def __init__(self, throttle, yaw, climb, font=None):
         super().__init__(throttle, yaw, climb, font=font)
@@ -68,32 +61,43 @@ class TargetState(State):
             "climb_down": self.climb_down
         }
 
-    def execute_functions(self, functions):
-        [self.functions.get(f_, lambda: 1)() for f_ in functions]
+    def execute_functions(self, functions, dt):
+        [self.functions.get(f_, lambda dt: 1)(dt) for f_ in functions]
 
-    def throttle_more(self):
-        self.throttle += self.THROTTLE_SPEED if self.throttle < 100 else 0
+    def set_axis(self, name, value):
+        setattr(self, name, self._clamp(value))
 
-    def throttle_down(self):
-        self.throttle -= self.THROTTLE_SPEED if self.throttle > -100 else 0
+    @staticmethod
+    def _clamp(value):
+        return max(-100, min(100, value))
+
+    def throttle_more(self, dt):
+        self.throttle = self._clamp(self.throttle + self.THROTTLE_SPEED * dt)
 
-    def yaw_left(self):
-        self.yaw -= self.YAW_SPEED if self.throttle > -100 else 0
+    def throttle_down(self, dt):
+        self.throttle = self._clamp(self.throttle - self.THROTTLE_SPEED * dt)
 
-    def yaw_right(self):
-        self.yaw += self.YAW_SPEED if self.throttle < 100 else 0
+    def yaw_left(self, dt):
+        self.yaw = self._clamp(self.yaw - self.YAW_SPEED * dt)
 
-    def climb_up(self):
-        self.climb += self.CLIMB_SPEED if self.throttle < 100 else 0
+    def yaw_right(self, dt):
+        self.yaw = self._clamp(self.yaw + self.YAW_SPEED * dt)
 
-    def climb_down(self):
-        self.climb -= self.CLIMB_SPEED if self.throttle > -100 else 0
+    def climb_up(self, dt):
+        self.climb = self._clamp(self.climb + self.CLIMB_SPEED * dt)
+
+    def climb_down(self, dt):
+        self.climb = self._clamp(self.climb - self.CLIMB_SPEED * dt)
 
 
 class AirshipController:
-    def __init__(self, host="192.168.8.100"):
+    RENDER_FPS = 20
+
+    def __init__(self, host="192.168.8.100", encoding=protocol.BINARY, stats_export=None,
+                 input_hertz=InputSampler.SAMPLE_HERTZ, video_transport=TCP, direct=False):
         self.shutdown = False
         self.host = host
+        self.stats_export = stats_export
 
         pygame.init()
 
@@ -102,232 +106,144 @@ class AirshipController:
         # Set the width and height of the screen [width,height]
         size = [1280, 720]
         self.screen = pygame.display.set_mode(size)
-        self.clock = pygame.time.Clock()
         self.font = pygame.font.Font(None, 20)
-
-        # Initialize the joysticks
-        pygame.joystick.init()
-
-        self.pressed_functions = []
+        self.hud = Hud(self.screen, self.font)
 
         self.target_state = TargetState(0, 0, 0, font=self.font)
+        self.inputs = InputSampler(self.target_state, hertz=input_hertz)
+        self.inputs.open_joysticks()
         self.current_state = None
-
-        self.tunnel = Tunnel(host)
-        self.communicator = Communicator(self)
-        self.video = Video(self)
-
-        self.tunnel_thread = threading.Thread(target=self.tunnel.run)
-        self.tunnel_thread.start()
+        self.telemetry = None
+
+        # Restarts the VPN and the video decoder as soon as they exit
+        self.supervisor = Supervisor()
+        self.tunnel = Tunnel(host, self.supervisor, udp=video_transport == RTP)
+        if direct:
+            # Control straight to the remote's WiFi address, the tunnel only carries video
+            self.communicator = Communicator(self, encoding=encoding, bind_address=("", 0),
+                                             remote_address=(host, Communicator.CONTROL_PORT),
+                                             channel=ClientChannel(load_key()))
+        else:
+            self.communicator = Communicator(self, encoding=encoding)
+        self.communicator.send_state(self.target_state)
+        video = RtpVideoReceiver if video_transport == RTP else VideoReceiver
+        self.video = video(supervisor=self.supervisor)
+        # Surfaces sharing memory with the decoded frame buffers, blitting them copies nothing extra
+        self.video_surfaces = [pygame.image.frombuffer(buffer, self.video.frame_size, "RGB")
+                               for buffer in self.video.frames.buffers]
+
+        self.tunnel.start()
         self.communicator_thread = threading.Thread(target=self.communicator.run)
         self.communicator_thread.start()
-        self.video_thread = threading.Thread(target=self.video.run)
+        self.video_thread = threading.Thread(target=self.video.run, name="video")
         self.video_thread.start()
 
     def run(self):
+        render_period = 1.0 / self.RENDER_FPS
+        next_render = time.monotonic()
+        last_command = self.target_state.to_command()
         try:
             while not self.shutdown:
+                # Wake up on any input event, for held keys at the sample rate, else at the next frame
+                timeout = next_render - time.monotonic()
+                if self.inputs.timeout() is not None:
+                    timeout = min(timeout, self.inputs.timeout())
+                events = [pygame.event.wait(max(1, int(timeout * 1000)))] + pygame.event.get()
 
-                self.screen.fill((0, 0, 0))
-
-                for event in pygame.event.get():  # User did something
+                for event in events:
                     if event.type == pygame.QUIT:  # If user clicked close
                         self.shutdown = True  # Flag that we are done so we exit this loop
+                    self.inputs.handle(event)
+                self.inputs.sample()
 
-                    # Possible joystick actions: JOYAXISMOTION JOYBALLMOTION JOYBUTTONDOWN JOYBUTTONUP JOYHATMOTION
-                    if event.type == pygame.JOYBUTTONDOWN or event.type == pygame.KEYDOWN:
-                        function = FUNCTIONS.get(event.key)
-                        self.pressed_functions.append(function)
-
-                    if event.type == pygame.JOYBUTTONUP or event.type == pygame.KEYUP:
-                        try:
-                            function = FUNCTIONS.get(event.key)
-                            self.pressed_functions.remove(function)
-                        except ValueError:
-                            pass
-
-                _old_state = copy.copy(self.target_state)
-                self.target_state.execute_functions(self.pressed_functions)
-
-                self.screen.blit(self.font.render("Target State:", True, (255, 255, 255)), [10, 10])
-                self.screen.blit(self.target_state.draw(), [10, 20])
-                if _old_state != self.target_state:
-                    self.communicator.send_queue.append(self.target_state.to_data())
+                # Push the command right away instead of waiting for the next frame
+                command = self.target_state.to_command()
+                if command != last_command:
+                    self.communicator.send_command(command)
+                    last_command = command
 
-                self.screen.blit(self.font.render("Current State:", True, (255, 255, 255)), [10, 40])
-                if self.current_state:
-                    self.screen.blit(self.current_state.draw(), [10, 50])
-                else:
-                    self.screen.blit(self.font.render(" - ", True, (255, 255, 255)), [10, 50])
-
-
-                # Go ahead and update the screen with what we've drawn.
-                pygame.display.flip()
-
-                # Limit to 20 frames per second
-                self.clock.tick(20)
+                now = time.monotonic()
+                if now >= next_render:
+                    next_render = max(next_render + render_period, now)
+                    self._render()
 
         except KeyboardInterrupt:
             pass
         finally:
             self.stop()
 
+    def _render(self):
+        if self.video.stats.frames_decoded:
+            index, fresh = self.video.frames.take()
+            if fresh:
+                self.hud.set_background(self.video_surfaces[index])
+
+        self.hud.set_text("target_label", [10, 10], "Target State:")
+        self.hud.set_text("target", [10, 20], self.target_state.text())
+        self.hud.set_text("current_label", [10, 40], "Current State:")
+        self.hud.set_text("current", [10, 50], self.current_state.text() if self.current_state else " - ")
+        self.hud.set_text("link_label", [10, 70], "Link:")
+        self.hud.set_text("link", [10, 80], self.communicator.link_stats.summary())
+        self.hud.set_text("video", [10, 90], self.video.stats.summary())
+        self.hud.set_text("failsafe", [10, 100], self._failsafe_text())
+        self.hud.set_text("attitude", [10, 110], self._attitude_text())
+
+        # Only changed regions are updated, nothing at all if nothing changed
+        self.hud.draw()
+
+    def _failsafe_text(self):
+        t = self.telemetry
+        if t is None:
+            return "Failsafe: -"
+        return "Failsafe: {}  Triggers: {}  Reaction: {:.0f} ms (max {:.0f} ms)".format(
+            "ACTIVE" if t.failsafe_active else "off", t.failsafe_triggers,
+            t.failsafe_reaction * 1000, t.failsafe_max_reaction * 1000)
+
+    def _attitude_text(self):
+        t = self.telemetry
+        if t is None or t.attitude_stale:
+            return "Attitude: -"
+        return "Attitude: roll {:+.1f}  pitch {:+.1f}  yaw {:+.0f}  altitude {:.1f} m ({:+.1f} m/s)".format(
+            t.roll, t.pitch, t.yaw, t.altitude, t.vertical_speed)
+
+    def on_telemetry(self, header, telemetry):
+        self.telemetry = telemetry
+        self.current_state = State.from_telemetry(telemetry)
+
     def stop(self):
         self.shutdown = True
-        self.tunnel.shutdown = True
         self.video.shutdown = True
+        self.communicator.stop()
         print("Stopping client...")
 
-        self.tunnel_thread.join()
         self.communicator_thread.join()
         self.video_thread.join()
+        self.supervisor.stop()
+        for name, stats in self.supervisor.to_json().items():
+            if stats["starts"]:
+                print("{}: {} restarts, up {:.0f} s".format(name, stats["restarts"], stats["uptime"]))
 
-
-class Tunnel:
-    REMOTE_ADDRESS = "172.31.31.33"
-    BIND_ADDRESS = "172.31.31.34"
-    VPN_INTERFACE = "ptp-control"
-
-    def __init__(self, host):
-        self.host = host
-        self.shutdown = False
-        self.vpn = None
-
-    def run(self):
-        while not self.shutdown:
-            if self.vpn is None:
-                try:
-                    self._start_vpn()
-                except subprocess.SubprocessError:
-                    print("Error in VPN: {}".format(self.vpn.communicate()))
-
-            time.sleep(0.5)
-            self.vpn.poll()
-            if self.vpn.returncode is not None:
-                self.vpn = None
-
-        if self.vpn:
-            self.vpn.terminate()
-
-    def _start_vpn(self):
-        self.vpn = subprocess.Popen(["/usr/sbin/openvpn",
-                                 "--proto", "tcp-client",
-                                 "--dev-type", "tun",
-                                 "--dev", self.VPN_INTERFACE,
-                                 "--ifconfig", self.BIND_ADDRESS, self.REMOTE_ADDRESS,
-                                 "--remote", self.host,
-                                 "--persist-key", "--persist-tun",
-                                 "--secret", "secret.key",
-                                 "--keepalive", "2", "5"], stdout=subprocess.DEVNULL)
-
-
-class Communicator:
-    CONTROL_PORT = 8081
-
-    def __init__(self, controller):
-        self.controller = controller
-
-        self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.control_socket.settimeout(3)
-        self.send_queue = []
-
-    def run(self):
-        self._bind()
-
-        while not self.controller.shutdown:
-            time.sleep(0.01)
-            readable, writable, exceptional = select.select([self.control_socket],
-                                                            [self.control_socket],
-                                                            [self.control_socket])
-            if self.send_queue and self.control_socket in writable:
-                data = self.send_queue.pop()
-                self.control_socket.sendto(data, (self.controller.tunnel.REMOTE_ADDRESS, self.CONTROL_PORT))
-            if self.control_socket in readable:
-                data = self.control_socket.recv(1024)
-                if data:
-                    self.controller.current_state = State.from_json_data(data)
-                else:
-                    self.control_socket.close()
-                    return
-
-    def _bind(self):
-        while not self.controller.shutdown:
-            try:
-                self.control_socket.bind((self.controller.tunnel.BIND_ADDRESS, self.CONTROL_PORT))
-                break
-            except (OSError, TimeoutError, socket.timeout):
-                time.sleep(0.5)
-
-
-class Video:
-    VIDEO_PORT = 8082
-
-    def __init__(self, controller):
-        self.controller = controller
-        self.shutdown = False
-        self.stream = None
-        self.nc = None
-        self.video_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.video_socket.settimeout(3)
-
-    def run(self):
-        while not self.shutdown:
-            if self.stream is None:
-                try:
-                    self._start_stream()
-                except subprocess.SubprocessError:
-                    print("Error in Stream: {}".format(self.stream.communicate()))
-
-            time.sleep(0.5)
-            self.stream.poll()
-            if self.stream.returncode is not None:
-                self.stream = None
-
-        if self.stream:
-            self.stream.terminate()
-            self.nc.terminate()
-            print("terminated")
-        
-    def _start_stream(self):
-        self.nc = subprocess.Popen(["nc", "-l", "-p", str(self.VIDEO_PORT)], stdout=subprocess.PIPE)
-        self.stream = subprocess.Popen(["mplayer", "-fps", "200", "-demuxer", "h264es", '-'], stdin=self.nc.stdout)
-
-    def run2(self):
-        while not self.controller.shutdown:
-            try:
-                data = self.video_socket.recv(2048000)
-                if not data:
-                    raise OSError
-            except OSError:
-                time.sleep(.5)
-                self._connect()
-                continue
-
-            print('got {} bytes'.format(len(data)))
-
-            try:
-                image = Image.frombytes("RGB", (1280, 720), data)
-            except ValueError:
-                time.sleep(0.5)
-                continue
-            img = pygame.image.frombuffer(image, (1280, 720), 'RGB')
-            self.controller.screen.blit(img, (0, 0))
-            time.sleep(0.5)
-
-    def _connect(self):
-        while not self.controller.shutdown:
-            try:
-                #self.video_socket.connect((self.controller.tunnel.REMOTE_ADDRESS, self.VIDEO_PORT))
-                break
-            except (OSError, TimeoutError, socket.timeout):
-                time.sleep(0.5)
+        if self.stats_export:
+            self.communicator.link_stats.export(self.stats_export)
 
 
 if __name__ == '__main__':
-    import sys
-
-    if len(sys.argv) > 1:
-        ctrl = AirshipController(sys.argv[1])
-    else:
-        ctrl = AirshipController()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", nargs="?", default="192.168.8.100")
+    parser.add_argument("--json", action="store_true", help="Use the JSON wire format for debugging")
+    parser.add_argument("--stats-export", help="Write link latency stats to this .csv/.json file on exit")
+    parser.add_argument("--input-hertz", type=float, default=InputSampler.SAMPLE_HERTZ,
+                        help="Sample rate for held keys")
+    parser.add_argument("--video-transport", choices=[TCP, RTP], default=TCP,
+                        help="rtp: video as UDP datagrams with FEC, has to match the remote")
+    parser.add_argument("--direct", action="store_true",
+                        help="Control without the VPN, authenticated with secret.key, has to match the remote")
+    args = parser.parse_args()
+
+    ctrl = AirshipController(args.host, encoding=protocol.JSON if args.json else protocol.BINARY,
+                             stats_export=args.stats_export, input_hertz=args.input_hertz,
+                             video_transport=args.video_transport, direct=args.direct)
     ctrl.run()
+
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# Fleet mode: one ground station process for several airships. All control links run
+# on one thread (communicator.LinkLoop), each craft with its own address and ports,
+# and optionally its own tunnel. The HUD shows one line per craft, input goes to the
+# selected one (keys 1-9 or Tab), the others keep their last command. Video is
+# received for the selected craft only, and only through its tunnel: the remote streams
+# to the client's VPN address, a craft controlled directly without one has no video.
+#
+# Crafts come from a JSON file, a list of objects with the arguments of Craft, e.g.
+#   [{"name": "alpha", "host": "192.168.8.100", "direct": true},
+#    {"name": "beta", "host": "192.168.8.101", "key_file": "beta.key", "tunnel": {"interface": "ptp-beta",
+#     "bind_address": "172.31.32.34", "remote_address": "172.31.32.33", "local_port": 1195}}]
+# or from the command line as name=host[:control port], those are controlled directly.
+# A craft needs either direct or a tunnel, key_file is used for both.
+import json
+import threading
+import time
+
+import pygame
+
+from communicator import Communicator, LinkLoop
+from control import TargetState
+from hud import Hud
+from inputs import InputSampler
+from rtp import RTP, TCP
+from secure import KEY_FILE, ClientChannel, load_key
+from supervisor import Supervisor
+from tunnel import Tunnel
+from video import RtpVideoReceiver, VideoReceiver
+
+
+class Craft:
+    # Telemetry older than this shows the craft as lost
+    STALE_AFTER = 1.0
+
+    def __init__(self, fleet, name, host, control_port=Communicator.CONTROL_PORT,
+                 video_port=VideoReceiver.VIDEO_PORT, direct=False, key_file=KEY_FILE, tunnel=None):
+        self.fleet = fleet
+        self.name = name
+        self.host = host
+        self.video_port = video_port
+        self.target_state = TargetState(0, 0, 0)
+        self.telemetry = None
+        self.telemetry_time = None
+
+        if not direct and tunnel is None:
+            # Plaintext straight to the host reaches neither a VPN nor a DIRECT remote
+            raise ValueError("Craft {} needs direct or a tunnel".format(name))
+        self.tunnel = None
+        bind_address, remote_address = ("", 0), (host, control_port)
+        if tunnel is not None:
+            tunnel = dict(tunnel)
+            tunnel.setdefault("key_file", key_file)
+            self.tunnel = Tunnel(host, fleet.supervisor, udp=fleet.video_transport == RTP,
+                                 name="vpn-" + name, **tunnel)
+            if not direct:
+                bind_address = (self.tunnel.bind_address, 0)
+                remote_address = (self.tunnel.remote_address, control_port)
+        else:
+            print("Craft {} has no tunnel, no video: the remote streams through its VPN".format(name))
+        channel = ClientChannel(load_key(key_file)) if direct else None
+        self.communicator = Communicator(self, bind_address=bind_address, remote_address=remote_address,
+                                         channel=channel)
+
+    @property
+    def shutdown(self):
+        return self.fleet.shutdown
+
+    @property
+    def video_address(self):
+        # None without a tunnel, nothing would arrive
+        return None if self.tunnel is None else (self.tunnel.bind_address, self.video_port)
+
+    def on_telemetry(self, header, telemetry):
+        # On the link thread, the HUD only reads these two
+        self.telemetry = telemetry
+        self.telemetry_time = time.monotonic()
+
+    def text(self, now):
+        t = self.telemetry
+        target = self.target_state
+        line = "{:<10} T{:+4.0f} Y{:+4.0f} C{:+4.0f}".format(self.name, target.throttle, target.yaw, target.climb)
+        if t is None:
+            return line + "  no telemetry"
+        rtt = self.communicator.link_stats.rtt.percentile(50)
+        return line + "  {}  motor {:.2f}  RSSI {}  {}  RTT {} ms".format(
+            "LOST" if now - self.telemetry_time > self.STALE_AFTER else "ok  ",
+            t.motor_left, "-" if t.wifi_rssi is None else t.wifi_rssi,
+            "FAILSAFE" if t.failsafe_active else "        ",
+            "-" if rtt is None else "{:.0f}".format(rtt * 1000))
+
+
+def load_crafts(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_craft(argument):
+    # name=host[:control port], controlled directly (the remote's CONTROL_TRANSPORT = DIRECT)
+    # with secret.key, tunnels need a fleet.json
+    name, _, address = argument.partition("=")
+    host, _, port = address.partition(":")
+    craft = {"name": name, "host": host, "direct": True}
+    if port:
+        craft["control_port"] = int(port)
+    return craft
+
+
+class FleetController:
+    RENDER_FPS = 20
+    ROW_HEIGHT = 12
+    SELECT_KEYS = {getattr(pygame, "K_{}".format(i)): i - 1 for i in range(1, 10)}
+
+    def __init__(self, crafts, input_hertz=InputSampler.SAMPLE_HERTZ, video_transport=TCP):
+        self.shutdown = False
+        self.video_transport = video_transport
+
+        pygame.init()
+        pygame.display.set_caption("Fleet")
+        self.screen = pygame.display.set_mode([1280, 720])
+        self.font = pygame.font.Font(None, 20)
+        self.hud = Hud(self.screen, self.font)
+
+        # Restarts the tunnels and the video decoder as soon as they exit
+        self.supervisor = Supervisor()
+        self.crafts = [Craft(self, **craft) for craft in crafts]
+        self.selected = 0
+        self.inputs = InputSampler(self.crafts[0].target_state, hertz=input_hertz)
+        self.inputs.open_joysticks()
+        self._last_commands = {}
+
+        for craft in self.crafts:
+            if craft.tunnel is not None:
+                craft.tunnel.start()
+            craft.communicator.send_state(craft.target_state)
+            self._last_commands[craft.name] = craft.target_state.to_command()
+        self.links = LinkLoop([craft.communicator for craft in self.crafts], self)
+        self.links_thread = threading.Thread(target=self.links.run, name="fleet-links")
+        self.links_thread.start()
+
+        self.video = None
+        self.video_thread = None
+        self.video_surfaces = None
+        self._video_switch = None
+        self._start_video()
+
+    def _start_video(self):
+        address = self.crafts[self.selected].video_address
+        if address is None:
+            return
+        receiver = RtpVideoReceiver if self.video_transport == RTP else VideoReceiver
+        video = receiver(bind_address=address, supervisor=self.supervisor)
+        # Surfaces first, _render takes them once it sees the receiver
+        self.video_surfaces = [pygame.image.frombuffer(buffer, video.frame_size, "RGB")
+                               for buffer in video.frames.buffers]
+        self.video_thread = threading.Thread(target=video.run, name="video")
+        self.video = video
+        self.video_thread.start()
+
+    def _stop_video(self):
+        video, thread = self.video, self.video_thread
+        self.video = None
+        if video is not None:
+            video.shutdown = True
+            thread.join()
+
+    def _switch_video(self, previous):
+        # Off the UI thread: joining a receiver takes up to its socket timeout and the
+        # decoder's teardown. Switches run in order, each one's receiver is gone before
+        # the next binds, and only the last one starts a receiver.
+        if previous is not None:
+            previous.join()
+        self._stop_video()
+        if self._video_switch is threading.current_thread() and not self.shutdown:
+            self._start_video()
+
+    def select(self, index):
+        if index == self.selected or not 0 <= index < len(self.crafts):
+            return
+        # Held keys stay with the craft they were pressed for
+        self.inputs.pressed_functions = []
+        self.selected = index
+        self.inputs.target_state = self.crafts[index].target_state
+        if self.video is not None:
+            self.video.shutdown = True
+        self.hud.set_background(None)
+        self._video_switch = threading.Thread(target=self._switch_video, args=(self._video_switch,),
+                                              name="video-switch")
+        self._video_switch.start()
+
+    def _handle(self, event):
+        if event.type == pygame.QUIT:
+            self.shutdown = True
+        elif event.type == pygame.KEYDOWN and event.key in self.SELECT_KEYS:
+            self.select(self.SELECT_KEYS[event.key])
+            return
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_TAB:
+            self.select((self.selected + 1) % len(self.crafts))
+            return
+        self.inputs.handle(event)
+
+    def run(self):
+        render_period = 1.0 / self.RENDER_FPS
+        next_render = time.monotonic()
+        try:
+            while not self.shutdown:
+                timeout = next_render - time.monotonic()
+                if self.inputs.timeout() is not None:
+                    timeout = min(timeout, self.inputs.timeout())
+                for event in [pygame.event.wait(max(1, int(timeout * 1000)))] + pygame.event.get():
+                    self._handle(event)
+                self.inputs.sample()
+
+                craft = self.crafts[self.selected]
+                command = craft.target_state.to_command()
+                if command != self._last_commands[craft.name]:
+                    craft.communicator.send_command(command)
+                    self._last_commands[craft.name] = command
+
+                now = time.monotonic()
+                if now >= next_render:
+                    next_render = max(next_render + render_period, now)
+                    self._render(now)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def _render(self, now):
+        video = self.video
+        if video is not None and video.stats.frames_decoded:
+            index, fresh = video.frames.take()
+            if fresh:
+                self.hud.set_background(self.video_surfaces[index])
+
+        for i, craft in enumerate(self.crafts):
+            marker = ">" if i == self.selected else " "
+            self.hud.set_text(("craft", i), [10, 10 + i * self.ROW_HEIGHT],
+                              "{} {} {}".format(marker, i + 1, craft.text(now)))
+        self.hud.set_text("help", [10, 20 + len(self.crafts) * self.ROW_HEIGHT],
+                          "1-9/Tab: select craft   " + ("no video" if video is None else video.stats.summary()))
+        self.hud.draw()
+
+    def stop(self):
+        self.shutdown = True
+        if self.video is not None:
+            self.video.shutdown = True
+        # Wakes up the link loop, it checks shutdown
+        self.crafts[0].communicator.stop()
+        print("Stopping fleet...")
+
+        self.links_thread.join()
+        if self._video_switch is not None:
+            self._video_switch.join()
+        self._stop_video()
+        self.supervisor.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("crafts", nargs="+", help="JSON file with the crafts, or name=host[:control port] each")
+    parser.add_argument("--input-hertz", type=float, default=InputSampler.SAMPLE_HERTZ,
+                        help="Sample rate for held keys")
+    parser.add_argument("--video-transport", choices=[TCP, RTP], default=TCP,
+                        help="rtp: video as UDP datagrams with FEC, has to match the remotes")
+    args = parser.parse_args()
+
+    if len(args.crafts) == 1 and args.crafts[0].endswith(".json"):
+        crafts = load_crafts(args.crafts[0])
+    else:
+        crafts = [parse_craft(craft) for craft in args.crafts]
+    FleetController(crafts, input_hertz=args.input_hertz, video_transport=args.video_transport).run()
@@ -0,0 +1 @@
+../remote/h264.py
\ No newline at end of file
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# Client without a window, for scripts, test harnesses and small companion boards:
+# set_target() sends throttle/yaw/climb (-1..1), subscribe() hands every telemetry
+# packet to a callback, play() sends a scripted command sequence on a fixed grid at up
+# to some kHz. Only the control link is loaded up front. pygame is never imported,
+# the video receiver (and its frame buffers) only with video=, the VPN only when
+# the control link or the video needs it, cryptography only with direct.
+#
+#   python3 client/headless.py 192.168.8.100 --script ramp.json --hertz 200 --telemetry
+# A script is a JSON list of segments: {"duration": s, "throttle": .., "yaw": .., "climb": ..,
+# "ramp": true to go there linearly from the previous segment instead of jumping}.
+import json
+import sys
+import threading
+import time
+
+import protocol
+from communicator import Communicator
+from rtp import RTP
+from secure import KEY_FILE
+from supervisor import Supervisor
+from tunnel import Tunnel
+
+
+class Segment:
+    def __init__(self, duration, throttle=0.0, yaw=0.0, climb=0.0, ramp=False):
+        self.duration = duration
+        self.command = protocol.Command(throttle, yaw, climb)
+        self.ramp = ramp
+
+
+def load_script(path):
+    with open(path) as f:
+        return [Segment(**segment) for segment in json.load(f)]
+
+
+class HeadlessClient:
+    SCRIPT_HERTZ = 100
+
+    def __init__(self, host="192.168.8.100", encoding=protocol.BINARY, direct=False, key_file=KEY_FILE,
+                 video=None, tunnel=None, bind_address=None, remote_address=None):
+        # video: None, rtp.TCP or rtp.RTP. tunnel: None starts the VPN unless it carries
+        # nothing (direct without video), False when it is up already. The addresses
+        # override the control link's, e.g. for a remote on localhost.
+        self.shutdown = False
+        self.host = host
+        self.target = None
+        self.header = None
+        self.telemetry = None
+        self._subscribers = []
+        self._received = threading.Condition()
+
+        if tunnel is None:
+            tunnel = not direct or video is not None
+        self.supervisor = Supervisor() if tunnel or video is not None else None
+        self.tunnel = Tunnel(host, self.supervisor, udp=video == RTP) if tunnel else None
+
+        channel = None
+        if direct:
+            from secure import ClientChannel, load_key
+            channel = ClientChannel(load_key(key_file))
+            bind_address = ("", 0) if bind_address is None else bind_address
+            remote_address = (host, Communicator.CONTROL_PORT) if remote_address is None else remote_address
+        else:
+            # Over the VPN, the one already up if there is no tunnel of our own
+            local, remote = ((Tunnel.BIND_ADDRESS, Tunnel.REMOTE_ADDRESS) if self.tunnel is None
+                             else (self.tunnel.bind_address, self.tunnel.remote_address))
+            bind_address = (local, Communicator.CONTROL_PORT) if bind_address is None else bind_address
+            remote_address = (remote, Communicator.CONTROL_PORT) if remote_address is None else remote_address
+        self.communicator = Communicator(self, encoding=encoding, bind_address=bind_address,
+                                         remote_address=remote_address, channel=channel)
+        self._communicator_thread = threading.Thread(target=self.communicator.run, name="communicator")
+
+        self.video = None
+        self._video_thread = None
+        if video is not None:
+            from video import RtpVideoReceiver, VideoReceiver
+            self.video = (RtpVideoReceiver if video == RTP else VideoReceiver)(supervisor=self.supervisor)
+            self._video_thread = threading.Thread(target=self.video.run, name="video")
+
+    def start(self):
+        if self.tunnel is not None:
+            self.tunnel.start()
+        self._communicator_thread.start()
+        if self._video_thread is not None:
+            self._video_thread.start()
+
+    def stop(self):
+        # Also after a failed or missing start(), e.g. a harness cleaning up its setup
+        self.shutdown = True
+        self.communicator.stop()
+        if self._communicator_thread.ident is not None:
+            self._communicator_thread.join()
+        else:
+            # Never ran, nothing else closes its sockets
+            self.communicator.close()
+        if self.video is not None:
+            self.video.shutdown = True
+            if self._video_thread.ident is not None:
+                self._video_thread.join()
+        if self.supervisor is not None:
+            self.supervisor.stop()
+
+    def set_target(self, throttle=None, yaw=None, climb=None):
+        # Axes left out keep their value (0 before the first command), clamped to -1..1.
+        # Nothing is sent before the first call, the remote stays in its failsafe.
+        current = protocol.Command(0.0, 0.0, 0.0) if self.target is None else self.target
+        command = protocol.Command(*(old if new is None else max(-1.0, min(1.0, new))
+                                     for old, new in zip(current, (throttle, yaw, climb))))
+        self._send(command)
+        return command
+
+    def _send(self, command):
+        # The communicator keeps the latest command only, repeating one is not needed
+        if command != self.target:
+            self.target = command
+            self.communicator.send_command(command)
+
+    def subscribe(self, callback):
+        # callback(header, telemetry) runs on the communicator thread, it has to be quick.
+        # Copied on write, the thread iterates without a lock.
+        self._subscribers = self._subscribers + [callback]
+        return callback
+
+    def unsubscribe(self, callback):
+        self._subscribers = [subscriber for subscriber in self._subscribers if subscriber is not callback]
+
+    def on_telemetry(self, header, telemetry):
+        self.header, self.telemetry = header, telemetry
+        for callback in self._subscribers:
+            callback(header, telemetry)
+        with self._received:
+            self._received.notify_all()
+
+    def wait_for_telemetry(self, predicate=None, timeout=None):
+        # The latest telemetry once there is one (that predicate accepts), None on timeout
+        def ready():
+            return self.telemetry is not None and (predicate is None or predicate(self.telemetry))
+
+        with self._received:
+            if self._received.wait_for(ready, timeout):
+                return self.telemetry
+        return None
+
+    def play(self, segments, hertz=SCRIPT_HERTZ):
+        # One command every 1/hertz on a fixed grid, a late tick does not delay the
+        # following ones. Consecutive equal commands are not sent again.
+        period = 1.0 / hertz
+        start = time.monotonic()
+        ticks = late = 0
+        sent = self.communicator.stats.sent
+        begin = protocol.Command(0.0, 0.0, 0.0) if self.target is None else self.target
+        for segment in segments:
+            steps = max(1, int(round(segment.duration * hertz)))
+            for step in range(steps):
+                if self.shutdown:
+                    break
+                fraction = (step + 1) / steps if segment.ramp else 1.0
+                self._send(protocol.Command(*(a + (b - a) * fraction for a, b in zip(begin, segment.command))))
+                ticks += 1
+                delay = start + ticks * period - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    late += 1
+            begin = segment.command
+        return {"ticks": ticks,
+                "late": late,
+                "duration": time.monotonic() - start,
+                "packets": self.communicator.stats.sent - sent}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", nargs="?", default="192.168.8.100")
+    parser.add_argument("--json", action="store_true", help="Use the JSON wire format for debugging")
+    parser.add_argument("--direct", action="store_true",
+                        help="Control without the VPN, authenticated with secret.key, has to match the remote")
+    parser.add_argument("--no-tunnel", action="store_true", help="The VPN is up already, do not start it")
+    parser.add_argument("--script", help="JSON list of segments, without it only telemetry is received")
+    parser.add_argument("--hertz", type=float, default=HeadlessClient.SCRIPT_HERTZ,
+                        help="Command rate while playing the script")
+    parser.add_argument("--telemetry", action="store_true", help="Print every telemetry packet as a JSON line")
+    args = parser.parse_args()
+
+    client = HeadlessClient(args.host, encoding=protocol.JSON if args.json else protocol.BINARY,
+                            direct=args.direct, tunnel=False if args.no_tunnel else None)
+    if args.telemetry:
+        def write(header, telemetry):
+            line = {"seq": header.seq, "timestamp": header.timestamp}
+            line.update(telemetry._asdict())
+            print(json.dumps(line))
+            sys.stdout.flush()
+
+        client.subscribe(write)
+    client.start()
+    try:
+        if args.script:
+            print(json.dumps(client.play(load_script(args.script), args.hertz)), file=sys.stderr)
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.stop()
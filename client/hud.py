@@ -0,0 +1,80 @@
+import pygame
+
+
+class TextCache:
+    def __init__(self, font, color=(255, 255, 255), max_entries=512):
+        self.font = font
+        self.color = color
+        self.max_entries = max_entries
+        self._surfaces = {}
+
+    def render(self, text):
+        surface = self._surfaces.get(text)
+        if surface is None:
+            if len(self._surfaces) >= self.max_entries:
+                self._surfaces.clear()
+            surface = self.font.render(text, True, self.color)
+            self._surfaces[text] = surface
+        return surface
+
+
+# Text labels over a background (black or the video frame). Labels are only rendered
+# when their text changes, and only the screen regions of changed labels are updated.
+# draw() does nothing at all when neither a label nor the background changed.
+class Hud:
+    BACKGROUND_COLOR = (0, 0, 0)
+
+    def __init__(self, screen, font):
+        self.screen = screen
+        self.text_cache = TextCache(font)
+        self.background = None
+        self.frames_drawn = 0
+        self.frames_skipped = 0
+
+        self._labels = {}
+        self._dirty = []
+        self._full_redraw = True
+
+    def set_background(self, surface):
+        # Call whenever the background surface got new content
+        self.background = surface
+        self._full_redraw = True
+
+    def set_text(self, key, position, text):
+        label = self._labels.get(key)
+        if label is not None and label[0] == text:
+            return
+        surface = self.text_cache.render(text)
+        rect = surface.get_rect(topleft=position)
+        if label is not None:
+            self._dirty.append(label[1])
+        self._dirty.append(rect)
+        self._labels[key] = (text, rect, surface)
+
+    def _restore_background(self, rect):
+        if self.background is None:
+            self.screen.fill(self.BACKGROUND_COLOR, rect)
+        else:
+            self.screen.blit(self.background, rect, area=rect)
+
+    def draw(self):
+        if self._full_redraw:
+            self._restore_background(self.screen.get_rect())
+            for _, rect, surface in self._labels.values():
+                self.screen.blit(surface, rect)
+            pygame.display.flip()
+        elif self._dirty:
+            for rect in self._dirty:
+                self._restore_background(rect)
+            for _, rect, surface in self._labels.values():
+                if rect.collidelist(self._dirty) != -1:
+                    self.screen.blit(surface, rect)
+            pygame.display.update(self._dirty)
+        else:
+            self.frames_skipped += 1
+            return False
+
+        self._full_redraw = False
+        self._dirty = []
+        self.frames_drawn += 1
+        return True
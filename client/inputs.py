@@ -0,0 +1,101 @@
+import time
+
+import pygame
+
+FUNCTIONS = {
+    119: "throttle_more",   # w
+    115: "throttle_less",   # s
+     97: "yaw_left",        # a
+    100: "yaw_right",       # d
+    101: "climb_up",        # e
+    113: "climb_down",      # q
+    276: "yaw_left",        # ARROW_LEFT
+    275: "yaw_right",       # ARROW_RIGHT
+    273: "throttle_more",   # ARROW_UP
+    274: "throttle_less",   # ARROW_DOWN
+}
+
+JOY_BUTTONS = {
+    4: "climb_down",        # L1
+    5: "climb_up",          # R1
+}
+
+# Joystick axis -> (target state attribute, scale). Scale -1 inverts, e.g. stick forward is -1
+AXES = {
+    0: ("yaw", 1),          # left stick horizontal
+    1: ("throttle", -1),    # left stick vertical
+    4: ("climb", -1),       # right stick vertical
+}
+
+
+def shape_axis(value, deadzone, expo):
+    # Deadzone around the center, rescaled so the output still reaches +-1,
+    # then an expo curve for finer control around the center
+    magnitude = abs(value)
+    if magnitude <= deadzone:
+        return 0.0
+    magnitude = min(1.0, (magnitude - deadzone) / (1.0 - deadzone))
+    magnitude = (1 - expo) * magnitude + expo * magnitude ** 3
+    return magnitude if value > 0 else -magnitude
+
+
+# Samples keyboard and joystick independent of the render rate. Key and button events
+# change the target state as soon as they are handled; held keys ramp the state at
+# the configured sample rate. Analog axes set their target directly.
+class InputSampler:
+    SAMPLE_HERTZ = 250
+    DEADZONE = 0.08
+    EXPO = 0.3
+
+    def __init__(self, target_state, hertz=SAMPLE_HERTZ, deadzone=DEADZONE, expo=EXPO,
+                 keys=FUNCTIONS, buttons=JOY_BUTTONS, axes=AXES):
+        self.target_state = target_state
+        self.period = 1.0 / hertz
+        self.deadzone = deadzone
+        self.expo = expo
+        self.keys = keys
+        self.buttons = buttons
+        self.axes = axes
+
+        self.pressed_functions = []
+        self.joysticks = []
+        self._last_sample = time.monotonic()
+
+    def open_joysticks(self):
+        # Joysticks only send events while a Joystick object for them exists
+        pygame.joystick.init()
+        self.joysticks = [pygame.joystick.Joystick(i) for i in range(pygame.joystick.get_count())]
+
+    def timeout(self):
+        # How long to wait for events: held keys need sampling, otherwise only events matter
+        return self.period if self.pressed_functions else None
+
+    def handle(self, event):
+        if event.type == pygame.KEYDOWN:
+            self._press(self.keys.get(event.key))
+        elif event.type == pygame.KEYUP:
+            self._release(self.keys.get(event.key))
+        elif event.type == pygame.JOYBUTTONDOWN:
+            self._press(self.buttons.get(event.button))
+        elif event.type == pygame.JOYBUTTONUP:
+            self._release(self.buttons.get(event.button))
+        elif event.type == pygame.JOYAXISMOTION and event.axis in self.axes:
+            name, scale = self.axes[event.axis]
+            self.target_state.set_axis(name, scale * shape_axis(event.value, self.deadzone, self.expo) * 100)
+
+    def _press(self, function):
+        if function is not None and function not in self.pressed_functions:
+            self.pressed_functions.append(function)
+
+    def _release(self, function):
+        try:
+            self.pressed_functions.remove(function)
+        except ValueError:
+            pass
+
+    def sample(self, now=None):
+        now = time.monotonic() if now is None else now
+        # Cap dt, so a stall does not turn into a jump of the target state
+        dt = min(now - self._last_sample, 0.1)
+        self._last_sample = now
+        self.target_state.execute_functions(self.pressed_functions, dt)
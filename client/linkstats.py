@@ -0,0 +1,123 @@
+import csv
+import json
+from collections import deque
+
+# Upper bucket bounds in seconds for exported histograms, last bucket is open
+HISTOGRAM_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+
+class RollingHistogram:
+    def __init__(self, window=1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def percentile(self, percent):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+    def buckets(self):
+        counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for value in self.samples:
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+        return counts
+
+    def to_json(self):
+        return {"count": self.count,
+                "window": len(self.samples),
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+                "max": max(self.samples) if self.samples else None,
+                "buckets": self.buckets()}
+
+
+# Latency of the control link, fed by the Communicator.
+#
+# rtt:     command sent -> applied on the remote -> telemetry with its seq received,
+#          measured on the local clock only
+# latency: client timestamp of the command (the key press) -> applied on the remote,
+#          compares both wall clocks, so only meaningful with synchronized clocks
+class LinkStats:
+    SEND_HISTORY = 1024
+
+    def __init__(self, window=1000):
+        self.rtt = RollingHistogram(window)
+        self.latency = RollingHistogram(window)
+        self.telemetry_lost = 0
+        self.telemetry_reordered = 0
+        self.last_telemetry_seq = None
+        self.last_applied_seq = 0
+        self.last_applied_timestamp = 0.0
+        self._sent = [(None, 0.0)] * self.SEND_HISTORY
+
+    def command_sent(self, seq, now):
+        self._sent[seq % self.SEND_HISTORY] = (seq, now)
+
+    def sent_time(self, seq):
+        # None once it has dropped out of the history
+        sent_seq, sent_time = self._sent[seq % self.SEND_HISTORY]
+        return sent_time if sent_seq == seq else None
+
+    def telemetry_received(self, header, telemetry, now):
+        seq = header.seq
+        if seq is not None:
+            if self.last_telemetry_seq is not None:
+                delta = (seq - self.last_telemetry_seq) & 0xFFFFFFFF
+                if delta >= 0x80000000 or delta == 0:
+                    self.telemetry_reordered += 1
+                    return
+                self.telemetry_lost += delta - 1
+            self.last_telemetry_seq = seq
+
+        applied_seq = telemetry.applied_seq
+        if applied_seq and applied_seq != self.last_applied_seq:
+            self.last_applied_seq = applied_seq
+            sent_time = self.sent_time(applied_seq)
+            if sent_time is not None:
+                self.rtt.add(now - sent_time)
+            # Resends and heartbeats carry the timestamp of the original state change,
+            # only its first application counts for the latency
+            if telemetry.applied_timestamp and telemetry.applied_timestamp != self.last_applied_timestamp:
+                self.last_applied_timestamp = telemetry.applied_timestamp
+                self.latency.add(telemetry.applied_time - telemetry.applied_timestamp)
+
+    def summary(self):
+        def ms(value):
+            return "-" if value is None else "{:.1f}".format(value * 1000)
+
+        return "RTT p50/p95: {}/{} ms  Latency p50/p95: {}/{} ms  Lost: {}  Reordered: {}".format(
+            ms(self.rtt.percentile(50)), ms(self.rtt.percentile(95)),
+            ms(self.latency.percentile(50)), ms(self.latency.percentile(95)),
+            self.telemetry_lost, self.telemetry_reordered)
+
+    def to_json(self):
+        return {"rtt": self.rtt.to_json(),
+                "latency": self.latency.to_json(),
+                "telemetry_lost": self.telemetry_lost,
+                "telemetry_reordered": self.telemetry_reordered,
+                "histogram_buckets": HISTOGRAM_BUCKETS}
+
+    def export(self, path):
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["metric", "sample", "value"])
+                for name, histogram in (("rtt", self.rtt), ("latency", self.latency)):
+                    for i, value in enumerate(histogram.samples):
+                        writer.writerow([name, i, value])
+                writer.writerow(["telemetry_lost", "", self.telemetry_lost])
+                writer.writerow(["telemetry_reordered", "", self.telemetry_reordered])
+        else:
+            with open(path, "w") as f:
+                json.dump(self.to_json(), f, indent=2)
@@ -0,0 +1 @@
+../remote/metrics.py
\ No newline at end of file
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Telemetry for a logger, a second screen or an analysis tool next to the pilot's
+# station: subscribes to the remote at its own rate and with its own fields, and
+# writes one JSON line per packet. Needs the VPN (or the remote on the same network),
+# the remote only serves subscriptions without --direct.
+import json
+import select
+import socket
+import sys
+import time
+
+import protocol
+
+
+class Observer:
+    CONTROL_PORT = 8081
+    REMOTE_ADDRESS = "172.31.31.33"
+    # The remote drops subscriptions not renewed within 5 s
+    RENEW_INTERVAL = 2.0
+
+    def __init__(self, remote_address=(REMOTE_ADDRESS, CONTROL_PORT), hertz=5, fields=None, delta=False,
+                 bind_address=("", 0)):
+        self.remote_address = remote_address
+        self.hertz = hertz
+        self.mask = protocol.ALL_FIELDS if fields is None else protocol.field_mask(fields)
+        self.delta = delta
+        self.shutdown = False
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(bind_address)
+        self.codec = protocol.Codec()
+        self.decoder = protocol.FieldsDecoder()
+        self.received = 0
+        self.decode_errors = 0
+        self._seq = 0
+        self._next_renew = 0.0
+
+    def _subscribe(self, hertz):
+        self._seq += 1
+        self.socket.sendto(self.codec.encode_subscribe(self._seq, hertz, self.mask, self.delta),
+                           self.remote_address)
+
+    def poll(self, timeout):
+        # (header, telemetry) of the next packet, None if nothing (usable) arrived
+        now = time.monotonic()
+        if now >= self._next_renew:
+            self._next_renew = now + self.RENEW_INTERVAL
+            self._subscribe(self.hertz)
+        if not select.select([self.socket], [], [], min(timeout, self._next_renew - now))[0]:
+            return None
+        data = self.socket.recv(protocol.MAX_PACKET_SIZE)
+        try:
+            header, fields = protocol.decode_fields(data)
+        except protocol.ProtocolError:
+            self.decode_errors += 1
+            return None
+        self.received += 1
+        telemetry = self.decoder.update(header, fields)
+        return None if telemetry is None else (header, telemetry)
+
+    def run(self, handle):
+        try:
+            while not self.shutdown:
+                received = self.poll(0.5)
+                if received is not None:
+                    handle(*received)
+        finally:
+            self.close()
+
+    def close(self):
+        self._subscribe(0)
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", nargs="?", default=Observer.REMOTE_ADDRESS)
+    parser.add_argument("--port", type=int, default=Observer.CONTROL_PORT)
+    parser.add_argument("--hertz", type=float, default=5)
+    parser.add_argument("--fields", help="Comma separated telemetry fields, all if not given")
+    parser.add_argument("--delta", action="store_true", help="Only receive fields that changed")
+    args = parser.parse_args()
+
+    observer = Observer((args.host, args.port), args.hertz,
+                        fields=args.fields.split(",") if args.fields else None, delta=args.delta)
+
+    def write(header, telemetry):
+        line = {"seq": header.seq, "timestamp": header.timestamp}
+        line.update((name, value) for name, value in telemetry._asdict().items() if value is not None)
+        print(json.dumps(line))
+        sys.stdout.flush()
+
+    try:
+        observer.run(write)
+    except KeyboardInterrupt:
+        pass
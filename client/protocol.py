@@ -0,0 +1 @@
+../remote/protocol.py
\ No newline at end of file
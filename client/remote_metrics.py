@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Queries the remote's runtime metrics over the control channel: counters as numbers,
+# histograms as count, sum and p50/p99 bucket bounds. Needs the VPN (or the remote on
+# the same network), the remote does not answer over --direct. For all buckets use
+# the Prometheus endpoint on the remote (Remote.METRICS_ADDRESS).
+import json
+import socket
+import sys
+
+import protocol
+from metrics import decode_snapshot
+
+
+class MetricsClient:
+    CONTROL_PORT = 8081
+    REMOTE_ADDRESS = "172.31.31.33"
+    TIMEOUT = 1.0
+
+    def __init__(self, remote_address=(REMOTE_ADDRESS, CONTROL_PORT), bind_address=("", 0), timeout=TIMEOUT):
+        self.remote_address = remote_address
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(bind_address)
+        self.socket.settimeout(timeout)
+        self.codec = protocol.Codec()
+        self._seq = 0
+
+    def query(self, prefix=""):
+        # The snapshot as a dict, None if the remote did not answer in time
+        self._seq += 1
+        self.socket.sendto(self.codec.encode_metrics_request(self._seq, prefix), self.remote_address)
+        while True:
+            try:
+                data = self.socket.recv(protocol.MAX_PACKET_SIZE)
+            except socket.timeout:
+                return None
+            try:
+                header, payload = protocol.decode_metrics(data)
+            except protocol.ProtocolError:
+                continue
+            if header.seq == self._seq:
+                return decode_snapshot(payload)
+
+    def close(self):
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", nargs="?", default=MetricsClient.REMOTE_ADDRESS)
+    parser.add_argument("--port", type=int, default=MetricsClient.CONTROL_PORT)
+    parser.add_argument("--prefix", default="", help="Only metrics starting with this, e.g. control_")
+    args = parser.parse_args()
+
+    client = MetricsClient((args.host, args.port))
+    snapshot = client.query(args.prefix)
+    client.close()
+    if snapshot is None:
+        print("No answer from {}:{}".format(args.host, args.port))
+        sys.exit(1)
+    print(json.dumps(snapshot, indent=2, sort_keys=True))
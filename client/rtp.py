@@ -0,0 +1 @@
+../remote/rtp.py
\ No newline at end of file
@@ -0,0 +1 @@
+../remote/secure.py
\ No newline at end of file
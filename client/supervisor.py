@@ -0,0 +1 @@
+../remote/supervisor.py
\ No newline at end of file
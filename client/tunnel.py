@@ -0,0 +1,47 @@
+# The OpenVPN tunnel to the remote, restarted by the supervisor whenever it exits.
+# Its own module, so clients without a window (headless.py) do not import pygame.
+import subprocess
+
+from secure import KEY_FILE
+
+
+class Tunnel:
+    REMOTE_ADDRESS = "172.31.31.33"
+    BIND_ADDRESS = "172.31.31.34"
+    VPN_INTERFACE = "ptp-control"
+
+    def __init__(self, host, supervisor, udp=False, name="vpn", interface=VPN_INTERFACE,
+                 bind_address=BIND_ADDRESS, remote_address=REMOTE_ADDRESS, local_port=None, key_file=KEY_FILE):
+        self.host = host
+        self.supervisor = supervisor
+        # Over UDP when video is sent as datagrams too, the remote's VIDEO_TRANSPORT decides
+        self.udp = udp
+        # Several tunnels side by side (fleet.py) each need their own interface and
+        # addresses, and over UDP their own local port
+        self.name = name
+        self.interface = interface
+        self.bind_address = bind_address
+        self.remote_address = remote_address
+        self.local_port = local_port
+        # The OpenVPN static key, per craft in a fleet
+        self.key_file = key_file
+        self.vpn = None
+
+    def start(self):
+        self.vpn = self.supervisor.add(self.name, self._start_vpn)
+
+    def stop(self):
+        if self.vpn is not None:
+            self.vpn.stop()
+
+    def _start_vpn(self):
+        port = [] if self.local_port is None else ["--lport", str(self.local_port)]
+        return subprocess.Popen(["/usr/sbin/openvpn",
+                                 "--proto", "udp" if self.udp else "tcp-client",
+                                 "--dev-type", "tun",
+                                 "--dev", self.interface,
+                                 "--ifconfig", self.bind_address, self.remote_address,
+                                 "--remote", self.host,
+                                 "--persist-key", "--persist-tun",
+                                 "--secret", self.key_file,
+                                 "--keepalive", "2", "5"] + port, stdout=subprocess.DEVNULL)
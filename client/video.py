@@ -0,0 +1,234 @@
+import os
+import socket
+import subprocess
+import threading
+import time
+from collections import deque
+
+from h264 import NalRingBuffer
+from linkstats import RollingHistogram
+from rtp import JitterBuffer
+from supervisor import Supervisor
+
+
+class FrameBuffers:
+    # Triple buffering of decoded RGB frames: the decoder reads into the back buffer,
+    # the HUD blits the display buffer, neither ever waits for the other.
+    def __init__(self, frame_bytes):
+        self.buffers = [bytearray(frame_bytes) for _ in range(3)]
+        self._back, self._ready, self._display = 0, 1, 2
+        self._fresh = False
+        self._lock = threading.Lock()
+
+    @property
+    def back(self):
+        return self.buffers[self._back]
+
+    def publish(self):
+        with self._lock:
+            self._back, self._ready = self._ready, self._back
+            self._fresh = True
+
+    def take(self):
+        # Index of the buffer to display and whether it is a new frame
+        with self._lock:
+            fresh = self._fresh
+            if fresh:
+                self._display, self._ready = self._ready, self._display
+                self._fresh = False
+            return self._display, fresh
+
+
+class VideoStats:
+    def __init__(self):
+        self.frames_received = 0
+        self.frames_decoded = 0
+        self.frames_dropped = 0
+        self.decoder_restarts = 0
+        self.arrival_jitter = RollingHistogram(200)
+        self.decode_latency = RollingHistogram(200)
+        self._last_arrival = None
+        self._mean_interval = None
+
+    def frame_arrived(self, now):
+        self.frames_received += 1
+        if self._last_arrival is not None:
+            interval = now - self._last_arrival
+            if self._mean_interval is None:
+                self._mean_interval = interval
+            self.arrival_jitter.add(abs(interval - self._mean_interval))
+            self._mean_interval += 0.05 * (interval - self._mean_interval)
+        self._last_arrival = now
+
+    def summary(self):
+        def ms(value):
+            return "-" if value is None else "{:.1f}".format(value * 1000)
+
+        return "Frames: {}  Jitter p95: {} ms  Decode p50/p95: {}/{} ms  Dropped: {}".format(
+            self.frames_decoded, ms(self.arrival_jitter.percentile(95)),
+            ms(self.decode_latency.percentile(50)), ms(self.decode_latency.percentile(95)),
+            self.frames_dropped)
+
+    def to_json(self):
+        return {"frames_received": self.frames_received,
+                "frames_decoded": self.frames_decoded,
+                "frames_dropped": self.frames_dropped,
+                "decoder_restarts": self.decoder_restarts,
+                "arrival_jitter": self.arrival_jitter.to_json(),
+                "decode_latency": self.decode_latency.to_json()}
+
+
+# Receives the raspivid TCP stream and decodes it in one long-lived ffmpeg process.
+# Access units go into ffmpeg's stdin, raw RGB frames come back from its stdout into
+# FrameBuffers, from where the HUD blits them. If the decoder falls behind, frames
+# are dropped up to the next keyframe instead of queueing up latency. The supervisor
+# restarts ffmpeg the moment it dies, frames arriving meanwhile are dropped.
+class VideoReceiver:
+    VIDEO_PORT = 8082
+    FRAME_SIZE = (1280, 720)
+    MAX_IN_FLIGHT = 3
+    DECODER = ["ffmpeg", "-loglevel", "error", "-fflags", "nobuffer", "-flags", "low_delay",
+               "-probesize", "32", "-f", "h264", "-i", "pipe:0",
+               "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "{width}x{height}", "pipe:1"]
+
+    def __init__(self, bind_address=("", VIDEO_PORT), frame_size=FRAME_SIZE, supervisor=None):
+        self.bind_address = bind_address
+        self.frame_size = frame_size
+        self.shutdown = False
+
+        self.ring = NalRingBuffer()
+        self.frames = FrameBuffers(frame_size[0] * frame_size[1] * 3)
+        self.stats = VideoStats()
+
+        self.supervisor = Supervisor() if supervisor is None else supervisor
+        self.decoder = self.supervisor.add("decoder", self._start_decoder, autostart=False,
+                                           on_start=self._decoder_started)
+        self._in_flight = deque()
+        self._waiting_for_key = True
+
+    def run(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(self.bind_address)
+        server.listen(1)
+        server.settimeout(0.5)
+        try:
+            while not self.shutdown:
+                try:
+                    connection, _ = server.accept()
+                except socket.timeout:
+                    continue
+                with connection:
+                    connection.settimeout(0.5)
+                    self._receive(connection)
+        finally:
+            server.close()
+            self._stop_decoder()
+
+    def _receive(self, connection):
+        self.ring.reset()
+        self._waiting_for_key = True
+        while not self.shutdown:
+            try:
+                if not self.ring.receive(connection.recv_into):
+                    return
+            except socket.timeout:
+                continue
+            except OSError as e:
+                print("Error in video stream: {}".format(e))
+                return
+            for unit, key in self.ring.units():
+                self._feed(unit, key)
+
+    def _feed(self, unit, key):
+        now = time.monotonic()
+        self.stats.frame_arrived(now)
+
+        if not key and (self._waiting_for_key or len(self._in_flight) >= self.MAX_IN_FLIGHT):
+            self._waiting_for_key = True
+            self.stats.frames_dropped += 1
+            return
+        self._waiting_for_key = False
+
+        if not self.decoder.running:
+            self.decoder.start()
+        decoder = self.decoder.process
+        if decoder is None:
+            # Backing off after the decoder failed to start
+            self._waiting_for_key = True
+            self.stats.frames_dropped += 1
+            return
+        self._in_flight.append(now)
+        try:
+            fd = decoder.stdin.fileno()
+            written = 0
+            while written < len(unit):
+                written += os.write(fd, unit[written:])
+        except OSError as e:
+            # The decoder died, the supervisor is restarting it already
+            print("Error while feeding the decoder: {}".format(e))
+            self._waiting_for_key = True
+
+    def _start_decoder(self):
+        command = [arg.format(width=self.frame_size[0], height=self.frame_size[1]) for arg in self.DECODER]
+        return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+
+    def _decoder_started(self, decoder):
+        if self.decoder.stats.restarts:
+            self.stats.decoder_restarts += 1
+            # A fresh decoder cannot use the frames the old one had
+            self._waiting_for_key = True
+        self._in_flight.clear()
+        reader = threading.Thread(target=self._read_frames, args=(decoder.stdout,), name="video-decoder")
+        reader.daemon = True
+        reader.start()
+
+    def _stop_decoder(self):
+        decoder = self.decoder.process
+        if decoder is not None:
+            decoder.stdin.close()
+        self.decoder.stop()
+
+    def _read_frames(self, stdout):
+        while True:
+            view = memoryview(self.frames.back)
+            filled = 0
+            while filled < len(view):
+                size = stdout.readinto(view[filled:])
+                if not size:
+                    return
+                filled += size
+            self.frames.publish()
+            self.stats.frames_decoded += 1
+            if self._in_flight:
+                self.stats.decode_latency.add(time.monotonic() - self._in_flight.popleft())
+
+
+# Receives the stream as datagrams from the remote's RtpVideoStreamer. The jitter
+# buffer repairs single losses per FEC group and drops frames that are still missing
+# packets after its latency, so a loss never stalls the frames behind it.
+class RtpVideoReceiver(VideoReceiver):
+    RECEIVE_BUFFER = 1024 * 1024
+
+    def __init__(self, bind_address=("", VideoReceiver.VIDEO_PORT), frame_size=VideoReceiver.FRAME_SIZE,
+                 latency=JitterBuffer.LATENCY, supervisor=None):
+        super().__init__(bind_address, frame_size, supervisor)
+        self.jitter_buffer = JitterBuffer(latency)
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER)
+        sock.bind(self.bind_address)
+        # Short timeout, incomplete frames have to expire even when nothing arrives
+        sock.settimeout(0.01)
+        try:
+            while not self.shutdown:
+                try:
+                    frames = self.jitter_buffer.add(sock.recv(65536))
+                except socket.timeout:
+                    frames = self.jitter_buffer.poll()
+                for unit, key in frames:
+                    self._feed(unit, key)
+        finally:
+            sock.close()
+            self._stop_decoder()
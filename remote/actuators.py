@@ -0,0 +1,122 @@
+import time
+
+from gpiozero import PWMLED, Servo, exc
+
+# Changes smaller than this are not written, the PWM resolution is far coarser anyway
+EPSILON = 1e-6
+
+
+class ActuatorStats:
+    def __init__(self):
+        self.writes = 0
+        self.unchanged = 0
+        self.clamped = 0
+        self.slew_limited = 0
+        self.errors = 0
+        self.last_error = None
+
+    def to_json(self):
+        return dict(vars(self))
+
+
+# One output channel. update() clamps the requested value to the channel range, limits
+# how fast it may change (slew_rate in output units per second, None for unlimited)
+# and only writes it to the device if it differs from the last written value.
+class Actuator:
+    def __init__(self, name, device, minimum, maximum, slew_rate=None):
+        self.name = name
+        self.device = device
+        self.minimum = minimum
+        self.maximum = maximum
+        self.slew_rate = slew_rate
+        self.stats = ActuatorStats()
+
+        # Last value written to the device, None until the first write
+        self.value = None
+        self._last_update = None
+
+    def update(self, target, now=None):
+        now = time.monotonic() if now is None else now
+        value = min(max(target, self.minimum), self.maximum)
+        if value != target:
+            self.stats.clamped += 1
+
+        # The first write sets the initial output, there is nothing to ramp from
+        if self.slew_rate is not None and self.value is not None:
+            max_step = self.slew_rate * max(now - self._last_update, 0.0)
+            if abs(value - self.value) > max_step:
+                value = self.value + (max_step if value > self.value else -max_step)
+                self.stats.slew_limited += 1
+        self._last_update = now
+
+        if self.value is not None and abs(value - self.value) < EPSILON:
+            self.stats.unchanged += 1
+            return True
+        try:
+            self.device.value = value
+        except exc.GPIOZeroError as e:
+            self.stats.errors += 1
+            if self.stats.last_error is None:
+                print("Error writing {} to {}: {}".format(value, self.name, e))
+            self.stats.last_error = str(e)
+            return False
+        self.value = value
+        self.stats.writes += 1
+        return True
+
+    def close(self):
+        self.device.close()
+
+
+def create_pin_factory(name):
+    # None uses gpiozero's default (or GPIOZERO_PIN_FACTORY), "pigpio" gives DMA-timed
+    # PWM from the pigpio daemon instead of software PWM in a thread of this process.
+    # A factory instance is used as it is, e.g. a MockFactory per simulated remote
+    if name is not None and not isinstance(name, str):
+        return name
+    if name == "pigpio":
+        try:
+            from gpiozero.pins.pigpio import PiGPIOFactory
+            return PiGPIOFactory()
+        except (ImportError, OSError) as e:
+            print("pigpio not available, using the default pin factory: {}".format(e))
+    return None
+
+
+class Actuators:
+    MOTOR_LEFT_PIN = 22
+    SERVO_PITCH_PIN = 23
+    MOTOR_FREQUENCY = 1000
+    # ESC duty cycle per second: the full 0.1..0.2 range takes 0.4 s
+    MOTOR_SLEW_RATE = 0.25
+    SERVO_SLEW_RATE = None
+
+    def __init__(self, pin_factory=None):
+        factory = create_pin_factory(pin_factory)
+        self.motor_left = Actuator("motor_left",
+                                   PWMLED(self.MOTOR_LEFT_PIN, frequency=self.MOTOR_FREQUENCY,
+                                          pin_factory=factory),
+                                   0.0, 1.0, self.MOTOR_SLEW_RATE)
+        #self.motor_right = Actuator("motor_right", PWMLED(24, pin_factory=factory), 0.0, 1.0, self.MOTOR_SLEW_RATE)
+        self.servo_pitch = Actuator("servo_pitch", Servo(self.SERVO_PITCH_PIN, pin_factory=factory),
+                                    -1.0, 1.0, self.SERVO_SLEW_RATE)
+        self.channels = (self.motor_left, self.servo_pitch)
+
+        self.motor_left.update(0)
+        self.servo_pitch.update(0)
+
+    def write(self, state, now=None):
+        # (True if every channel was written without error, True if any output changed)
+        now = time.monotonic() if now is None else now
+        writes = sum(channel.stats.writes for channel in self.channels)
+        ok = self.motor_left.update(state.motor_left, now)
+        #ok = self.motor_right.update(state.motor_right, now) and ok
+        ok = self.servo_pitch.update(state.servo_pitch, now) and ok
+        return ok, sum(channel.stats.writes for channel in self.channels) != writes
+
+    def to_json(self):
+        return {channel.name: channel.stats.to_json() for channel in self.channels}
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
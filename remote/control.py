@@ -1,77 +1,28 @@
-import threading
+import time
 from copy import copy
 
-from gpiozero import PWMLED, exc, Servo
+from actuators import Actuators
+from failsafe import LinkMonitor
+from metrics import Registry
+from mixer import Mixer
+from protocol import Telemetry
+from recorder import RSSI_UNKNOWN
+from scheduler import LoopScheduler
 
 
 class ControlState:
-    THREE_D = False # Allow throttle unter 0?
+    # Replaced by Remote when a calibration file is present
+    MIXER = Mixer()
 
-    def __init__(self, throttle, yaw, climb):
+    def __init__(self, throttle, yaw, climb, seq=0, timestamp=0.0):
         self.throttle = throttle
         self.yaw = yaw
         self.climb = climb
+        # Sequence number and client timestamp of the command this state came from
+        self.seq = seq
+        self.timestamp = timestamp
 
-        #self._convert_to_motors_directional()
-        self._convert_to_motors()
-        self.servo_pitch = self.climb
-
-    def _convert_to_motors_directional(self):
-        backwards_scale = -1 if self.throttle < 0 else 1
-        backwards = -1 if backwards_scale and self.THREE_D else 0
-
-        left_motor = self.throttle*100 + self.yaw*100
-        right_motor = self.throttle*100 - self.yaw*100
-
-        scale_factor = 1
-
-        # Calculate scale factor
-        if abs(left_motor) > 100 or abs(right_motor) > 100:
-            # Find highest of the 2 values, since both could be above 100
-            x = max(abs(left_motor), abs(right_motor))
-
-            # Calculate scale factor
-            scale_factor = 100.0 / x
-
-        # Use scale factor, and turn values back into integers
-        left_motor = int(left_motor * scale_factor * backwards) / 100.0
-        right_motor = int(right_motor * scale_factor * backwards) / 100.0
-
-        self.motor_left = self.percentage_2d_to_pwm(left_motor if self.THREE_D else self._3d_to_2d(left_motor))
-        self.motor_right = self.percentage_2d_to_pwm(right_motor  if self.THREE_D else self._3d_to_2d(right_motor))
-
-    def _convert_to_motors(self):
-        self.motor_left = self.percentage_2d_to_pwm(self.throttle if self.THREE_D else self._3d_to_2d(self.throttle))
-        self.motor_right = self.motor_left
-
-    def _convert_to_2d(self, value):
-        return value if self.THREE_D else self._3d_to_2d(value)
-
-    @staticmethod
-    def _2d_to_3d(value):
-        return -1 + (value * 2)
-
-    @staticmethod
-    def _3d_to_2d(value):
-        return (value + 1) / 2.0
-
-    @staticmethod
-    def pwm_to_percentage(pwm):
-        perc = pwm*10 - 1
-        if perc <= 0:
-            return 0
-        if perc >= 1:
-            return 1
-        return perc
-
-    @staticmethod
-    def percentage_2d_to_pwm(percentage):
-        pwm = (percentage + 1) / 10
-        if pwm < 0.0800:
-            return 0
-        if pwm > 0.2200:
-            return 0.2200
-        return pwm
+        self.motor_left, self.motor_right, self.servo_pitch = self.MIXER.mix(throttle, yaw, climb)
 
     def to_json(self):
         return {"throttle": self.throttle,
@@ -87,47 +38,114 @@ class ControlState:
 
 class Control:
     CONTROL_LOOP_HERTZ = 50
-
-    def __init__(self, remote, sensors):
-        self._control_loop = None
-
-        self.motor_left = PWMLED(22, frequency=1000)
-        self.motor_left.value = 0
-        #self.motor_right = PWMLED(24)
-        #self.motor_right.value = 0
-
-        self.servo_pitch = Servo(23)
-        self.servo_pitch.value = 0
+    OVERRUN_POLICY = LoopScheduler.SKIP
+
+    def __init__(self, sensors, hertz=CONTROL_LOOP_HERTZ, overrun_policy=OVERRUN_POLICY, recorder=None,
+                 pin_factory=None, link_monitor=None, metrics=None, clock=time.monotonic, scheduled=True):
+        # clock and scheduled=False: a simulation (simulator.py) calls step() in its own time
+        self._control_loop = LoopScheduler(hertz, self._loop, overrun_policy=overrun_policy)
+        self.clock = clock
+        self.metrics = Registry() if metrics is None else metrics
+        self._tick_seconds = self.metrics.histogram("control_tick_seconds", "Duration of one control loop tick")
+        self._jitter_seconds = self.metrics.histogram("control_jitter_seconds",
+                                                      "How late control loop ticks started")
+        self._writes = self.metrics.counter("control_writes_total", "Ticks that changed the outputs")
+        self._failsafe_ticks = self.metrics.counter("control_failsafe_ticks_total",
+                                                    "Ticks with the link-loss failsafe engaged")
+        self.recorder = recorder
+        self.link_monitor = LinkMonitor() if link_monitor is None else link_monitor
+
+        self.actuators = Actuators(pin_factory)
 
         self.target_state = ControlState(0, 0, 0)
+        # (seq, client timestamp, apply time) of the last state written to the outputs
+        self.applied = (0, 0.0, 0.0)
 
         self.sensors = sensors
-        self.remote = remote
 
-        self._loop()
-
-    def get_state(self):
-        return {"current_state": {"motor_left": self.motor_left.value,
-                                  #"motor_right": self.motor_right.value,
-                                  "servo_pitch": self.servo_pitch.value},
-                "target_state": self.target_state.to_json()}
+        loop = self._control_loop.stats
+        self.metrics.collect("control_overruns_total", "Ticks longer than the period", lambda: loop.overruns,
+                             type="counter")
+        self.metrics.collect("control_skipped_total", "Ticks dropped after a stall", lambda: loop.skipped,
+                             type="counter")
+        self.metrics.collect("failsafe_triggers_total", "Times the link-loss failsafe engaged",
+                             lambda: self.link_monitor.stats.triggers, type="counter")
+
+        if scheduled:
+            self._control_loop.start()
+
+    def get_telemetry(self):
+        target = self.target_state
+        rssi = self.sensors.get_wifi_rssi()
+        loop = self._control_loop.stats
+        actuators = self.actuators
+        failsafe = self.link_monitor.stats
+        attitude, attitude_stale = self.sensors.get_attitude()
+        return Telemetry(actuators.motor_left.value, actuators.servo_pitch.value,
+                         target.throttle, target.yaw, target.climb,
+                         target.motor_left, target.motor_right, target.servo_pitch,
+                         rssi.value, rssi.stale,
+                         loop.ticks, loop.overruns, loop.skipped,
+                         loop.mean_jitter, loop.max_jitter, loop.max_duration,
+                         *self.applied,
+                         self.link_monitor.active, failsafe.triggers,
+                         failsafe.last_reaction, failsafe.max_reaction,
+                         *(attitude[:5] if attitude is not None else (0.0,) * 5), attitude_stale)
+
+    def get_loop_stats(self):
+        return self._control_loop.stats.to_json()
+
+    def get_actuator_stats(self):
+        return self.actuators.to_json()
+
+    def get_failsafe_stats(self):
+        return self.link_monitor.stats.to_json()
 
     def set_state(self, input):
         self.target_state = input
+        self.link_monitor.command_received(self.clock())
+
+    def step(self):
+        self._loop()
 
     def _loop(self):
-        target_state = copy(self.target_state)
-        try:
-            self.motor_left.value = target_state.motor_left
-            #self.motor_right.value = target_state.motor_right
-            self.servo_pitch.value = target_state.servo_pitch
-        except exc.OutputDeviceBadValue:
-            pass
+        start = time.perf_counter()
+        self._tick()
+        self._tick_seconds.observe(time.perf_counter() - start)
+        self._jitter_seconds.observe(self._control_loop.lateness)
 
-        self.remote.control_server.send_telemetry()
-        self._control_loop = threading.Timer(1.0 / self.CONTROL_LOOP_HERTZ, self._loop)
-        self._control_loop.start()
+    def _tick(self):
+        target_state = copy(self.target_state)
+        inputs = (target_state.throttle, target_state.yaw, target_state.climb)
+        outputs = self.link_monitor.inputs(inputs, self.clock())
+        if outputs is not inputs:
+            target_state = ControlState(*outputs, seq=target_state.seq, timestamp=target_state.timestamp)
+
+        ok, changed = self.actuators.write(target_state, self.clock())
+        if changed:
+            self._writes.inc()
+        if ok:
+            self.link_monitor.actuated(self.clock())
+            if not self.link_monitor.active:
+                self.applied = (target_state.seq, target_state.timestamp, time.time())
+
+        if self.link_monitor.active:
+            self._failsafe_ticks.inc()
+
+        if self.recorder is not None:
+            self._record(target_state)
+
+    def _record(self, target_state):
+        rssi = self.sensors.get_wifi_rssi().value
+        loop = self._control_loop.stats
+        self.recorder.record(time.time(), target_state.seq,
+                             target_state.throttle, target_state.yaw, target_state.climb,
+                             target_state.motor_left, target_state.motor_right, target_state.servo_pitch,
+                             self.actuators.motor_left.value, self.actuators.servo_pitch.value,
+                             self.link_monitor.active,
+                             RSSI_UNKNOWN if rssi is None else rssi, loop.last_jitter, loop.last_duration)
 
     def stop(self):
-        self._control_loop.cancel()
+        self._control_loop.stop()
+        self.actuators.close()
 
@@ -0,0 +1,103 @@
+import time
+
+
+class FailsafeProfile:
+    # What to do when commands stop arriving: keep the last state for hold seconds,
+    # then move throttle/yaw/climb to the failsafe values over ramp seconds.
+    # The defaults cut the motors (throttle -1 is zero thrust) and center the servo.
+    def __init__(self, hold=0.0, ramp=1.0, throttle=-1.0, yaw=0.0, climb=0.0):
+        self.hold = hold
+        self.ramp = ramp
+        self.throttle = throttle
+        self.yaw = yaw
+        self.climb = climb
+
+    def inputs(self, last, elapsed):
+        # (throttle, yaw, climb) elapsed seconds after the link was lost, last are the inputs before
+        if elapsed <= self.hold:
+            return last
+        progress = 1.0 if self.ramp <= 0 else min(1.0, (elapsed - self.hold) / self.ramp)
+        return blend(last, (self.throttle, self.yaw, self.climb), progress)
+
+
+def blend(start, end, progress):
+    return tuple(s + (e - s) * progress for s, e in zip(start, end))
+
+
+class FailsafeStats:
+    def __init__(self):
+        self.triggers = 0
+        self.recoveries = 0
+        self.last_reaction = 0.0
+        self.max_reaction = 0.0
+
+    def to_json(self):
+        return dict(vars(self))
+
+
+# Watches the time of the last valid command from inside the control loop. Once no
+# command arrived for timeout seconds, the next tick switches to the failsafe profile,
+# so the outputs react at most one loop period (plus jitter) after the deadline.
+# When commands come back, the outputs blend from the failsafe inputs to the commanded
+# ones over recovery seconds instead of jumping.
+class LinkMonitor:
+    TIMEOUT = 0.75
+    RECOVERY = 0.5
+
+    def __init__(self, profile=None, timeout=TIMEOUT, recovery=RECOVERY):
+        self.profile = FailsafeProfile() if profile is None else profile
+        self.timeout = timeout
+        self.recovery = recovery
+        self.stats = FailsafeStats()
+
+        self.last_command = None
+        # Until the first command the link counts as lost, the outputs start in failsafe
+        self.active = True
+        self._lost_at = None
+        self._lost_inputs = (self.profile.throttle, self.profile.yaw, self.profile.climb)
+        self._output = self._lost_inputs
+        self._recovering_at = None
+        self._recovery_start = None
+        self._pending_trigger = None
+
+    def command_received(self, now=None):
+        self.last_command = time.monotonic() if now is None else now
+
+    def inputs(self, target, now):
+        # (throttle, yaw, climb) to write this tick, for the commanded target inputs
+        if self.last_command is not None and now - self.last_command < self.timeout:
+            if self.active:
+                self.active = False
+                if self._lost_at is not None:
+                    self.stats.recoveries += 1
+                self._recovering_at = now
+                self._recovery_start = self._output
+            if self._recovering_at is not None:
+                progress = (now - self._recovering_at) / self.recovery if self.recovery > 0 else 1.0
+                if progress >= 1.0:
+                    self._recovering_at = None
+                else:
+                    self._output = blend(self._recovery_start, target, progress)
+                    return self._output
+            self._output = target
+            return target
+
+        if not self.active:
+            self.active = True
+            self.stats.triggers += 1
+            self._lost_at = self.last_command + self.timeout
+            self._lost_inputs = self._output
+            self._recovering_at = None
+            self._pending_trigger = self._lost_at
+        if self._lost_at is None:
+            return self._output
+        self._output = self.profile.inputs(self._lost_inputs, now - self._lost_at)
+        return self._output
+
+    def actuated(self, now):
+        # Called after the outputs were written, measures deadline to actuation
+        if self._pending_trigger is not None:
+            reaction = now - self._pending_trigger
+            self._pending_trigger = None
+            self.stats.last_reaction = reaction
+            self.stats.max_reaction = max(self.stats.max_reaction, reaction)
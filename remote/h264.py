@@ -0,0 +1,91 @@
+# Shared between remote and client (client/h264.py links here).
+
+START_CODE = b"\x00\x00\x01"
+
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+
+class NalRingBuffer:
+    # Reads the H.264 Annex-B byte stream straight into a preallocated buffer and
+    # splits it into access units without copying: units are handed out as memoryviews
+    # into the buffer and stay valid until the next receive(). Only the tail of the
+    # unfinished access unit is moved back to the front when the end is reached.
+    def __init__(self, size=4 * 1024 * 1024):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.reset()
+
+    def reset(self):
+        self.unit_start = 0     # start of the access unit in progress
+        self.scan = 0           # where the next start code search continues
+        self.end = 0            # end of the received data
+        self.unit_has_slice = False
+        self.unit_is_key = False
+
+    def receive(self, read_into):
+        # read_into is e.g. socket.recv_into or a pipe's readinto
+        if self.end == len(self.buffer):
+            self._compact()
+        size = read_into(self.view[self.end:])
+        self.end += size
+        return size
+
+    def _compact(self):
+        pending = self.end - self.unit_start
+        if pending == len(self.buffer):
+            # An access unit larger than the buffer, throw it away
+            self.reset()
+            return
+        self.view[:pending] = self.view[self.unit_start:self.end]
+        self.scan -= self.unit_start
+        self.end = pending
+        self.unit_start = 0
+
+    def units(self):
+        # Yields (access unit, is keyframe) for every access unit completed by the received data
+        while True:
+            pos = self.buffer.find(START_CODE, self.scan, self.end)
+            # The NAL header and the first slice header byte are needed to find unit boundaries
+            if pos < 0 or pos + 4 >= self.end:
+                # A start code may be cut off at the end, search its first bytes again
+                self.scan = max(self.scan, self.end - 2) if pos < 0 else pos
+                return
+
+            header = self.buffer[pos + 3]
+            nal_type = header & 0x1F
+            if nal_type in (NAL_SLICE, NAL_IDR):
+                # first_mb_in_slice == 0 is coded as a single 1 bit
+                new_unit = self.unit_has_slice and self.buffer[pos + 4] & 0x80
+            else:
+                new_unit = self.unit_has_slice and nal_type in (NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD)
+
+            if new_unit:
+                # Include the leading zero of a 4 byte start code in the next unit
+                nal_start = pos - 1 if pos > self.unit_start and self.buffer[pos - 1] == 0 else pos
+                unit, key = self.view[self.unit_start:nal_start], self.unit_is_key
+                self.unit_start = nal_start
+                self.unit_has_slice = False
+                self.unit_is_key = False
+                yield unit, key
+
+            if nal_type in (NAL_SLICE, NAL_IDR):
+                self.unit_has_slice = True
+            if nal_type in (NAL_IDR, NAL_SPS):
+                self.unit_is_key = True
+            self.scan = pos + 3
+
+    def flush(self):
+        # Hands out the access unit in progress, for sources that deliver whole frames:
+        # when the source has nothing more to read, the last unit is complete
+        if not self.unit_has_slice:
+            return None
+        unit, key = self.view[self.unit_start:self.end], self.unit_is_key
+        self.unit_start = self.scan = self.end
+        self.unit_has_slice = False
+        self.unit_is_key = False
+        return unit, key
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# Attitude and altitude from an MPU-6050 class IMU (also MPU-6500/9250) and an optional
+# BMP280 barometer on the I2C bus.
+#
+# The "imu" thread only reads the registers, at SAMPLE_HERTZ on a fixed grid, and
+# appends the raw values to a preallocated ring buffer. The "imu-filter" thread takes
+# everything new FILTER_HERTZ times per second and runs it through the complementary
+# filter as NumPy arrays, one batch instead of one Python step per sample. Telemetry
+# gets the last result, so the rate the client sees is the filter rate.
+#
+#   python3 remote/imu.py record flight.npz --seconds 30   records the sensors
+#   python3 remote/imu.py synthesize test.npz              generated motion, with the true attitude
+#   python3 remote/imu.py filter test.npz                  runs the filter over a recording
+# FakeI2cBus replays a recording register by register, for tests without hardware.
+import fcntl
+import math
+import os
+import struct
+import time
+from collections import namedtuple
+
+import numpy
+
+from metrics import Registry
+from scheduler import LoopScheduler
+
+# roll, pitch, yaw in degrees, altitude in m above where the remote started, vertical speed in m/s
+Attitude = namedtuple("Attitude", ["roll", "pitch", "yaw", "altitude", "vertical_speed", "timestamp"])
+
+I2C_SLAVE = 0x0703
+STANDARD_GRAVITY = 9.80665
+
+# Columns of the ring buffer and of recordings
+TIME, ACCEL_X, ACCEL_Y, ACCEL_Z, GYRO_X, GYRO_Y, GYRO_Z, PRESSURE = range(8)
+COLUMNS = 8
+
+
+class I2cBus:
+    # The kernel's i2c-dev interface, register reads as a write of the register address
+    # and a read. Same method names as smbus2, which can be passed instead.
+    def __init__(self, bus=1):
+        self.fd = os.open("/dev/i2c-{}".format(bus), os.O_RDWR)
+        self._address = None
+
+    def _select(self, address):
+        if address != self._address:
+            fcntl.ioctl(self.fd, I2C_SLAVE, address)
+            self._address = address
+
+    def write_byte_data(self, address, register, value):
+        self._select(address)
+        os.write(self.fd, bytes((register, value)))
+
+    def read_i2c_block_data(self, address, register, length):
+        self._select(address)
+        os.write(self.fd, bytes((register,)))
+        return os.read(self.fd, length)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Mpu6050:
+    ADDRESS = 0x68
+    # MPU-6050, -6500, -9250, -9255
+    IDENTITIES = (0x68, 0x70, 0x71, 0x73)
+
+    SMPLRT_DIV = 0x19
+    CONFIG = 0x1A
+    GYRO_CONFIG = 0x1B
+    ACCEL_CONFIG = 0x1C
+    ACCEL_XOUT_H = 0x3B
+    PWR_MGMT_1 = 0x6B
+    WHO_AM_I = 0x75
+
+    # ±4 g and ±500 °/s, 44 Hz low pass, 1 kHz internal rate
+    ACCEL_RANGE = 0x08
+    GYRO_RANGE = 0x08
+    DLPF = 0x03
+    ACCEL_SCALE = STANDARD_GRAVITY / 8192       # m/s² per LSB
+    GYRO_SCALE = math.radians(1 / 65.5)         # rad/s per LSB
+    # accel x y z, temperature, gyro x y z, big endian
+    RAW = struct.Struct(">7h")
+
+    def __init__(self, bus, address=ADDRESS):
+        self.bus = bus
+        self.address = address
+
+    def setup(self):
+        identity = self.bus.read_i2c_block_data(self.address, self.WHO_AM_I, 1)[0]
+        if identity not in self.IDENTITIES:
+            raise OSError("No MPU-6050 at 0x{:02x} (WHO_AM_I 0x{:02x})".format(self.address, identity))
+        # Wake up with the gyro's PLL as clock
+        self.bus.write_byte_data(self.address, self.PWR_MGMT_1, 0x01)
+        self.bus.write_byte_data(self.address, self.SMPLRT_DIV, 0)
+        self.bus.write_byte_data(self.address, self.CONFIG, self.DLPF)
+        self.bus.write_byte_data(self.address, self.GYRO_CONFIG, self.GYRO_RANGE)
+        self.bus.write_byte_data(self.address, self.ACCEL_CONFIG, self.ACCEL_RANGE)
+
+    def read_raw(self):
+        # One 14 byte burst, so all axes are from the same sample
+        ax, ay, az, _, gx, gy, gz = self.RAW.unpack(
+            bytes(self.bus.read_i2c_block_data(self.address, self.ACCEL_XOUT_H, self.RAW.size)))
+        return ax, ay, az, gx, gy, gz
+
+
+class Bmp280:
+    ADDRESS = 0x76
+    IDENTITY = 0x58
+
+    CALIBRATION = 0x88
+    ID = 0xD0
+    CTRL_MEAS = 0xF4
+    CONFIG = 0xF5
+    PRESS_MSB = 0xF7
+
+    # Temperature x2 and pressure x16 oversampling, normal mode, IIR filter x16
+    MEASUREMENT = 0x57
+    FILTER = 0x10
+    # T1 T2 T3 P1 ... P9
+    TRIMMING = struct.Struct("<HhhHhhhhhhhh")
+
+    def __init__(self, bus, address=ADDRESS):
+        self.bus = bus
+        self.address = address
+        self.trimming = None
+
+    def setup(self):
+        identity = self.bus.read_i2c_block_data(self.address, self.ID, 1)[0]
+        if identity != self.IDENTITY:
+            raise OSError("No BMP280 at 0x{:02x} (ID 0x{:02x})".format(self.address, identity))
+        self.trimming = self.TRIMMING.unpack(
+            bytes(self.bus.read_i2c_block_data(self.address, self.CALIBRATION, self.TRIMMING.size)))
+        self.bus.write_byte_data(self.address, self.CONFIG, self.FILTER)
+        self.bus.write_byte_data(self.address, self.CTRL_MEAS, self.MEASUREMENT)
+
+    def read_pressure(self):
+        # Pa, the datasheet's floating point compensation
+        data = self.bus.read_i2c_block_data(self.address, self.PRESS_MSB, 6)
+        adc_p = data[0] << 12 | data[1] << 4 | data[2] >> 4
+        adc_t = data[3] << 12 | data[4] << 4 | data[5] >> 4
+        t1, t2, t3, p1, p2, p3, p4, p5, p6, p7, p8, p9 = self.trimming
+
+        t_fine = (adc_t / 16384.0 - t1 / 1024.0) * t2 + (adc_t / 131072.0 - t1 / 8192.0) ** 2 * t3
+        var1 = t_fine / 2.0 - 64000.0
+        var2 = var1 * var1 * p6 / 32768.0 + var1 * p5 * 2.0
+        var2 = var2 / 4.0 + p4 * 65536.0
+        var1 = (p3 * var1 * var1 / 524288.0 + p2 * var1) / 524288.0
+        var1 = (1.0 + var1 / 32768.0) * p1
+        if var1 == 0:
+            raise OSError("BMP280 not calibrated")
+        pressure = (1048576.0 - adc_p - var2 / 4096.0) * 6250.0 / var1
+        return pressure + (p9 * pressure * pressure / 2147483648.0 + pressure * p8 / 32768.0 + p7) / 16.0
+
+
+# Single producer (the imu thread), single consumer (the filter thread), no lock: the
+# producer bumps written after the row is complete, and the consumer drops whatever
+# the producer overwrote while it was copying.
+class SampleRing:
+    def __init__(self, capacity, columns=COLUMNS):
+        self.capacity = capacity
+        self.data = numpy.zeros((capacity, columns))
+        self.written = 0
+        self.taken = 0
+        self.overruns = 0
+
+    def append(self, row):
+        self.data[self.written % self.capacity] = row
+        self.written += 1
+
+    def take(self):
+        # Copy of all rows since the last take, oldest first
+        written = self.written
+        start = max(self.taken, written - self.capacity)
+        lost = start - self.taken
+        batch = self.data[numpy.arange(start, written) % self.capacity]
+        lapped = self.written - self.capacity - start
+        if lapped > 0:
+            batch = batch[lapped:]
+            lost += lapped
+        self.taken = written
+        self.overruns += lost
+        return batch
+
+
+def _recursive(initial, factor, inputs):
+    # y[k] = factor * y[k - 1] + inputs[k] for the whole batch at once:
+    # y[k] = factor^(k+1) * (initial + sum(inputs[j] / factor^(j+1) for j <= k)).
+    # In chunks, so factor^-n stays far away from overflowing
+    out = numpy.empty(len(inputs))
+    for start in range(0, len(inputs), 256):
+        chunk = inputs[start:start + 256]
+        powers = factor ** numpy.arange(1, len(chunk) + 1)
+        out[start:start + len(chunk)] = powers * (initial + numpy.cumsum(chunk / powers))
+        initial = out[start + len(chunk) - 1]
+    return out
+
+
+def pressure_altitude(pressure, reference):
+    # International barometric formula, m above the reference pressure
+    return 44330.0 * (1.0 - (pressure / reference) ** (1 / 5.255))
+
+
+# Gyro integrated for the short term, pulled towards the gravity vector from the
+# accelerometer for the long term: angle = a * (angle + rate * dt) + (1 - a) * accel_angle
+# with a = tau / (tau + dt). Body rates are taken as Euler rates, fine for an airship
+# that stays within some ten degrees of level. Yaw is the integrated gyro only, there
+# is no magnetometer. Altitude is the low passed barometric altitude.
+class ComplementaryFilter:
+    TIME_CONSTANT = 0.5
+    ALTITUDE_TIME_CONSTANT = 1.0
+
+    def __init__(self, hertz, time_constant=TIME_CONSTANT, altitude_time_constant=ALTITUDE_TIME_CONSTANT,
+                 accel_scale=Mpu6050.ACCEL_SCALE, gyro_scale=Mpu6050.GYRO_SCALE):
+        dt = 1.0 / hertz
+        self.factor = time_constant / (time_constant + dt)
+        self.altitude_time_constant = altitude_time_constant
+        self.accel_scale = accel_scale
+        self.gyro_scale = gyro_scale
+
+        self.roll = self.pitch = self.yaw = None
+        self.altitude = 0.0
+        self.vertical_speed = 0.0
+        self.reference_pressure = None
+        self._last_time = None
+        self._last_pressure_time = None
+
+    def update(self, batch):
+        times = batch[:, TIME]
+        accel = batch[:, ACCEL_X:ACCEL_Z + 1] * self.accel_scale
+        gyro = batch[:, GYRO_X:GYRO_Z + 1] * self.gyro_scale
+        ax, ay, az = accel[:, 0], accel[:, 1], accel[:, 2]
+        accel_roll = numpy.arctan2(ay, az)
+        accel_pitch = numpy.arctan2(-ax, numpy.hypot(ay, az))
+
+        if self.roll is None:
+            self.roll, self.pitch, self.yaw = accel_roll[0], accel_pitch[0], 0.0
+            self._last_time = times[0]
+        dt = numpy.diff(times, prepend=self._last_time)
+        self._last_time = times[-1]
+
+        a = self.factor
+        self.roll = _recursive(self.roll, a, a * gyro[:, 0] * dt + (1 - a) * accel_roll)[-1]
+        self.pitch = _recursive(self.pitch, a, a * gyro[:, 1] * dt + (1 - a) * accel_pitch)[-1]
+        self.yaw = math.remainder(self.yaw + numpy.dot(gyro[:, 2], dt), 2 * math.pi)
+
+        pressure = batch[:, PRESSURE]
+        measured = ~numpy.isnan(pressure)
+        if measured.any():
+            pressure, pressure_times = pressure[measured], times[measured]
+            if self.reference_pressure is None:
+                self.reference_pressure = pressure[0]
+                self._last_pressure_time = pressure_times[0]
+            altitudes = pressure_altitude(pressure, self.reference_pressure)
+            pressure_dt = numpy.diff(pressure_times, prepend=self._last_pressure_time)
+            span = pressure_times[-1] - self._last_pressure_time
+            # Mean interval for the factor, barometer reads are evenly spread anyway
+            factor = self.altitude_time_constant / (self.altitude_time_constant + pressure_dt.mean())
+            altitude = _recursive(self.altitude, factor, (1 - factor) * altitudes)[-1]
+            if span > 0:
+                self.vertical_speed = (altitude - self.altitude) / span
+            self.altitude = altitude
+            self._last_pressure_time = pressure_times[-1]
+
+        return Attitude(math.degrees(self.roll), math.degrees(self.pitch), math.degrees(self.yaw),
+                        float(self.altitude), float(self.vertical_speed), float(times[-1]))
+
+
+class ImuStats:
+    def __init__(self):
+        self.samples = 0
+        self.read_errors = 0
+        self.batches = 0
+        self.filter_time = 0.0
+        self.max_filter_time = 0.0
+
+    def to_json(self):
+        return {"samples": self.samples,
+                "read_errors": self.read_errors,
+                "batches": self.batches,
+                "mean_filter_time": self.filter_time / self.batches if self.batches else 0.0,
+                "max_filter_time": self.max_filter_time}
+
+
+class Imu:
+    SAMPLE_HERTZ = 500
+    FILTER_HERTZ = 50
+    # Every this many samples one barometer read, the BMP280 does not update faster
+    BAROMETER_DIVISOR = 20
+    RING_SECONDS = 2.0
+    # Attitude older than this is reported as stale
+    MAX_AGE = 0.5
+
+    def __init__(self, bus, hertz=SAMPLE_HERTZ, filter_hertz=FILTER_HERTZ, barometer=True, metrics=None,
+                 clock=time.monotonic):
+        # With another clock (simulator.py) the caller runs _sample() and update() itself
+        self.bus = bus
+        self.clock = clock
+        self.hertz = hertz
+        self.stats = ImuStats()
+        self.mpu = Mpu6050(bus)
+        self.mpu.setup()
+        self.barometer = None
+        if barometer:
+            try:
+                self.barometer = Bmp280(bus)
+                self.barometer.setup()
+            except OSError as e:
+                print("No barometer, no altitude: {}".format(e))
+                self.barometer = None
+
+        self.ring = SampleRing(int(hertz * self.RING_SECONDS))
+        self.filter = ComplementaryFilter(hertz)
+        self._attitude = None
+        self._sampler = LoopScheduler(hertz, self._sample, name="imu")
+        self._filterer = LoopScheduler(filter_hertz, self.update, name="imu-filter")
+        self._add_metrics(Registry() if metrics is None else metrics)
+
+    def _add_metrics(self, metrics):
+        stats, ring = self.stats, self.ring
+        metrics.collect("imu_samples_total", "IMU samples read", lambda: stats.samples, type="counter")
+        metrics.collect("imu_read_errors_total", "Failed IMU reads", lambda: stats.read_errors, type="counter")
+        metrics.collect("imu_overruns_total", "Samples overwritten before the filter took them",
+                        lambda: ring.overruns, type="counter")
+        metrics.collect("imu_sampler_overruns_total", "IMU reads longer than the sample period",
+                        lambda: self._sampler.stats.overruns, type="counter")
+        self._filter_seconds = metrics.histogram("imu_filter_seconds", "Filtering one batch of IMU samples")
+
+    def start(self):
+        self._sampler.start()
+        self._filterer.start()
+
+    def stop(self):
+        self._sampler.stop()
+        self._filterer.stop()
+
+    def _sample(self):
+        try:
+            values = self.mpu.read_raw()
+            pressure = math.nan
+            if self.barometer is not None and self.stats.samples % self.BAROMETER_DIVISOR == 0:
+                pressure = self.barometer.read_pressure()
+        except OSError as e:
+            self.stats.read_errors += 1
+            if self.stats.read_errors == 1:
+                print("Error while reading the IMU: {}".format(e))
+            return
+        self.ring.append((self.clock(),) + values + (pressure,))
+        self.stats.samples += 1
+
+    def update(self):
+        batch = self.ring.take()
+        if not len(batch):
+            return
+        start = time.perf_counter()
+        self._attitude = self.filter.update(batch)
+        duration = time.perf_counter() - start
+        self.stats.batches += 1
+        self.stats.filter_time += duration
+        self.stats.max_filter_time = max(self.stats.max_filter_time, duration)
+        self._filter_seconds.observe(duration)
+
+    def latest(self):
+        # (attitude, stale), attitude None before the first batch
+        attitude = self._attitude
+        return attitude, attitude is None or self.clock() - attitude.timestamp > self.MAX_AGE
+
+
+# Replays a recording (see load_recording) through the MPU-6050 and BMP280 registers,
+# one sample per burst read of the accelerometer, so the real drivers, the ring and
+# the filter run unchanged. The barometer's trimming values are chosen so that the
+# compensation is linear in the raw value, which makes encoding a pressure exact.
+class FakeI2cBus:
+    TRIMMING = (27504, 26435, 0, 60000, 0, 0, 0, 0, 0, 0, 0, 0)
+
+    def __init__(self, recording, loop=True, barometer=True):
+        self.raw = numpy.rint(recording["raw"]).astype(int)
+        self.pressure = recording.get("pressure")
+        self.loop = loop
+        self.barometer = barometer and self.pressure is not None
+        self.index = 0
+        self.reads = 0
+
+    def write_byte_data(self, address, register, value):
+        if address not in self._devices():
+            raise OSError("No device at 0x{:02x}".format(address))
+
+    def _devices(self):
+        return (Mpu6050.ADDRESS, Bmp280.ADDRESS) if self.barometer else (Mpu6050.ADDRESS,)
+
+    def read_i2c_block_data(self, address, register, length):
+        if address not in self._devices():
+            raise OSError("No device at 0x{:02x}".format(address))
+        self.reads += 1
+        if address == Mpu6050.ADDRESS:
+            if register == Mpu6050.WHO_AM_I:
+                return bytes((0x68,))
+            ax, ay, az, gx, gy, gz = self._next_sample()
+            return Mpu6050.RAW.pack(ax, ay, az, 0, gx, gy, gz)
+        if register == Bmp280.ID:
+            return bytes((Bmp280.IDENTITY,))
+        if register == Bmp280.CALIBRATION:
+            return Bmp280.TRIMMING.pack(*self.TRIMMING)
+        pressure = self._pressure()
+        adc_p = int(round(1048576.0 - pressure * self.TRIMMING[3] / 6250.0))
+        adc_t = 519888
+        return bytes((adc_p >> 12 & 0xFF, adc_p >> 4 & 0xFF, (adc_p & 0x0F) << 4,
+                      adc_t >> 12 & 0xFF, adc_t >> 4 & 0xFF, (adc_t & 0x0F) << 4))
+
+    def _next_sample(self):
+        # Raw accel and gyro register values
+        if self.index >= len(self.raw):
+            if not self.loop:
+                raise OSError("End of recording")
+            self.index = 0
+        sample = self.raw[self.index]
+        self.index += 1
+        return sample
+
+    def _pressure(self):
+        # The pressure of the sample read last
+        return self.pressure[max(0, self.index - 1) % len(self.pressure)]
+
+    def close(self):
+        pass
+
+
+def load_recording(path):
+    # raw: (n, 6) accel and gyro register values, hertz, optionally pressure (n,) in
+    # Pa and the true attitude (n, 3: roll, pitch, yaw in rad) and altitude (n,)
+    with numpy.load(path) as recording:
+        return {name: recording[name] for name in recording.files}
+
+
+def record(bus, path, seconds, hertz):
+    mpu = Mpu6050(bus)
+    mpu.setup()
+    barometer = Bmp280(bus)
+    try:
+        barometer.setup()
+    except OSError:
+        barometer = None
+    count = int(seconds * hertz)
+    raw = numpy.zeros((count, 6))
+    pressure = numpy.zeros(count)
+    deadline = time.monotonic()
+    for i in range(count):
+        raw[i] = mpu.read_raw()
+        pressure[i] = barometer.read_pressure() if barometer is not None else math.nan
+        deadline += 1.0 / hertz
+        time.sleep(max(0.0, deadline - time.monotonic()))
+    recording = {"raw": raw, "hertz": hertz}
+    if barometer is not None:
+        recording["pressure"] = pressure
+    numpy.savez(path, **recording)
+
+
+def synthesize(seconds, hertz, noise=True, seed=1):
+    # Slow rolling and pitching within ±10°, a yaw turn, a climb to 5 m and back, with
+    # sensor noise and a gyro bias like a real MPU-6050 at rest
+    rng = numpy.random.default_rng(seed)
+    t = numpy.arange(int(seconds * hertz)) / hertz
+    roll = math.radians(10) * numpy.sin(2 * math.pi * 0.2 * t)
+    pitch = math.radians(6) * numpy.sin(2 * math.pi * 0.13 * t + 1.0)
+    yaw = math.radians(90) * (1 - numpy.cos(2 * math.pi * 0.05 * t)) / 2
+    altitude = 5.0 * (1 - numpy.cos(2 * math.pi * t / seconds)) / 2
+
+    gyro = numpy.stack([numpy.gradient(angle, t) for angle in (roll, pitch, yaw)], axis=1)
+    gravity = STANDARD_GRAVITY * numpy.stack([-numpy.sin(pitch),
+                                              numpy.cos(pitch) * numpy.sin(roll),
+                                              numpy.cos(pitch) * numpy.cos(roll)], axis=1)
+    pressure = 101325.0 * (1 - altitude / 44330.0) ** 5.255
+    if noise:
+        gravity += rng.normal(0, 0.3, gravity.shape)
+        gyro += rng.normal(0, math.radians(0.5), gyro.shape) + math.radians(0.3)
+        pressure += rng.normal(0, 1.5, pressure.shape)
+    raw = numpy.hstack([gravity / Mpu6050.ACCEL_SCALE, gyro / Mpu6050.GYRO_SCALE])
+    return {"raw": numpy.clip(numpy.rint(raw), -32768, 32767), "hertz": hertz, "pressure": pressure,
+            "attitude": numpy.stack([roll, pitch, yaw], axis=1), "altitude": altitude}
+
+
+def as_batch(recording, start_time=0.0):
+    # A recording as ring buffer rows, timed at its nominal rate
+    raw = recording["raw"]
+    batch = numpy.full((len(raw), COLUMNS), math.nan)
+    batch[:, TIME] = start_time + numpy.arange(len(raw)) / float(recording["hertz"])
+    batch[:, ACCEL_X:GYRO_Z + 1] = raw
+    if "pressure" in recording:
+        # Every BAROMETER_DIVISOR-th sample, like Imu does
+        batch[::Imu.BAROMETER_DIVISOR, PRESSURE] = recording["pressure"][::Imu.BAROMETER_DIVISOR]
+    return batch
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["record", "synthesize", "filter"])
+    parser.add_argument("path")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--hertz", type=float, default=Imu.SAMPLE_HERTZ)
+    parser.add_argument("--bus", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        record(I2cBus(args.bus), args.path, args.seconds, args.hertz)
+    elif args.mode == "synthesize":
+        numpy.savez(args.path, **synthesize(args.seconds, args.hertz))
+    else:
+        recording = load_recording(args.path)
+        batch = as_batch(recording)
+        filter_ = ComplementaryFilter(float(recording["hertz"]))
+        step = int(float(recording["hertz"]) / Imu.FILTER_HERTZ)
+        for start in range(0, len(batch), step):
+            attitude = filter_.update(batch[start:start + step])
+            print("{:8.3f}  roll {:6.1f}  pitch {:6.1f}  yaw {:6.1f}  altitude {:6.2f} m  {:+5.2f} m/s".format(
+                attitude.timestamp, *attitude[:5]))
@@ -0,0 +1,234 @@
+# Shared between remote and client (client/metrics.py links here).
+#
+# Runtime metrics of the remote: counters, fixed-bucket histograms and collectors read
+# on a scrape, served in the Prometheus text format and as JSON over the control channel.
+import bisect
+import json
+import os
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from 10 µs to 1 s: ticks, packet handling and sends
+TIMING_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+# No locks anywhere: every counter and histogram has exactly one writer thread (the
+# control loop, the server's event loop, the video thread), and a scrape only reads.
+# A scrape may see a histogram's count one observation ahead of its sum, nothing worse.
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=TIMING_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        # The last one counts everything above the largest bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        # Upper bound of the bucket the quantile falls into, inf above the largest
+        counts = list(self.counts)
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.bounds + (float("inf"),), counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return None
+
+
+# Values that are already counted somewhere (ServerStats, the supervisor, ...) are
+# not counted twice: read() is called on a scrape. It returns a number, or a dict of
+# label value -> number for the label.
+class Collector:
+    def __init__(self, name, help, read, type="gauge", label=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.type = type
+        self.label = label
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self, namespace="airship"):
+        self.namespace = namespace
+        self.metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric {} registered twice".format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def histogram(self, name, help, buckets=TIMING_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def collect(self, name, help, read, type="gauge", label=None):
+        return self._add(Collector(name, help, read, type, label))
+
+    def _read(self, collector):
+        try:
+            return collector.read()
+        except Exception as e:
+            # A broken collector must not break the scrape, nor the control channel
+            print("Error while reading metric {}: {}".format(collector.name, e))
+            return None
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in list(self.metrics.values()):
+            name = "{}_{}".format(self.namespace, metric.name)
+            if isinstance(metric, Histogram):
+                type_ = "histogram"
+            elif isinstance(metric, Counter):
+                type_ = "counter"
+            else:
+                type_ = metric.type
+            lines.append("# HELP {} {}".format(name, metric.help))
+            lines.append("# TYPE {} {}".format(name, type_))
+
+            if isinstance(metric, Histogram):
+                counts = list(metric.counts)
+                cumulative = 0
+                for bound, count in zip(metric.bounds + (float("inf"),), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(name, _format_value(bound), cumulative))
+                lines.append("{}_sum {}".format(name, _format_value(metric.sum)))
+                lines.append("{}_count {}".format(name, cumulative))
+            elif isinstance(metric, Counter):
+                lines.append("{} {}".format(name, _format_value(metric.value)))
+            else:
+                value = self._read(metric)
+                if isinstance(value, dict):
+                    for label, labelled in value.items():
+                        label = str(label).replace("\\", "\\\\").replace('"', '\\"')
+                        lines.append('{}{{{}="{}"}} {}'.format(name, metric.label, label, _format_value(labelled)))
+                else:
+                    lines.append("{} {}".format(name, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def to_json(self, prefix=""):
+        # Compact enough for one datagram: histograms as count, sum and p50/p99
+        result = {}
+        for metric in list(self.metrics.values()):
+            if not metric.name.startswith(prefix):
+                continue
+            if isinstance(metric, Histogram):
+                result[metric.name] = {"count": metric.count,
+                                       "sum": metric.sum,
+                                       "p50": metric.quantile(0.5),
+                                       "p99": metric.quantile(0.99)}
+            elif isinstance(metric, Counter):
+                result[metric.name] = metric.value
+            else:
+                result[metric.name] = self._read(metric)
+        return result
+
+
+def encode_snapshot(registry, prefix, limit):
+    # zlib compressed JSON for the control channel, an error instead if it does not fit
+    payload = zlib.compress(bytes(json.dumps(registry.to_json(prefix), separators=(",", ":")), "utf-8"))
+    if len(payload) > limit:
+        payload = zlib.compress(bytes(json.dumps({"error": "{} bytes, ask for a narrower prefix".format(
+            len(payload))}), "utf-8"))
+    return payload
+
+
+def decode_snapshot(payload):
+    return json.loads(str(zlib.decompress(payload), "utf-8"))
+
+
+def thread_cpu_seconds():
+    # CPU time of every live thread by name, from the per-thread clocks
+    cpu = {}
+    for thread in threading.enumerate():
+        try:
+            clock = time.pthread_getcpuclockid(thread.ident)
+            cpu[thread.name] = cpu.get(thread.name, 0.0) + time.clock_gettime(clock)
+        except (OSError, TypeError):
+            # Thread ended in between, or never started
+            pass
+    return cpu
+
+
+def resident_memory_bytes(path="/proc/self/statm"):
+    with open(path) as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def add_process_metrics(registry):
+    registry.collect("process_cpu_seconds_total", "CPU time of the whole process", time.process_time,
+                     type="counter")
+    registry.collect("thread_cpu_seconds_total", "CPU time per thread", thread_cpu_seconds,
+                     type="counter", label="thread")
+    registry.collect("process_resident_memory_bytes", "Resident set size", resident_memory_bytes)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = bytes(self.server.registry.render(), "utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # One line per scrape would drown everything else
+        pass
+
+
+# Serves the registry for Prometheus (or curl) on its own thread, on localhost by
+# default: a scraper on the pi itself, or through ssh over the VPN.
+class MetricsServer:
+    def __init__(self, registry, address=("127.0.0.1", 9108)):
+        self.httpd = ThreadingHTTPServer(address, MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry
+        self.address = self.httpd.server_address
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="metrics")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import json
+import sys
+
+import numpy
+
+MOTOR_LEFT = "motor_left"
+MOTOR_RIGHT = "motor_right"
+SERVO_PITCH = "servo_pitch"
+CHANNELS = (MOTOR_LEFT, MOTOR_RIGHT, SERVO_PITCH)
+
+
+class ChannelCalibration:
+    # Maps a channel demand to the output value written to the device.
+    # Unidirectional channels (ESCs) take a demand of 0..1, bidirectional ones (servos,
+    # 3D ESCs) -1..1. Demands within the deadband give the neutral output, the rest is
+    # shaped by curve (an exponent, 1 is linear) between the endpoints.
+    def __init__(self, min_output, max_output, deadband=0.0, curve=1.0, bidirectional=False, trim=0.0):
+        self.min_output = min_output
+        self.max_output = max_output
+        self.deadband = deadband
+        self.curve = curve
+        self.bidirectional = bidirectional
+        self.trim = trim
+
+    @staticmethod
+    def from_json(data):
+        return ChannelCalibration(**data)
+
+    def to_json(self):
+        return dict(vars(self))
+
+    def evaluate(self, demand):
+        demand = numpy.clip(numpy.asarray(demand, dtype=float), -1.0, 1.0)
+        magnitude = numpy.abs(demand) if self.bidirectional else numpy.clip(demand, 0.0, 1.0)
+        active = magnitude > self.deadband
+        shaped = numpy.where(active, (magnitude - self.deadband) / (1.0 - self.deadband), 0.0) ** self.curve
+
+        if self.bidirectional:
+            center = (self.min_output + self.max_output) / 2.0 + self.trim
+            half_range = numpy.where(demand < 0, center - self.min_output, self.max_output - center)
+            output = center + numpy.sign(demand) * shaped * half_range
+        else:
+            output = self.min_output + shaped * (self.max_output - self.min_output)
+        return numpy.clip(output, min(self.min_output, self.max_output), max(self.min_output, self.max_output))
+
+
+# Same outputs as the former hard-coded conversion: ESC duty 0.1..0.2, servo -1..1
+DEFAULT_CALIBRATION = {
+    MOTOR_LEFT: ChannelCalibration(0.1, 0.2),
+    MOTOR_RIGHT: ChannelCalibration(0.1, 0.2),
+    SERVO_PITCH: ChannelCalibration(-1.0, 1.0, bidirectional=True),
+}
+
+
+# Turns throttle/yaw/climb into device outputs. The calibration curves are compiled
+# once into lookup tables, so mix() costs some arithmetic and one interpolated table
+# lookup per channel. mix_batch() evaluates whole NumPy arrays of inputs at once.
+class Mixer:
+    TABLE_SIZE = 2049
+
+    def __init__(self, calibration=None, yaw_mix=0.0, three_d=False):
+        # yaw_mix: share of yaw applied as differential thrust, 0 keeps both motors equal
+        # three_d: throttle below 0 reverses the motors instead of being the lower half of the range
+        self.calibration = dict(DEFAULT_CALIBRATION if calibration is None else calibration)
+        self.yaw_mix = yaw_mix
+        self.three_d = three_d
+
+        self._grid = numpy.linspace(-1.0, 1.0, self.TABLE_SIZE)
+        self._tables = {channel: self.calibration[channel].evaluate(self._grid) for channel in CHANNELS}
+        # Plain lists are faster than NumPy for single lookups
+        self._lists = {channel: table.tolist() for channel, table in self._tables.items()}
+        self._scale = (self.TABLE_SIZE - 1) / 2.0
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            data = json.load(f)
+        calibration = {channel: ChannelCalibration.from_json(data["channels"][channel]) for channel in CHANNELS}
+        return Mixer(calibration, yaw_mix=data.get("yaw_mix", 0.0), three_d=data.get("three_d", False))
+
+    def to_json(self):
+        return {"yaw_mix": self.yaw_mix,
+                "three_d": self.three_d,
+                "channels": {channel: self.calibration[channel].to_json() for channel in CHANNELS}}
+
+    def _lookup(self, table, demand):
+        position = (min(max(demand, -1.0), 1.0) + 1.0) * self._scale
+        index = min(int(position), self.TABLE_SIZE - 2)
+        low = table[index]
+        return low + (table[index + 1] - low) * (position - index)
+
+    def motor_demands(self, throttle, yaw):
+        if not self.three_d:
+            throttle = (throttle + 1) / 2.0
+        left = throttle + yaw * self.yaw_mix
+        right = throttle - yaw * self.yaw_mix
+        # Scale both down together, so the yaw ratio is kept at full throttle
+        peak = max(abs(left), abs(right))
+        if peak > 1.0:
+            left /= peak
+            right /= peak
+        return left, right
+
+    def mix(self, throttle, yaw, climb):
+        left, right = self.motor_demands(throttle, yaw)
+        return (self._lookup(self._lists[MOTOR_LEFT], left),
+                self._lookup(self._lists[MOTOR_RIGHT], right),
+                self._lookup(self._lists[SERVO_PITCH], climb))
+
+    def mix_batch(self, throttle, yaw, climb):
+        throttle = numpy.asarray(throttle, dtype=float)
+        yaw = numpy.asarray(yaw, dtype=float)
+        if not self.three_d:
+            throttle = (throttle + 1) / 2.0
+        left = throttle + yaw * self.yaw_mix
+        right = throttle - yaw * self.yaw_mix
+        peak = numpy.maximum(numpy.maximum(numpy.abs(left), numpy.abs(right)), 1.0)
+        return (self.curve(MOTOR_LEFT, left / peak),
+                self.curve(MOTOR_RIGHT, right / peak),
+                self.curve(SERVO_PITCH, climb))
+
+    def curve(self, channel, demand):
+        return numpy.interp(numpy.clip(demand, -1.0, 1.0), self._grid, self._tables[channel])
+
+
+def sweep(mixer, steps=21):
+    # Output of every channel over the full input range, as CSV
+    inputs = numpy.linspace(-1.0, 1.0, steps)
+    motor_left, motor_right, servo_pitch = mixer.mix_batch(inputs, numpy.zeros(steps), inputs)
+    print("input,motor_left,motor_right,servo_pitch")
+    for row in zip(inputs, motor_left, motor_right, servo_pitch):
+        print("{:.3f},{:.5f},{:.5f},{:.5f}".format(*row))
+
+
+if __name__ == '__main__':
+    sweep(Mixer.load(sys.argv[1]) if len(sys.argv) > 1 else Mixer())
@@ -0,0 +1,400 @@
+import json
+import math
+import re
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+# Shared between remote and client (client/protocol.py links here).
+#
+# Binary frame: header | payload | crc32(header + payload)
+# The first byte is MAGIC, which can never start a JSON document, so both
+# encodings can be told apart per packet and JSON stays usable for debugging.
+
+MAGIC = 0xA5
+VERSION = 4
+
+COMMAND = 1
+TELEMETRY = 2
+# Observers register for telemetry with SUBSCRIBE and get TELEMETRY_FIELDS back: a
+# subset of the fields, with delta encoding only the ones that changed. Binary only.
+SUBSCRIBE = 3
+TELEMETRY_FIELDS = 4
+# Runtime metrics (metrics.py) over the control channel: METRICS_REQUEST carries a
+# name prefix, METRICS the zlib compressed JSON snapshot. Binary only.
+METRICS_REQUEST = 5
+METRICS = 6
+
+BINARY = "binary"
+JSON = "json"
+
+RSSI_UNKNOWN = -32768
+
+HEADER = struct.Struct("<BBBxId")           # magic, version, type, seq, sender timestamp
+CRC = struct.Struct("<I")
+COMMAND_PAYLOAD = struct.Struct("<3f")      # throttle, yaw, climb
+TELEMETRY_PAYLOAD = struct.Struct("<8fh?x3I3fI2d?xI2f5f?")
+SUBSCRIBE_PAYLOAD = struct.Struct("<fIB")   # hertz (0 ends the subscription), field mask, flags
+FIELDS_HEADER = struct.Struct("<IB")        # field mask, flags, then the fields in the mask
+
+COMMAND_SIZE = HEADER.size + COMMAND_PAYLOAD.size + CRC.size
+TELEMETRY_SIZE = HEADER.size + TELEMETRY_PAYLOAD.size + CRC.size
+SUBSCRIBE_SIZE = HEADER.size + SUBSCRIBE_PAYLOAD.size + CRC.size
+MAX_PACKET_SIZE = 2048
+MAX_METRICS_PAYLOAD = MAX_PACKET_SIZE - HEADER.size - CRC.size
+
+FLAG_DELTA = 0x01                           # SUBSCRIBE: only send changed fields
+FLAG_KEYFRAME = 0x01                        # TELEMETRY_FIELDS: all fields of the subscription
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+Header = namedtuple("Header", ["version", "type", "seq", "timestamp"])
+Command = namedtuple("Command", ["throttle", "yaw", "climb"])
+Telemetry = namedtuple("Telemetry", ["motor_left", "servo_pitch",
+                                     "target_throttle", "target_yaw", "target_climb",
+                                     "target_motor_left", "target_motor_right", "target_servo_pitch",
+                                     "wifi_rssi", "wifi_rssi_stale",
+                                     "loop_ticks", "loop_overruns", "loop_skipped",
+                                     "loop_mean_jitter", "loop_max_jitter", "loop_max_duration",
+                                     # Last command written to the outputs: its seq, the client's
+                                     # timestamp of it and the remote's wall clock when it was applied
+                                     "applied_seq", "applied_timestamp", "applied_time",
+                                     # Link-loss failsafe: engaged now, times engaged, and the last and
+                                     # longest time from the command deadline to the outputs reacting
+                                     "failsafe_active", "failsafe_triggers",
+                                     "failsafe_reaction", "failsafe_max_reaction",
+                                     # IMU (imu.py): degrees, m above the start and m/s, at the
+                                     # filter's rate; stale without an IMU or a recent sample
+                                     "roll", "pitch", "yaw", "altitude", "vertical_speed", "attitude_stale"])
+
+
+Subscribe = namedtuple("Subscribe", ["hertz", "mask", "delta"])
+# values: field name -> value for the fields in mask
+TelemetryFields = namedtuple("TelemetryFields", ["mask", "keyframe", "values"])
+
+# struct format of each Telemetry field, as laid out in TELEMETRY_PAYLOAD
+FIELD_FORMATS = [code for count, code in re.findall(r"(\d*)([a-zA-Z?])", TELEMETRY_PAYLOAD.format[1:])
+                 if code != "x" for _ in range(int(count or 1))]
+ALL_FIELDS = (1 << len(Telemetry._fields)) - 1
+_field_structs = {}
+
+
+def field_mask(names):
+    mask = 0
+    for name in names:
+        mask |= 1 << Telemetry._fields.index(name)
+    return mask
+
+
+def field_names(mask):
+    return [name for i, name in enumerate(Telemetry._fields) if mask >> i & 1]
+
+
+def _fields_struct(mask):
+    fields_struct = _field_structs.get(mask)
+    if fields_struct is None:
+        formats = "".join(code for i, code in enumerate(FIELD_FORMATS) if mask >> i & 1)
+        fields_struct = _field_structs[mask] = struct.Struct("<" + formats)
+    return fields_struct
+
+
+def is_binary(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def packet_type(data):
+    # Type of a binary packet, None for JSON (always a command or telemetry)
+    return data[2] if is_binary(data) and len(data) > 2 else None
+
+
+class Codec:
+    # Encoding reuses one preallocated buffer per message type, so the returned
+    # memoryview is only valid until the next encode of the same type.
+    def __init__(self):
+        self._command_buffer = bytearray(COMMAND_SIZE)
+        self._command_view = memoryview(self._command_buffer)
+        self._telemetry_buffer = bytearray(TELEMETRY_SIZE)
+        self._telemetry_view = memoryview(self._telemetry_buffer)
+        self._subscribe_view = memoryview(bytearray(SUBSCRIBE_SIZE))
+        self._fields_buffer = bytearray(MAX_PACKET_SIZE)
+        self._fields_view = memoryview(self._fields_buffer)
+
+    @staticmethod
+    def _finish(view, type_, seq, payload_struct, values, timestamp):
+        HEADER.pack_into(view, 0, MAGIC, VERSION, type_, seq & 0xFFFFFFFF,
+                         time.time() if timestamp is None else timestamp)
+        payload_struct.pack_into(view, HEADER.size, *values)
+        end = HEADER.size + payload_struct.size
+        CRC.pack_into(view, end, zlib.crc32(view[:end]))
+        return view
+
+    def encode_command(self, seq, command, timestamp=None):
+        return self._finish(self._command_view, COMMAND, seq, COMMAND_PAYLOAD, command, timestamp)
+
+    def encode_telemetry(self, seq, telemetry, timestamp=None):
+        values = telemetry._replace(wifi_rssi=RSSI_UNKNOWN if telemetry.wifi_rssi is None else telemetry.wifi_rssi)
+        return self._finish(self._telemetry_view, TELEMETRY, seq, TELEMETRY_PAYLOAD, values, timestamp)
+
+    def encode_subscribe(self, seq, hertz, mask=ALL_FIELDS, delta=False, timestamp=None):
+        return self._finish(self._subscribe_view, SUBSCRIBE, seq, SUBSCRIBE_PAYLOAD,
+                            (hertz, mask, FLAG_DELTA if delta else 0), timestamp)
+
+    def encode_fields(self, seq, telemetry, mask, keyframe, timestamp=None):
+        # Only valid until the next encode_fields, like the other encodings
+        values = [RSSI_UNKNOWN if value is None else value
+                  for i, value in enumerate(telemetry) if mask >> i & 1]
+        fields_struct = _fields_struct(mask)
+        view = self._fields_view
+        HEADER.pack_into(view, 0, MAGIC, VERSION, TELEMETRY_FIELDS, seq & 0xFFFFFFFF,
+                         time.time() if timestamp is None else timestamp)
+        FIELDS_HEADER.pack_into(view, HEADER.size, mask, FLAG_KEYFRAME if keyframe else 0)
+        fields_struct.pack_into(view, HEADER.size + FIELDS_HEADER.size, *values)
+        end = HEADER.size + FIELDS_HEADER.size + fields_struct.size
+        CRC.pack_into(view, end, zlib.crc32(view[:end]))
+        return view[:end + CRC.size]
+
+    @staticmethod
+    def _encode_blob(type_, seq, payload, timestamp):
+        # Rare and of any length, so no preallocated buffer
+        header = HEADER.pack(MAGIC, VERSION, type_, seq & 0xFFFFFFFF, time.time() if timestamp is None else timestamp)
+        data = header + bytes(payload)
+        return data + CRC.pack(zlib.crc32(data))
+
+    def encode_metrics_request(self, seq, prefix="", timestamp=None):
+        return self._encode_blob(METRICS_REQUEST, seq, bytes(prefix, "utf-8"), timestamp)
+
+    def encode_metrics(self, seq, payload, timestamp=None):
+        return self._encode_blob(METRICS, seq, payload, timestamp)
+
+    @staticmethod
+    def decode(data):
+        if len(data) < HEADER.size + CRC.size:
+            raise ProtocolError("Packet too short ({} bytes)".format(len(data)))
+
+        magic, version, type_, seq, timestamp = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ProtocolError("Not a binary packet")
+        if version != VERSION:
+            raise ProtocolError("Unsupported protocol version {}".format(version))
+
+        if type_ in (METRICS_REQUEST, METRICS):
+            end = len(data) - CRC.size
+            if CRC.unpack_from(data, end)[0] != zlib.crc32(memoryview(data)[:end]):
+                raise ProtocolError("CRC mismatch")
+            payload = bytes(data[HEADER.size:end])
+            if type_ == METRICS_REQUEST:
+                try:
+                    payload = str(payload, "utf-8")
+                except UnicodeDecodeError as e:
+                    raise ProtocolError("Invalid metrics prefix: {}".format(e))
+            return Header(version, type_, seq, timestamp), payload
+
+        if type_ == TELEMETRY_FIELDS:
+            if len(data) < HEADER.size + FIELDS_HEADER.size + CRC.size:
+                raise ProtocolError("Packet too short ({} bytes)".format(len(data)))
+            mask, flags = FIELDS_HEADER.unpack_from(data, HEADER.size)
+            if mask & ~ALL_FIELDS:
+                raise ProtocolError("Unknown fields in mask {:x}".format(mask))
+            payload_struct = _fields_struct(mask)
+            offset = HEADER.size + FIELDS_HEADER.size
+        else:
+            payload_struct = {COMMAND: COMMAND_PAYLOAD, TELEMETRY: TELEMETRY_PAYLOAD,
+                              SUBSCRIBE: SUBSCRIBE_PAYLOAD}.get(type_)
+            if payload_struct is None:
+                raise ProtocolError("Unknown packet type {}".format(type_))
+            offset = HEADER.size
+        end = offset + payload_struct.size
+        if len(data) != end + CRC.size:
+            raise ProtocolError("Bad length {} for packet type {}".format(len(data), type_))
+        if CRC.unpack_from(data, end)[0] != zlib.crc32(memoryview(data)[:end]):
+            raise ProtocolError("CRC mismatch")
+
+        header = Header(version, type_, seq, timestamp)
+        values = payload_struct.unpack_from(data, offset)
+        if type_ == COMMAND:
+            return header, _command(*values)
+        if type_ == SUBSCRIBE:
+            hertz, mask, flags = values
+            return header, Subscribe(hertz, mask, bool(flags & FLAG_DELTA))
+        if type_ == TELEMETRY_FIELDS:
+            fields = dict(zip(field_names(mask), values))
+            if fields.get("wifi_rssi") == RSSI_UNKNOWN:
+                fields["wifi_rssi"] = None
+            return header, TelemetryFields(mask, bool(flags & FLAG_KEYFRAME), fields)
+        telemetry = Telemetry(*values)
+        if telemetry.wifi_rssi == RSSI_UNKNOWN:
+            telemetry = telemetry._replace(wifi_rssi=None)
+        return header, telemetry
+
+
+# JSON encoding, kept for debugging with netcat & co.
+
+def command_to_json(seq, command, timestamp=None):
+    return bytes(json.dumps({"seq": seq,
+                             "timestamp": time.time() if timestamp is None else timestamp,
+                             "throttle": command.throttle,
+                             "yaw": command.yaw,
+                             "climb": command.climb}), "utf-8")
+
+
+def telemetry_to_json(seq, telemetry, timestamp=None):
+    t = telemetry
+    return bytes(json.dumps({"seq": seq,
+                             "timestamp": time.time() if timestamp is None else timestamp,
+                             "current_state": {"motor_left": t.motor_left,
+                                               "servo_pitch": t.servo_pitch},
+                             "target_state": {"throttle": t.target_throttle,
+                                              "yaw": t.target_yaw,
+                                              "climb": t.target_climb,
+                                              "motor_left": t.target_motor_left,
+                                              "motor_right": t.target_motor_right,
+                                              "servo_pitch": t.target_servo_pitch},
+                             "loop": {"ticks": t.loop_ticks,
+                                      "overruns": t.loop_overruns,
+                                      "skipped": t.loop_skipped,
+                                      "mean_jitter": t.loop_mean_jitter,
+                                      "max_jitter": t.loop_max_jitter,
+                                      "max_duration": t.loop_max_duration},
+                             "applied": {"seq": t.applied_seq,
+                                         "timestamp": t.applied_timestamp,
+                                         "time": t.applied_time},
+                             "failsafe": {"active": t.failsafe_active,
+                                          "triggers": t.failsafe_triggers,
+                                          "reaction": t.failsafe_reaction,
+                                          "max_reaction": t.failsafe_max_reaction},
+                             "attitude": {"roll": t.roll,
+                                          "pitch": t.pitch,
+                                          "yaw": t.yaw,
+                                          "altitude": t.altitude,
+                                          "vertical_speed": t.vertical_speed,
+                                          "stale": t.attitude_stale},
+                             "wifi_rssi": t.wifi_rssi,
+                             "wifi_rssi_stale": t.wifi_rssi_stale}), "utf-8")
+
+
+def _decode_json(data):
+    try:
+        message = json.loads(str(data, "utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtocolError("Invalid JSON packet: {}".format(e))
+    if not isinstance(message, dict):
+        raise ProtocolError("JSON packet is not an object")
+    return message
+
+
+def _command(throttle, yaw, climb):
+    # Checked here so no receiver has to: finite numbers, clamped to -1..1
+    values = []
+    for name, value in zip(Command._fields, (throttle, yaw, climb)):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ProtocolError("Invalid command {} {!r}".format(name, value))
+        values.append(max(-1.0, min(1.0, float(value))))
+    return Command(*values)
+
+
+def command_from_json(data):
+    message = _decode_json(data)
+    seq, timestamp = message.get("seq"), message.get("timestamp")
+    # Both optional, but the server does sequence arithmetic on seq
+    if seq is not None and (isinstance(seq, bool) or not isinstance(seq, int) or not 0 <= seq <= 0xFFFFFFFF):
+        raise ProtocolError("Invalid command seq {!r}".format(seq))
+    if timestamp is not None and (isinstance(timestamp, bool) or not isinstance(timestamp, (int, float))
+                                  or not math.isfinite(timestamp)):
+        raise ProtocolError("Invalid command timestamp {!r}".format(timestamp))
+    header = Header(None, COMMAND, seq, timestamp)
+    return header, _command(message.get("throttle", 0), message.get("yaw", 0), message.get("climb", 0))
+
+
+def telemetry_from_json(data):
+    message = _decode_json(data)
+    current = message.get("current_state", {})
+    target = message.get("target_state", {})
+    loop = message.get("loop", {})
+    applied = message.get("applied", {})
+    failsafe = message.get("failsafe", {})
+    attitude = message.get("attitude", {})
+    header = Header(None, TELEMETRY, message.get("seq"), message.get("timestamp"))
+    return header, Telemetry(current.get("motor_left", 0), current.get("servo_pitch", 0),
+                             target.get("throttle", 0), target.get("yaw", 0), target.get("climb", 0),
+                             target.get("motor_left", 0), target.get("motor_right", 0),
+                             target.get("servo_pitch", 0),
+                             message.get("wifi_rssi"), message.get("wifi_rssi_stale", True),
+                             loop.get("ticks", 0), loop.get("overruns", 0), loop.get("skipped", 0),
+                             loop.get("mean_jitter", 0), loop.get("max_jitter", 0),
+                             loop.get("max_duration", 0),
+                             applied.get("seq", 0), applied.get("timestamp", 0.0), applied.get("time", 0.0),
+                             failsafe.get("active", False), failsafe.get("triggers", 0),
+                             failsafe.get("reaction", 0.0), failsafe.get("max_reaction", 0.0),
+                             attitude.get("roll", 0.0), attitude.get("pitch", 0.0), attitude.get("yaw", 0.0),
+                             attitude.get("altitude", 0.0), attitude.get("vertical_speed", 0.0),
+                             attitude.get("stale", True))
+
+
+def _decode_binary(data, type_):
+    header, message = Codec.decode(data)
+    if header.type != type_:
+        raise ProtocolError("Expected packet type {}, got {}".format(type_, header.type))
+    return header, message
+
+
+def decode_command(data):
+    if is_binary(data):
+        return _decode_binary(data, COMMAND)
+    return command_from_json(data)
+
+
+def decode_telemetry(data):
+    if is_binary(data):
+        return _decode_binary(data, TELEMETRY)
+    return telemetry_from_json(data)
+
+
+def decode_subscribe(data):
+    return _decode_binary(data, SUBSCRIBE)
+
+
+def decode_fields(data):
+    return _decode_binary(data, TELEMETRY_FIELDS)
+
+
+def decode_metrics_request(data):
+    return _decode_binary(data, METRICS_REQUEST)
+
+
+def decode_metrics(data):
+    return _decode_binary(data, METRICS)
+
+
+class FieldsDecoder:
+    # Rebuilds a subscriber's telemetry: fields missing from a delta keep their last
+    # value. After a lost packet a delta could miss a change, so nothing comes out
+    # until the next keyframe. Fields outside the subscription stay None.
+    def __init__(self):
+        self.values = {}
+        self.synced = False
+        self.last_seq = None
+        self.lost = 0
+
+    def update(self, header, fields):
+        if self.last_seq is not None:
+            # Serial number arithmetic like the server's: duplicates and packets older
+            # than the last one are dropped, only forward gaps count as lost
+            delta = (header.seq - self.last_seq) & 0xFFFFFFFF
+            if delta == 0 or delta >= 0x80000000:
+                return None
+            if delta > 1:
+                self.lost += delta - 1
+                self.synced = False
+        self.last_seq = header.seq
+        if fields.keyframe:
+            self.values = dict(fields.values)
+            self.synced = True
+        elif not self.synced:
+            return None
+        else:
+            self.values.update(fields.values)
+        return Telemetry(*(self.values.get(name) for name in Telemetry._fields))
@@ -0,0 +1,174 @@
+import math
+import time
+
+import protocol
+
+
+class PublisherStats:
+    def __init__(self):
+        self.subscribes = 0
+        self.rejected = 0
+        self.expired = 0
+        self.ticks = 0
+        self.encodes = 0
+        self.sends = 0
+        self.send_errors = 0
+        self.publish_time = 0.0
+        self.max_publish_time = 0.0
+
+    def to_json(self):
+        return {"subscribes": self.subscribes,
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "ticks": self.ticks,
+                "encodes": self.encodes,
+                "sends": self.sends,
+                "send_errors": self.send_errors,
+                "mean_publish_time": self.publish_time / self.ticks if self.ticks else 0.0,
+                "max_publish_time": self.max_publish_time}
+
+
+class Subscriber:
+    def __init__(self, address, expires):
+        self.address = address
+        self.expires = expires
+        self.group = None
+
+
+# Subscribers with the same decimation, fields and encoding get the very same packets,
+# so each group encodes once per tick and every member gets a copy. A delta group
+# sends the fields that changed since its last packet, and all of them every
+# KEYFRAME_INTERVAL packets and whenever a member joins.
+class SubscriberGroup:
+    KEYFRAME_INTERVAL = 25
+
+    def __init__(self, divisor, mask, delta):
+        self.divisor = divisor
+        self.mask = mask
+        self.delta = delta
+        self.members = {}
+        self.seq = 0
+        self.last_values = None
+        self.since_keyframe = 0
+        self.keyframe_due = True
+
+    def packet(self, codec, telemetry, timestamp):
+        keyframe = not self.delta or self.keyframe_due or self.since_keyframe >= self.KEYFRAME_INTERVAL
+        mask = self.mask
+        if not keyframe:
+            last = self.last_values
+            mask = 0
+            for i, value in enumerate(telemetry):
+                if self.mask >> i & 1 and value != last[i]:
+                    mask |= 1 << i
+        self.since_keyframe = 0 if keyframe else self.since_keyframe + 1
+        self.keyframe_due = False
+        self.last_values = telemetry
+        self.seq += 1
+        return codec.encode_fields(self.seq, telemetry, mask, keyframe, timestamp)
+
+
+# Telemetry for observers (logger, second screen, analysis tools) next to the pilot's
+# station. They send SUBSCRIBE with a rate, a field mask and whether they want deltas,
+# and renew it within LEASE seconds or are dropped. Runs on the server's event loop:
+# the control loop produces the telemetry once per tick however many subscribe.
+class TelemetryPublisher:
+    LEASE = 5.0
+    MAX_SUBSCRIBERS = 64
+    MIN_HERTZ = 0.1
+
+    def __init__(self, hertz, send):
+        # send(data, address), e.g. the datagram transport's sendto
+        self.hertz = hertz
+        self.send = send
+        self.codec = protocol.Codec()
+        self.stats = PublisherStats()
+        self.subscribers = {}
+        self.groups = {}
+        self._tick = 0
+        self._next_expiry = 0.0
+
+    def subscribe(self, address, subscription, now=None):
+        now = time.monotonic() if now is None else now
+        hertz = subscription.hertz
+        if hertz == 0:
+            self.unsubscribe(address)
+            return True
+        if not math.isfinite(hertz) or hertz < 0:
+            self.stats.rejected += 1
+            return False
+        # Between one packet per MIN_HERTZ period and every tick
+        hertz = min(max(hertz, self.MIN_HERTZ), self.hertz)
+        subscriber = self.subscribers.get(address)
+        if subscriber is None:
+            if len(self.subscribers) >= self.MAX_SUBSCRIBERS or not subscription.mask & protocol.ALL_FIELDS:
+                self.stats.rejected += 1
+                return False
+            subscriber = self.subscribers[address] = Subscriber(address, now + self.LEASE)
+        subscriber.expires = now + self.LEASE
+        self.stats.subscribes += 1
+
+        divisor = max(1, round(self.hertz / hertz))
+        key = (divisor, subscription.mask & protocol.ALL_FIELDS, subscription.delta)
+        if subscriber.group is not None and (subscriber.group.divisor, subscriber.group.mask,
+                                             subscriber.group.delta) == key:
+            # Just renewing the lease
+            return True
+        self._leave(subscriber)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = SubscriberGroup(*key)
+        group.members[address] = subscriber
+        group.keyframe_due = True
+        subscriber.group = group
+        return True
+
+    def unsubscribe(self, address):
+        subscriber = self.subscribers.pop(address, None)
+        if subscriber is not None:
+            self._leave(subscriber)
+
+    def _leave(self, subscriber):
+        group = subscriber.group
+        if group is None:
+            return
+        del group.members[subscriber.address]
+        if not group.members:
+            del self.groups[(group.divisor, group.mask, group.delta)]
+        subscriber.group = None
+
+    def _expire(self, now):
+        for address in [a for a, s in self.subscribers.items() if s.expires < now]:
+            self.unsubscribe(address)
+            self.stats.expired += 1
+
+    def publish(self, telemetry, now=None):
+        if not self.subscribers:
+            return
+        start = time.perf_counter()
+        now = time.monotonic() if now is None else now
+        if now >= self._next_expiry:
+            self._next_expiry = now + 1.0
+            self._expire(now)
+
+        self._tick += 1
+        timestamp = time.time()
+        for group in self.groups.values():
+            if self._tick % group.divisor:
+                continue
+            data = group.packet(self.codec, telemetry, timestamp)
+            self.stats.encodes += 1
+            for address in group.members:
+                try:
+                    self.send(data, address)
+                    self.stats.sends += 1
+                except OSError:
+                    self.stats.send_errors += 1
+
+        duration = time.perf_counter() - start
+        self.stats.ticks += 1
+        self.stats.publish_time += duration
+        self.stats.max_publish_time = max(self.stats.max_publish_time, duration)
+
+    def to_json(self):
+        return dict(self.stats.to_json(), subscribers=len(self.subscribers), groups=len(self.groups))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Chooses the video mode from link metrics. Pure logic without any I/O, so it can be
+# driven by synthetic traces: python3 ratecontrol.py trace.csv, with the columns
+# time,rssi,send_queue,rtt (dBm, bytes, seconds; empty for unknown).
+import csv
+import sys
+import time
+from collections import deque, namedtuple
+
+LinkSample = namedtuple("LinkSample", ["rssi", "send_queue", "rtt"])
+VideoMode = namedtuple("VideoMode", ["width", "height", "fps", "bitrate"])
+Decision = namedtuple("Decision", ["time", "previous", "mode", "reason"])
+
+# Best first. Neighbouring steps mostly change the bitrate only, which is cheap to
+# switch while streaming, a resolution change needs the capture restarted.
+LADDER = [
+    VideoMode(1280, 720, 30, 2000000),
+    VideoMode(1280, 720, 30, 1200000),
+    VideoMode(1280, 720, 30, 800000),
+    VideoMode(960, 540, 30, 600000),
+    VideoMode(960, 540, 20, 400000),
+    VideoMode(640, 360, 20, 250000),
+    VideoMode(640, 360, 10, 120000),
+]
+
+
+# Steps down the ladder as soon as one metric is bad, and up again only after all
+# metrics were good for UPGRADE_HOLD seconds, so the mode does not oscillate around
+# the link capacity. A bad link drops at most one step per DOWNGRADE_INTERVAL,
+# which is the time the send queue needs to show the effect of the last step.
+class RateController:
+    RSSI_BAD = -75
+    RSSI_GOOD = -67
+    QUEUE_BAD = 64 * 1024
+    QUEUE_GOOD = 8 * 1024
+    RTT_BAD = 0.15
+    RTT_GOOD = 0.06
+    DOWNGRADE_INTERVAL = 1.0
+    UPGRADE_HOLD = 5.0
+
+    def __init__(self, ladder=LADDER, start=1, log=print):
+        self.ladder = ladder
+        self.index = start
+        self.log = log
+        self.decisions = deque(maxlen=100)
+
+        self._last_change = None
+        self._good_since = None
+
+    @property
+    def mode(self):
+        return self.ladder[self.index]
+
+    def problems(self, sample):
+        problems = []
+        if sample.rssi is not None and sample.rssi < self.RSSI_BAD:
+            problems.append("rssi {} dBm".format(sample.rssi))
+        if sample.send_queue is not None and sample.send_queue > self.QUEUE_BAD:
+            problems.append("send queue {} bytes".format(sample.send_queue))
+        if sample.rtt is not None and sample.rtt > self.RTT_BAD:
+            problems.append("rtt {:.0f} ms".format(sample.rtt * 1000))
+        return problems
+
+    def is_good(self, sample):
+        # Unknown metrics do not block an upgrade, a missing RSSI reading is no reason to stay low
+        return ((sample.rssi is None or sample.rssi > self.RSSI_GOOD) and
+                (sample.send_queue is None or sample.send_queue < self.QUEUE_GOOD) and
+                (sample.rtt is None or sample.rtt < self.RTT_GOOD))
+
+    def update(self, sample, now=None):
+        # Returns the new mode if it changed, else None
+        now = time.monotonic() if now is None else now
+        problems = self.problems(sample)
+        if problems:
+            self._good_since = None
+            if self.index + 1 < len(self.ladder) and \
+                    (self._last_change is None or now - self._last_change >= self.DOWNGRADE_INTERVAL):
+                return self._change(self.index + 1, now, ", ".join(problems))
+            return None
+
+        if not self.is_good(sample):
+            self._good_since = None
+            return None
+        if self._good_since is None:
+            self._good_since = now
+        if self.index > 0 and now - self._good_since >= self.UPGRADE_HOLD:
+            self._good_since = now
+            return self._change(self.index - 1, now, "link good for {:.0f} s".format(self.UPGRADE_HOLD))
+        return None
+
+    def _change(self, index, now, reason):
+        decision = Decision(now, self.mode, self.ladder[index], reason)
+        self.index = index
+        self._last_change = now
+        self.decisions.append(decision)
+        if self.log is not None:
+            self.log("Video {p.width}x{p.height}@{p.fps} {p.bitrate} -> {m.width}x{m.height}@{m.fps} {m.bitrate}: {r}"
+                     .format(p=decision.previous, m=decision.mode, r=reason))
+        return decision.mode
+
+
+def read_trace(path):
+    def value(text, type_):
+        return type_(text) if text not in ("", None) else None
+
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            yield float(row["time"]), LinkSample(value(row.get("rssi"), int),
+                                                 value(row.get("send_queue"), int),
+                                                 value(row.get("rtt"), float))
+
+
+def run_trace(controller, trace):
+    for now, sample in trace:
+        controller.update(sample, now)
+    return list(controller.decisions)
+
+
+if __name__ == '__main__':
+    controller = RateController(log=lambda line: None)
+    for decision in run_trace(controller, read_trace(sys.argv[1])):
+        print("{:8.2f}  {}x{}@{} {:>8}  {}".format(decision.time, *decision.mode, decision.reason))
@@ -0,0 +1,90 @@
+import mmap
+import os
+import struct
+import threading
+from collections import namedtuple
+
+# Flight log: a fixed header followed by a ring of fixed-size records, written through
+# a shared memory map. Appending a record is a struct.pack_into() into the page cache,
+# so the control loop never waits for the disk; a background thread msyncs the map.
+
+MAGIC = b"FDR1"
+LOG_HEADER = struct.Struct("<4sHHIQ")       # magic, version, record size, capacity, records written
+RECORD = struct.Struct("<dI3f3f2f?h2f")
+VERSION = 2
+RSSI_UNKNOWN = -32768
+
+# throttle..climb are the inputs that were mixed (the failsafe's while it is engaged),
+# motor_left..servo_pitch the mixer's output for them, the applied values what reached
+# the outputs after the slew limit
+Record = namedtuple("Record", ["time", "seq",
+                               "throttle", "yaw", "climb",
+                               "motor_left", "motor_right", "servo_pitch",
+                               "applied_motor_left", "applied_servo_pitch", "failsafe",
+                               "wifi_rssi", "loop_jitter", "loop_duration"])
+
+
+class FlightRecorder:
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path, capacity=50 * 60 * 10):
+        self.path = path
+        self.capacity = capacity
+        self.written = 0
+
+        # Keep the log of the previous flight, the next boot would overwrite it otherwise
+        if os.path.exists(path):
+            os.replace(path, path + ".prev")
+
+        size = LOG_HEADER.size + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Allocate all blocks now, not on first write from the control loop
+            os.posix_fallocate(fd, 0, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        LOG_HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD.size, capacity, 0)
+
+        self._stop_event = threading.Event()
+        self._flush_thread = threading.Thread(target=self._flush_loop, name="recorder")
+        self._flush_thread.daemon = True
+        self._flush_thread.start()
+
+    def record(self, *values):
+        offset = LOG_HEADER.size + (self.written % self.capacity) * RECORD.size
+        RECORD.pack_into(self._map, offset, *values)
+        self.written += 1
+        # Published after the record, so readers never see a half written one as valid
+        struct.pack_into("<Q", self._map, LOG_HEADER.size - 8, self.written)
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.FLUSH_INTERVAL):
+            self._map.flush()
+
+    def close(self):
+        self._stop_event.set()
+        self._flush_thread.join()
+        self._map.flush()
+        self._map.close()
+
+
+class FlightLog:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._data = f.read()
+        magic, version, record_size, self.capacity, self.written = LOG_HEADER.unpack_from(self._data)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise ValueError("{} is not a flight log of version {}".format(path, VERSION))
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def __iter__(self):
+        # Oldest record first
+        for index in range(self.written - len(self), self.written):
+            offset = LOG_HEADER.size + (index % self.capacity) * RECORD.size
+            record = Record(*RECORD.unpack_from(self._data, offset))
+            if record.wifi_rssi == RSSI_UNKNOWN:
+                record = record._replace(wifi_rssi=None)
+            yield record
@@ -1,115 +1,205 @@
 #!/usr/bin/env python3
+import os
 import time
-import json
 import threading
-import subprocess
-import socketserver
 
 from control import Control, ControlState
+from metrics import MetricsServer, Registry, add_process_metrics
+from mixer import Mixer
+from recorder import FlightRecorder
+from rtp import RTP, TCP
+from secure import DIRECT, KEY_FILE, VPN, ServerChannel, load_key
 from sensors import Sensors
-
-
-class ThreadedUDPServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
-    control = None
-    sensors = None
-    client_socket = None
-    client_address = None
-
-    def set_instances(self, control, sensors):
-        self.control = control
-        self.sensors = sensors
-
-    def send_telemetry(self):
-        if None in [self.client_socket, self.control, self.sensors, self.client_address]:
-            return
-        telemetry = self.control.get_state()
-        telemetry['wifi_rssi'] = self.sensors.get_wifi_rssi()
-
-        self.client_socket.sendto(bytes(json.dumps(telemetry), "utf-8"), self.client_address)
-
-
-class ThreadedUDPRequestHandler(socketserver.BaseRequestHandler):
-
-    def handle(self):
-        self.server.client_socket = self.request[1]
-        self.server.client_address = self.client_address
-        data = self.request[0].strip()
-        target_state = json.loads(str(data, 'utf-8'))
-        if self.server.control is not None:
-            print(target_state)
-            self.server.control.set_state(ControlState(target_state.get("throttle", 0),
-                                                target_state.get("yaw", 0),
-                                                target_state.get("climb", 0)))
-
-
-
+from server import ControlServer
+from startup import Startup, StartupError, wait_for_address
+from supervisor import Supervisor
 
 
 class Remote:
     CONTROL_PORT = 8081
     VIDEO_PORT = 8082
+    # RTP: video as UDP datagrams with FEC, and the VPN over UDP too, so nothing runs
+    # TCP over TCP. Has to match the client's --video-transport
+    VIDEO_TRANSPORT = TCP
+    # DIRECT: control packets straight over WiFi, authenticated and encrypted with the
+    # VPN's key (secure.py), no tunnel in the way. Has to match the client's --direct
+    CONTROL_TRANSPORT = VPN
+    DIRECT_BIND_ADDRESS = "0.0.0.0"
+    KEY_FILE = KEY_FILE
     VPN_INTERFACE = "ptp-control"
     BIND_ADDRESS = "172.31.31.33"
     CLIENT_ADDRESS = "172.31.31.34"
+    FLIGHT_LOG = "flight.log"
+    CALIBRATION = "calibration.json"
+    # gpiozero pin factory for the outputs, None for gpiozero's default
+    PIN_FACTORY = "pigpio"
+    # I2C bus of the IMU (imu.py), None to fly without
+    IMU_BUS = 1
+
+    # Seconds to wait for the tunnel's address, openvpn configures it right at start
+    VPN_TIMEOUT = 10.0
+    # False runs the startup stages one after another
+    PARALLEL_STARTUP = True
+    # Prometheus endpoint, on localhost only: scrape on the pi or through ssh. None: off,
+    # the metrics can still be queried over the control channel (client/remote_metrics.py)
+    METRICS_ADDRESS = ("127.0.0.1", 9108)
 
     def __init__(self):
         self.shutdown = False
+        self.control_server = None
+        self.sensors = None
+        self.recorder = None
+        self.control = None
+        self._control_server_thread = None
+        self.metrics_server = None
+
+        # Restarts the VPN and the camera capture as soon as they exit
+        self.supervisor = Supervisor()
+        self.metrics = Registry()
+        add_process_metrics(self.metrics)
+
+        # Independent stages run at the same time, the control path does not wait for
+        # the camera: commands are accepted once "serving" is done. The stages are added
+        # in the order they run with PARALLEL_STARTUP off
+        # Only what "serving" needs may fail the startup: the camera never does, the
+        # VPN not when control comes directly
+        direct = self.CONTROL_TRANSPORT == DIRECT
+        self.startup = Startup(parallel=self.PARALLEL_STARTUP)
+        self.startup.add("metrics", self._start_metrics)
+        self.startup.add("vpn", self._start_vpn, optional=direct)
+        self.startup.add("tunnel", self._wait_for_tunnel, requires=["vpn"], optional=direct)
+        self.startup.add("control_server", self._bind_control_server, requires=[] if direct else ["tunnel"])
+        self.startup.add("calibration", self._load_calibration)
+        self.startup.add("sensors", self._start_sensors)
+        self.startup.add("camera", self._start_camera, requires=["sensors"], optional=True)
+        self.startup.add("recorder", self._start_recorder)
+        self.startup.add("control", self._start_control, requires=["calibration", "recorder", "sensors"])
+        self.startup.add("serving", self._serve, requires=["control_server", "control"])
+        self._add_metrics()
+        try:
+            self.startup.run()
+        except StartupError:
+            print(self.startup.report())
+            self.stop()
+            raise
+        print(self.startup.report())
+
+    def _add_metrics(self):
+        # Also the VPN: whether it runs, how often it was restarted and for how long it is up
+        supervisor = self.supervisor
+
+        def service(key):
+            return lambda: {name: stats[key] for name, stats in supervisor.to_json().items()}
+
+        self.metrics.collect("service_running", "Supervised process is running", service("running"),
+                             label="service")
+        self.metrics.collect("service_restarts_total", "Restarts of the supervised process", service("restarts"),
+                             type="counter", label="service")
+        self.metrics.collect("service_failures_total", "Unexpected exits and failed starts", service("failures"),
+                             type="counter", label="service")
+        self.metrics.collect("service_uptime_seconds", "Time up, summed over all runs", service("uptime"),
+                             label="service")
+        self.metrics.collect("startup_stage_seconds", "Duration of each startup stage",
+                             lambda: {name: stage.duration() for name, stage in self.startup.stages.items()
+                                      if stage.finished is not None},
+                             label="stage")
+
+    def _start_metrics(self):
+        if self.METRICS_ADDRESS is None:
+            return
+        try:
+            self.metrics_server = MetricsServer(self.metrics, self.METRICS_ADDRESS)
+        except OSError as e:
+            # Flying without it is fine
+            print("No metrics endpoint on {}: {}".format(self.METRICS_ADDRESS, e))
+            return
+        self.metrics_server.start()
 
-        self._start_vpn()
+    def _wait_for_tunnel(self):
+        if not wait_for_address(self.BIND_ADDRESS, self.VPN_TIMEOUT):
+            raise StartupError("No address {} after {} s".format(self.BIND_ADDRESS, self.VPN_TIMEOUT))
 
-        timeout = 4
-        while timeout > 0:
-            try:
-                self.control_server = ThreadedUDPServer((self.BIND_ADDRESS, self.CONTROL_PORT),
-                                                         ThreadedUDPRequestHandler)
-                break
-            except OSError:
-                timeout -= 1
-                time.sleep(0.5)
+    def _bind_control_server(self):
+        if self.CONTROL_TRANSPORT == DIRECT:
+            self.control_server = ControlServer(channel=ServerChannel(load_key(self.KEY_FILE)),
+                                                metrics=self.metrics)
+            self.control_server.bind((self.DIRECT_BIND_ADDRESS, self.CONTROL_PORT))
         else:
-            print("Timeout while connecting to remote...")
-            return
+            self.control_server = ControlServer(metrics=self.metrics)
+            self.control_server.bind((self.BIND_ADDRESS, self.CONTROL_PORT))
 
-        self.sensors = Sensors(self)
-        self.control = Control(self, self.sensors)
-        self.control_server.set_instances(self.control, self.sensors)
+    def _load_calibration(self):
+        if os.path.exists(self.CALIBRATION):
+            ControlState.MIXER = Mixer.load(self.CALIBRATION)
+
+    def _start_recorder(self):
+        self.recorder = self._create_recorder()
 
-        self._control_server_thread = threading.Thread(target=self.control_server.serve_forever)
+    def _start_sensors(self):
+        self.sensors = self._create_sensors()
+
+    def _start_control(self):
+        self.control = Control(self.sensors, recorder=self.recorder, pin_factory=self.PIN_FACTORY,
+                               metrics=self.metrics)
+
+    def _serve(self):
+        self.control_server.set_instances(self.control, self.sensors)
+        self._control_server_thread = threading.Thread(target=self.control_server.serve_forever,
+                                                       name="control-server")
         self._control_server_thread.daemon = True
         self._control_server_thread.start()
 
-    def _check_vpn(self):
-        if self.vpn_proc.returncode:
-            print("restarting vpn...")
-            self._start_vpn()
+    def _start_camera(self):
+        self.sensors.start_video()
+
+    def _create_sensors(self):
+        return Sensors(self)
+
+    def _create_recorder(self):
+        try:
+            return FlightRecorder(self.FLIGHT_LOG)
+        except OSError as e:
+            print("Flying without flight recorder: {}".format(e))
 
     def _start_vpn(self):
-        self.vpn_proc = subprocess.Popen(["/usr/sbin/openvpn",
-                                          "--proto", "tcp-server",
-                                          "--dev-type", "tun",
-                                          "--dev", self.VPN_INTERFACE,
-                                          "--resolv-retry", "infinite",
-                                          "--ifconfig", self.BIND_ADDRESS, self.CLIENT_ADDRESS,
-                                          "--persist-key", "--persist-tun",
-                                          "--secret", "secret.key",
-                                          "--keepalive", "2", "5",
-                                          "--verb", "1"])
+        self.vpn = self.supervisor.add("vpn", ["/usr/sbin/openvpn",
+                                               "--proto", "udp" if self.VIDEO_TRANSPORT == RTP else "tcp-server",
+                                               "--dev-type", "tun",
+                                               "--dev", self.VPN_INTERFACE,
+                                               "--resolv-retry", "infinite",
+                                               "--ifconfig", self.BIND_ADDRESS, self.CLIENT_ADDRESS,
+                                               "--persist-key", "--persist-tun",
+                                               "--secret", self.KEY_FILE,
+                                               "--keepalive", "2", "5",
+                                               "--verb", "1"])
 
     def fly(self):
+        # Nothing to poll, the supervisor watches the processes
         while not self.shutdown:
             try:
                 time.sleep(1)
-                self._check_vpn()
             except KeyboardInterrupt:
                 self.shutdown = True
 
         self.stop()
 
     def stop(self):
-        self.control.stop()
-        self.control_server.shutdown()
-        self._control_server_thread.join()
-        self.vpn_proc.terminate()
+        # Also after a failed startup, so only what came up
+        if self.control is not None:
+            self.control.stop()
+        if self._control_server_thread is not None:
+            self.control_server.shutdown()
+            self._control_server_thread.join()
+        if self.sensors is not None:
+            self.sensors.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.supervisor.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        for name, stats in self.supervisor.to_json().items():
+            if stats["starts"]:
+                print("{}: {} restarts, up {:.0f} s".format(name, stats["restarts"], stats["uptime"]))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Reads a flight log written by the FlightRecorder and
+#   dump:    prints it as CSV
+#   control: runs the recorded inputs through ControlState again and reports ticks
+#            where the mixing now gives different outputs than in flight (compared
+#            before the slew limit), --calibration to try a calibration file before
+#            flying it
+#   client:  sends it as telemetry to a client, which displays it like a live flight
+# at the original speed, --speed 4 for 4x, --speed 0 for as fast as possible.
+import argparse
+import csv
+import socket
+import sys
+import time
+
+import protocol
+from control import ControlState
+from mixer import Mixer
+from recorder import FlightLog, Record
+
+
+def paced(records, speed):
+    start = None
+    first = None
+    for record in records:
+        if speed > 0:
+            if start is None:
+                start, first = time.monotonic(), record.time
+            delay = (record.time - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        yield record
+
+
+def dump(log, args):
+    writer = csv.writer(sys.stdout)
+    writer.writerow(Record._fields)
+    for record in log:
+        writer.writerow(record)
+
+
+def replay_control(log, args):
+    if args.calibration:
+        ControlState.MIXER = Mixer.load(args.calibration)
+    mismatches = 0
+    for index, record in enumerate(paced(log, args.speed)):
+        state = ControlState(record.throttle, record.yaw, record.climb, seq=record.seq)
+        expected = (record.motor_left, record.motor_right, record.servo_pitch)
+        actual = (state.motor_left, state.motor_right, state.servo_pitch)
+        if any(abs(a - e) > args.tolerance for a, e in zip(actual, expected)):
+            mismatches += 1
+            print("#{} seq {}: recorded L:{:.4f} R:{:.4f} P:{:.4f}, now {}".format(index, record.seq, *expected, state))
+    print("{} of {} records differ".format(mismatches, len(log)))
+    return 1 if mismatches else 0
+
+
+def replay_client(log, args):
+    host, _, port = args.client.rpartition(":")
+    address = (host, int(port))
+    codec = protocol.Codec()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for seq, record in enumerate(paced(log, args.speed), 1):
+        telemetry = protocol.Telemetry(record.applied_motor_left, record.applied_servo_pitch,
+                                       record.throttle, record.yaw, record.climb,
+                                       record.motor_left, record.motor_right, record.servo_pitch,
+                                       record.wifi_rssi, False,
+                                       seq, 0, 0, record.loop_jitter, record.loop_jitter, record.loop_duration,
+                                       record.seq, 0.0, record.time,
+                                       record.failsafe, 0, 0.0, 0.0,
+                                       0.0, 0.0, 0.0, 0.0, 0.0, True)
+        sender.sendto(codec.encode_telemetry(seq, telemetry, timestamp=record.time), address)
+    sender.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log")
+    parser.add_argument("mode", choices=["dump", "control", "client"])
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 0 for as fast as possible")
+    parser.add_argument("--client", default="172.31.31.34:8081", help="host:port of the client for mode client")
+    parser.add_argument("--calibration", help="Mixer calibration file for mode control")
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="Allowed PWM difference for mode control")
+    args = parser.parse_args()
+
+    log = FlightLog(args.log)
+    if args.mode == "dump":
+        return dump(log, args)
+    if args.mode == "control":
+        return replay_control(log, args)
+    return replay_client(log, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
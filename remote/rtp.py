@@ -0,0 +1,244 @@
+# Shared between remote and client (client/rtp.py links here).
+#
+# H.264 over UDP: every access unit is cut into datagrams of at most MTU bytes.
+# Each datagram has an RTP header (sequence number, 90 kHz timestamp, marker on the
+# last packet of a frame) followed by a small frame header, so the receiver knows
+# which frame a packet belongs to and how many packets make the frame complete.
+# After every FEC_GROUP packets of a frame (and after its last one) an XOR parity
+# packet follows, which restores any single lost packet of its group.
+import struct
+import time
+
+from h264 import NAL_IDR, NAL_SPS, START_CODE
+
+RTP_VERSION = 2
+PAYLOAD_H264 = 96
+PAYLOAD_FEC = 97
+
+RTP_HEADER = struct.Struct("!BBHII")        # version/flags, marker/payload type, seq, timestamp, ssrc
+FRAME_HEADER = struct.Struct("!HHHB")       # frame number, packet index, packet count, flags
+FEC_HEADER = struct.Struct("!HHHH")         # frame number, first index, packets in group, xor of lengths
+HEADER_SIZE = RTP_HEADER.size + FRAME_HEADER.size
+
+FLAG_KEY = 0x01
+
+# Video transports: the H.264 byte stream over TCP, or this packetization over UDP
+TCP = "tcp"
+RTP = "rtp"
+
+CLOCK_RATE = 90000
+MTU = 1200
+FEC_GROUP = 8
+
+
+def is_key(unit):
+    # Whether an access unit contains an IDR slice or SPS
+    pos = unit.find(START_CODE)
+    while 0 <= pos < len(unit) - 3:
+        if unit[pos + 3] & 0x1F in (NAL_IDR, NAL_SPS):
+            return True
+        pos = unit.find(START_CODE, pos + 3)
+    return False
+
+
+def newer(a, b, bits=16):
+    # Serial number arithmetic: a comes after b
+    half = 1 << (bits - 1)
+    return 0 < (a - b) & ((1 << bits) - 1) < half
+
+
+class Packetizer:
+    def __init__(self, ssrc=0x41495253, mtu=MTU, fec_group=FEC_GROUP):
+        self.ssrc = ssrc
+        self.payload_size = mtu - HEADER_SIZE
+        self.fec_group = fec_group
+        self.seq = 0
+        self.frame = 0
+
+    def _rtp_header(self, payload_type, timestamp, marker):
+        header = RTP_HEADER.pack(RTP_VERSION << 6, (0x80 if marker else 0) | payload_type,
+                                 self.seq, timestamp, self.ssrc)
+        self.seq = (self.seq + 1) & 0xFFFF
+        return header
+
+    def packetize(self, unit, key=None, now=None):
+        # Datagrams for one access unit, media and FEC interleaved in sending order
+        unit = bytes(unit)
+        key = is_key(unit) if key is None else key
+        timestamp = int((time.monotonic() if now is None else now) * CLOCK_RATE) & 0xFFFFFFFF
+        chunks = [unit[i:i + self.payload_size] for i in range(0, len(unit), self.payload_size)] or [b""]
+        count = len(chunks)
+
+        packets = []
+        for start in range(0, count, self.fec_group):
+            group = chunks[start:start + self.fec_group]
+            for index, chunk in enumerate(group, start):
+                header = self._rtp_header(PAYLOAD_H264, timestamp, index == count - 1)
+                packets.append(header + FRAME_HEADER.pack(self.frame, index, count, FLAG_KEY if key else 0)
+                               + chunk)
+            if self.fec_group > 1 and len(group) > 1:
+                parity, lengths = xor_chunks(group)
+                packets.append(self._rtp_header(PAYLOAD_FEC, timestamp, False)
+                               + FEC_HEADER.pack(self.frame, start, len(group), lengths) + parity)
+        self.frame = (self.frame + 1) & 0xFFFF
+        return packets
+
+
+def xor_chunks(chunks):
+    size = max(len(chunk) for chunk in chunks)
+    parity = 0
+    lengths = 0
+    for chunk in chunks:
+        # Python integers XOR whole buffers at once, much faster than a loop over bytes
+        parity ^= int.from_bytes(chunk.ljust(size, b"\0"), "big")
+        lengths ^= len(chunk)
+    return parity.to_bytes(size, "big"), lengths
+
+
+class Frame:
+    def __init__(self, count, key, arrival):
+        self.count = count
+        self.key = key
+        self.arrival = arrival
+        self.chunks = {}
+        self.parity = {}            # first index -> (group size, xor of lengths, parity)
+
+    def complete(self):
+        return len(self.chunks) == self.count
+
+    def recover(self):
+        # Rebuilds single losses from parity, returns the number of rebuilt packets
+        recovered = 0
+        for first, (size, lengths, parity) in list(self.parity.items()):
+            missing = [i for i in range(first, first + size) if i not in self.chunks]
+            if len(missing) != 1:
+                continue
+            present = [self.chunks[i] for i in range(first, first + size) if i in self.chunks]
+            data, length = xor_chunks(present + [parity])
+            # The parity itself went into the length XOR, take it out again
+            length ^= len(parity) ^ lengths
+            self.chunks[missing[0]] = data[:length]
+            del self.parity[first]
+            recovered += 1
+        return recovered
+
+    def data(self):
+        return b"".join(self.chunks[i] for i in range(self.count))
+
+
+class RtpStats:
+    def __init__(self):
+        self.packets = 0
+        self.lost = 0
+        self.recovered = 0
+        self.late = 0
+        self.frames = 0
+        self.frames_dropped = 0
+        self.frames_skipped = 0
+
+    def to_json(self):
+        return dict(vars(self))
+
+
+# Collects packets into frames and hands out complete frames in order. A frame that
+# is still incomplete latency seconds after its first packet arrived is dropped
+# instead of stalling the frames behind it; until the next keyframe the following
+# frames are skipped too, they would only decode to garbage without their reference.
+class JitterBuffer:
+    LATENCY = 0.05
+    RESTART_DISTANCE = 1000
+
+    def __init__(self, latency=LATENCY):
+        self.latency = latency
+        self.stats = RtpStats()
+        self.frames = {}
+        self.next_frame = None
+        self.waiting_for_key = True
+        self._last_seq = None
+
+    def add(self, packet, now=None):
+        # Returns the complete frames as (access unit, is keyframe)
+        now = time.monotonic() if now is None else now
+        if len(packet) < RTP_HEADER.size:
+            return []
+        flags, payload_type, seq, _, _ = RTP_HEADER.unpack_from(packet)
+        if flags >> 6 != RTP_VERSION:
+            return []
+        self._count_sequence(seq)
+
+        payload_type &= 0x7F
+        if payload_type == PAYLOAD_H264 and len(packet) >= HEADER_SIZE:
+            number, index, count, frame_flags = FRAME_HEADER.unpack_from(packet, RTP_HEADER.size)
+            frame = self._frame(number, count, frame_flags & FLAG_KEY, now)
+            if frame is not None:
+                frame.chunks[index] = packet[HEADER_SIZE:]
+        elif payload_type == PAYLOAD_FEC and len(packet) >= RTP_HEADER.size + FEC_HEADER.size:
+            number, first, size, lengths = FEC_HEADER.unpack_from(packet, RTP_HEADER.size)
+            frame = self._frame(number, None, False, now)
+            if frame is not None:
+                frame.parity[first] = (size, lengths, packet[RTP_HEADER.size + FEC_HEADER.size:])
+        else:
+            return []
+
+        if frame is not None and frame.count is not None and not frame.complete():
+            self.stats.recovered += frame.recover()
+        return self.poll(now)
+
+    def _count_sequence(self, seq):
+        self.stats.packets += 1
+        if self._last_seq is None:
+            self._last_seq = seq
+        elif newer(seq, self._last_seq):
+            self.stats.lost += (seq - self._last_seq - 1) & 0xFFFF
+            self._last_seq = seq
+        elif seq != self._last_seq and self.stats.lost:
+            # Reordered, it was counted as lost when the gap showed up
+            self.stats.lost -= 1
+
+    def _frame(self, number, count, key, now):
+        if self.next_frame is not None and self.RESTART_DISTANCE < (self.next_frame - number) & 0xFFFF < 0x8000:
+            # Far behind: the sender started over, not a late packet
+            self.frames.clear()
+            self.next_frame = None
+            self.waiting_for_key = True
+        if self.next_frame is None:
+            self.next_frame = number
+        elif number != self.next_frame and not newer(number, self.next_frame):
+            # Parity of a frame that was complete without it is no news
+            if count is not None:
+                self.stats.late += 1
+            return None
+        frame = self.frames.get(number)
+        if frame is None:
+            frame = self.frames[number] = Frame(count, key, now)
+        elif frame.count is None and count is not None:
+            # Only parity arrived so far
+            frame.count, frame.key = count, key
+        return frame
+
+    def poll(self, now=None):
+        # Frames that are due, call regularly to expire incomplete frames
+        now = time.monotonic() if now is None else now
+        ready = []
+        while self.frames:
+            frame = self.frames.get(self.next_frame)
+            if frame is not None and frame.count is not None and frame.complete():
+                del self.frames[self.next_frame]
+                self.next_frame = (self.next_frame + 1) & 0xFFFF
+                if self.waiting_for_key and not frame.key:
+                    self.stats.frames_skipped += 1
+                    continue
+                self.waiting_for_key = False
+                self.stats.frames += 1
+                ready.append((frame.data(), frame.key))
+                continue
+
+            # Give up on the next frame once the oldest waiting frame is overdue
+            oldest = min(f.arrival for f in self.frames.values())
+            if now - oldest < self.latency:
+                break
+            self.frames.pop(self.next_frame, None)
+            self.stats.frames_dropped += 1
+            self.waiting_for_key = True
+            self.next_frame = (self.next_frame + 1) & 0xFFFF
+        return ready
@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+class LoopStats:
+    def __init__(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self.mean_jitter = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    def record(self, jitter, duration, period):
+        self.ticks += 1
+        self.last_jitter = jitter
+        self.max_jitter = max(self.max_jitter, jitter)
+        # Running mean, cheap enough to update on every tick
+        self.mean_jitter += (jitter - self.mean_jitter) / self.ticks
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        if duration > period:
+            self.overruns += 1
+
+    def to_json(self):
+        return {"ticks": self.ticks,
+                "overruns": self.overruns,
+                "skipped": self.skipped,
+                "last_jitter": self.last_jitter,
+                "max_jitter": self.max_jitter,
+                "mean_jitter": self.mean_jitter,
+                "last_duration": self.last_duration,
+                "max_duration": self.max_duration}
+
+
+# Runs callback at a fixed rate on one long-lived thread. Deadlines sit on a fixed
+# time.monotonic() grid, so a slow tick does not shift all following ticks.
+# If whole periods were missed, SKIP drops them and realigns, CATCH_UP runs them back to back.
+class LoopScheduler:
+    SKIP = "skip"
+    CATCH_UP = "catch_up"
+
+    def __init__(self, hertz, callback, overrun_policy=SKIP, name="control-loop"):
+        if hertz <= 0:
+            raise ValueError("Loop rate must be positive, got {}".format(hertz))
+        if overrun_policy not in (self.SKIP, self.CATCH_UP):
+            raise ValueError("Unknown overrun policy {}".format(overrun_policy))
+
+        self.period = 1.0 / hertz
+        self.callback = callback
+        self.overrun_policy = overrun_policy
+        self.stats = LoopStats()
+        # How late the running tick started, for the callback
+        self.lateness = 0.0
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            if deadline > now:
+                if self._stop_event.wait(deadline - now):
+                    break
+                now = time.monotonic()
+
+            late = now - deadline
+            if late >= self.period and self.overrun_policy == self.SKIP:
+                missed = int(late // self.period)
+                deadline += missed * self.period
+                self.stats.skipped += missed
+                late -= missed * self.period
+
+            self.lateness = late
+            try:
+                self.callback()
+            except Exception as e:
+                print("Exception in {}: {}".format(self._thread.name, e))
+
+            self.stats.record(late, time.monotonic() - now, self.period)
+            deadline += self.period
@@ -0,0 +1,259 @@
+# Shared between remote and client (client/secure.py links here).
+#
+# Authenticated control channel straight over UDP, without the VPN. Both ends hold
+# the same pre-shared key (the OpenVPN static key secret.key). Bring-up is one round
+# trip: the client sends HELLO with a random nonce, the remote answers WELCOME with
+# its own, both authenticated with the key. Session keys for each direction are
+# derived from the key and both nonces, so packet counters start at 0 in every
+# session without ever reusing a nonce. Every DATA packet carries a 64 bit counter
+# and is sealed with ChaCha20-Poly1305; a sliding window rejects replays.
+#
+#   HELLO:   0xC1 | client nonce (16) | HMAC-SHA256 (32)
+#   WELCOME: 0xC2 | session id (4) | client nonce (16) | server nonce (16) | HMAC-SHA256 (32)
+#   DATA:    0xC3 | session id (4) | counter (8) | ciphertext | tag (16)
+# The inner packets are the ones of protocol.py.
+import binascii
+import hashlib
+import hmac
+import os
+import struct
+import time
+from collections import deque
+
+HELLO = 0xC1
+WELCOME = 0xC2
+DATA = 0xC3
+
+NONCE_SIZE = 16
+MAC_SIZE = 32
+TAG_SIZE = 16
+DATA_HEADER = struct.Struct("!BIQ")         # type, session id, counter
+HELLO_SIZE = 1 + NONCE_SIZE + MAC_SIZE
+WELCOME_SIZE = 5 + 2 * NONCE_SIZE + MAC_SIZE
+REPLAY_WINDOW = 64
+
+CLIENT_TO_SERVER = b"client->remote"
+SERVER_TO_CLIENT = b"remote->client"
+
+KEY_FILE = "secret.key"
+
+# Control transports: through the VPN, or directly with this channel
+VPN = "vpn"
+DIRECT = "direct"
+
+
+class SecurityError(ValueError):
+    pass
+
+
+def load_key(path=KEY_FILE):
+    # The hex lines of an OpenVPN static key file, or raw bytes of any other file
+    with open(path, "rb") as f:
+        content = f.read()
+    if b"BEGIN OpenVPN Static key" in content:
+        lines = [line.strip() for line in content.splitlines()]
+        start = lines.index(b"-----BEGIN OpenVPN Static key V1-----") + 1
+        end = lines.index(b"-----END OpenVPN Static key V1-----")
+        return binascii.unhexlify(b"".join(lines[start:end]))
+    if len(content) < 32:
+        raise SecurityError("Key in {} is too short".format(path))
+    return content
+
+
+def write_key(path):
+    # A new key in the format of openvpn --genkey
+    hexed = binascii.hexlify(os.urandom(256))
+    with open(path, "wb") as f:
+        f.write(b"-----BEGIN OpenVPN Static key V1-----\n")
+        for i in range(0, len(hexed), 32):
+            f.write(hexed[i:i + 32] + b"\n")
+        f.write(b"-----END OpenVPN Static key V1-----\n")
+    os.chmod(path, 0o600)
+
+
+def _hkdf(key, salt, info, length=32):
+    # RFC 5869 with SHA-256, one block is all that is needed
+    prk = hmac.new(salt, key, hashlib.sha256).digest()
+    return hmac.new(prk, info + b"\x01", hashlib.sha256).digest()[:length]
+
+
+class ReplayWindow:
+    def __init__(self, size=REPLAY_WINDOW):
+        self.size = size
+        self.highest = -1
+        self.bitmap = 0
+
+    def check(self, counter):
+        # Whether the counter is new, call update() only once the packet authenticated
+        if counter > self.highest:
+            return True
+        offset = self.highest - counter
+        return offset < self.size and not self.bitmap >> offset & 1
+
+    def update(self, counter):
+        if counter > self.highest:
+            shift = counter - self.highest
+            self.bitmap = (self.bitmap << shift | 1) & ((1 << self.size) - 1) if shift < self.size else 1
+            self.highest = counter
+        else:
+            self.bitmap |= 1 << (self.highest - counter)
+
+
+class Session:
+    def __init__(self, psk, session_id, client_nonce, server_nonce, is_server):
+        salt = client_nonce + server_nonce
+        send_info, receive_info = (SERVER_TO_CLIENT, CLIENT_TO_SERVER) if is_server else \
+            (CLIENT_TO_SERVER, SERVER_TO_CLIENT)
+        self.session_id = session_id
+        # Imported with the first session, a client over the VPN never loads cryptography
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+        self._invalid_tag = InvalidTag
+        self._send_cipher = ChaCha20Poly1305(_hkdf(psk, salt, send_info))
+        self._receive_cipher = ChaCha20Poly1305(_hkdf(psk, salt, receive_info))
+        self._send_counter = 0
+        self._window = ReplayWindow()
+
+    def seal(self, data):
+        header = DATA_HEADER.pack(DATA, self.session_id, self._send_counter)
+        nonce = b"\0\0\0\0" + header[5:]
+        self._send_counter += 1
+        return header + self._send_cipher.encrypt(nonce, bytes(data), header)
+
+    def open(self, packet):
+        if len(packet) < DATA_HEADER.size + TAG_SIZE:
+            raise SecurityError("Packet too short")
+        type_, session_id, counter = DATA_HEADER.unpack_from(packet)
+        if session_id != self.session_id:
+            raise SecurityError("Unknown session {:08x}".format(session_id))
+        if not self._window.check(counter):
+            raise SecurityError("Replayed packet {}".format(counter))
+        header = bytes(packet[:DATA_HEADER.size])
+        try:
+            data = self._receive_cipher.decrypt(b"\0\0\0\0" + header[5:], bytes(packet[DATA_HEADER.size:]), header)
+        except self._invalid_tag:
+            raise SecurityError("Authentication failed")
+        self._window.update(counter)
+        return data
+
+
+class SecureStats:
+    def __init__(self):
+        self.handshakes = 0
+        self.rejected = 0
+        self.handshake_time = None
+
+    def to_json(self):
+        return dict(vars(self))
+
+
+class ClientChannel:
+    HANDSHAKE_INTERVAL = 0.25
+
+    def __init__(self, psk):
+        self.psk = psk
+        self.session = None
+        self.stats = SecureStats()
+        self._nonce = None
+        self._hello_time = None
+
+    def hello(self, now=None):
+        self._nonce = os.urandom(NONCE_SIZE)
+        self._hello_time = time.monotonic() if now is None else now
+        message = bytes([HELLO]) + self._nonce
+        return message + hmac.new(self.psk, message, hashlib.sha256).digest()
+
+    def open(self, packet, now=None):
+        # The inner packet, or None for a completed handshake
+        if len(packet) and packet[0] == WELCOME:
+            self._welcome(bytes(packet), now)
+            return None
+        if self.session is None:
+            raise SecurityError("No session yet")
+        try:
+            return self.session.open(packet)
+        except SecurityError as e:
+            self.stats.rejected += 1
+            raise e
+
+    def _welcome(self, packet, now):
+        if len(packet) != WELCOME_SIZE or self._nonce is None:
+            raise SecurityError("Unexpected WELCOME")
+        message, mac = packet[:-MAC_SIZE], packet[-MAC_SIZE:]
+        if not hmac.compare_digest(mac, hmac.new(self.psk, message, hashlib.sha256).digest()):
+            self.stats.rejected += 1
+            raise SecurityError("WELCOME authentication failed")
+        session_id, = struct.unpack_from("!I", message, 1)
+        client_nonce, server_nonce = message[5:5 + NONCE_SIZE], message[5 + NONCE_SIZE:]
+        if client_nonce != self._nonce:
+            raise SecurityError("WELCOME for another HELLO")
+        self.session = Session(self.psk, session_id, client_nonce, server_nonce, is_server=False)
+        self._nonce = None
+        self.stats.handshakes += 1
+        self.stats.handshake_time = (time.monotonic() if now is None else now) - self._hello_time
+
+    def seal(self, data):
+        return self.session.seal(data)
+
+
+# The remote side. An authenticated HELLO only creates a pending session, which
+# replaces the running one with the first DATA packet sealed with its keys: a replayed
+# HELLO cannot tear down the running session, a restarted client is back within one
+# round trip. Clients draw a new nonce for every HELLO, one seen before is a replay
+# and must not replace the pending session of a client that is connecting.
+class ServerChannel:
+    # Nonces remembered, over an hour of a client retrying every HANDSHAKE_INTERVAL
+    NONCE_HISTORY = 16384
+
+    def __init__(self, psk):
+        self.psk = psk
+        self.session = None
+        self.stats = SecureStats()
+        self._pending = None
+        self._nonces = set()
+        self._nonce_order = deque()
+
+    def open(self, packet):
+        # (inner packet or None, reply to send or None)
+        if len(packet) and packet[0] == HELLO:
+            return None, self._hello(bytes(packet))
+        session = self.session
+        if self._pending is not None and len(packet) >= DATA_HEADER.size and \
+                DATA_HEADER.unpack_from(packet)[1] == self._pending.session_id:
+            session = self._pending
+        if session is None:
+            self.stats.rejected += 1
+            raise SecurityError("No session yet")
+        try:
+            data = session.open(packet)
+        except SecurityError as e:
+            self.stats.rejected += 1
+            raise e
+        if session is self._pending:
+            self.session, self._pending = session, None
+        return data, None
+
+    def _hello(self, packet):
+        if len(packet) != HELLO_SIZE:
+            raise SecurityError("Bad HELLO")
+        message, mac = packet[:-MAC_SIZE], packet[-MAC_SIZE:]
+        if not hmac.compare_digest(mac, hmac.new(self.psk, message, hashlib.sha256).digest()):
+            self.stats.rejected += 1
+            raise SecurityError("HELLO authentication failed")
+        client_nonce = message[1:]
+        if client_nonce in self._nonces:
+            self.stats.rejected += 1
+            raise SecurityError("Replayed HELLO")
+        self._nonces.add(client_nonce)
+        self._nonce_order.append(client_nonce)
+        if len(self._nonce_order) > self.NONCE_HISTORY:
+            self._nonces.discard(self._nonce_order.popleft())
+        server_nonce = os.urandom(NONCE_SIZE)
+        session_id = struct.unpack("!I", os.urandom(4))[0]
+        self._pending = Session(self.psk, session_id, client_nonce, server_nonce, is_server=True)
+        self.stats.handshakes += 1
+        reply = bytes([WELCOME]) + struct.pack("!I", session_id) + client_nonce + server_nonce
+        return reply + hmac.new(self.psk, reply, hashlib.sha256).digest()
+
+    def seal(self, data):
+        return self.session.seal(data)
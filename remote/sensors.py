@@ -2,60 +2,184 @@ import subprocess
 import threading
 import time
 import re
+from collections import namedtuple
+
+from imu import I2cBus, Imu
+from rtp import RTP
+from streaming import RtpVideoStreamer, VideoStreamer
+
+Reading = namedtuple("Reading", ["value", "timestamp", "stale"])
+
+
+class ProcWirelessSource:
+    # Reads the link level straight from the kernel, no subprocess involved
+    def __init__(self, interface="wlan0", path="/proc/net/wireless"):
+        self.interface = interface
+        self.path = path
+
+    def read(self):
+        with open(self.path) as f:
+            for line in f:
+                name, _, fields = line.partition(":")
+                if name.strip() == self.interface:
+                    # status, link quality, signal level, noise, ...
+                    return int(float(fields.split()[2]))
+        return None
+
+
+class IwSource:
+    # Fallback for drivers that do not report to /proc/net/wireless
+    def __init__(self, interface="wlan0"):
+        self.interface = interface
+
+    def read(self):
+        wifi_link = subprocess.check_output(["/sbin/iw", "dev", self.interface, "link"])
+        match = re.search(r'Signal: (-?\d+) dBm', str(wifi_link, 'utf-8'))
+        if match:
+            return int(match.group(1))
+
+
+class Sampler:
+    # Polls a source on its own thread; readers only ever get the cached value
+    def __init__(self, source, interval=0.5, max_age=2.0, name="sampler"):
+        self.source = source
+        self.interval = interval
+        self.max_age = max_age
+        self.errors = 0
+
+        self._latest = (None, 0.0)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def latest(self):
+        value, timestamp = self._latest
+        return Reading(value, timestamp, time.monotonic() - timestamp > self.max_age)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                value = self.source.read()
+                if value is not None:
+                    self._latest = (value, time.monotonic())
+            except (OSError, ValueError, IndexError, subprocess.CalledProcessError) as e:
+                self.errors += 1
+                if self.errors == 1:
+                    print("Error while sampling {}: {}".format(self._thread.name, e))
+            self._stop_event.wait(self.interval)
+
+
+def default_rssi_source(interface="wlan0"):
+    proc_source = ProcWirelessSource(interface)
+    try:
+        if proc_source.read() is not None:
+            return proc_source
+    except (OSError, ValueError, IndexError):
+        pass
+    return IwSource(interface)
 
 
 class Sensors:
-    def __init__(self, remote):
-        #TODO: IMU?
+    RSSI_INTERVAL = 0.5
+
+    def __init__(self, remote, rssi_source=None, imu=None):
         self.remote = remote
 
-        self._create_camera()
+        self.rssi_sampler = Sampler(rssi_source or default_rssi_source(), interval=self.RSSI_INTERVAL, name="rssi")
+        self.rssi_sampler.start()
 
-        self._camera_stream_thread = threading.Thread(target=self._stream_video)
+        self.imu = self._create_imu() if imu is None else imu
+        if self.imu is not None:
+            self.imu.start()
+
+        self._stopped = False
+        streamer = RtpVideoStreamer if remote.VIDEO_TRANSPORT == RTP else VideoStreamer
+        self.video_streamer = streamer((remote.CLIENT_ADDRESS, remote.VIDEO_PORT), self.rssi_sampler,
+                                       supervisor=remote.supervisor)
+        self._camera_stream_thread = threading.Thread(target=self._stream_video, name="video-stream")
         self._camera_stream_thread.daemon = True
+        self._add_metrics(remote.metrics)
+
+    def _add_metrics(self, metrics):
+        self._stream_connections = metrics.counter("video_connections_total", "Video streams started")
+        self._stream_errors = metrics.counter("video_stream_errors_total", "Video streams ended by an error")
+        self._stream_seconds = metrics.histogram("video_stream_seconds", "How long each video stream lasted",
+                                                 buckets=(1, 10, 60, 300, 1800))
+        streamer = self.video_streamer
+        metrics.collect("video_capture_restarts_total", "Camera captures that had to be restarted",
+                        lambda: streamer.capture_restarts, type="counter")
+        if isinstance(streamer, RtpVideoStreamer):
+            metrics.collect("video_packets_sent_total", "RTP video datagrams sent",
+                            lambda: streamer.packets_sent, type="counter")
+            metrics.collect("video_packets_dropped_total", "RTP video datagrams dropped at the socket",
+                            lambda: streamer.packets_dropped, type="counter")
+        metrics.collect("wifi_rssi_dbm", "Last WiFi signal level", lambda: self.get_wifi_rssi().value)
+        metrics.collect("rssi_errors_total", "Failed RSSI reads", lambda: self.rssi_sampler.errors, type="counter")
+
+    def _create_imu(self):
+        if self.remote.IMU_BUS is None:
+            return None
+        try:
+            bus = I2cBus(self.remote.IMU_BUS)
+        except OSError as e:
+            print("Flying without IMU: {}".format(e))
+            return None
+        try:
+            return Imu(bus, metrics=self.remote.metrics)
+        except OSError as e:
+            bus.close()
+            print("Flying without IMU: {}".format(e))
+
+    def start_video(self):
+        # Separate from __init__, the camera is the slowest part of the startup
+        self._create_camera()
         self._camera_stream_thread.start()
 
-    @staticmethod
-    def _create_camera():
-        subprocess.call(['modprobe', 'bcm2835-v4l2'])
-        ret = subprocess.call(["v4l2-ctl", "-v", "width=1280,height=720,pixelformat=H264",
-                               "--set-ctrl=exposure_dynamic_framerate=1",
-                               "--set-ctrl=video_bitrate=1000000",
-                               "--set-ctrl=scene_mode=8"])
-        return ret
+    def _create_camera(self):
+        return self.video_streamer.setup()
+
+    def _streaming(self):
+        return not (self.remote.shutdown or self._stopped)
 
     def _stream_video(self):
-        proc = None
-        while not self.remote.shutdown:
+        while self._streaming():
             try:
-                if proc is None:
-                    check_ip = subprocess.check_output(["ip", "ro"])
-                    if str(check_ip).find(self.remote.BIND_ADDRESS):
-                        proc = subprocess.Popen(["/usr/bin/raspivid","-t", "0", "-fps", "60",
-                                                 "-h", "720", "-w", "1280",
-                                                 "-o", "tcp://{}:{}".format(self.remote.CLIENT_ADDRESS,
-                                                                            self.remote.VIDEO_PORT)],
-                                                stdout=subprocess.DEVNULL)
-
-                time.sleep(0.5)
-                proc.poll()
-                if proc.returncode:
-                    proc = None
-
+                check_ip = subprocess.check_output(["ip", "ro"])
+                if self.remote.BIND_ADDRESS in str(check_ip):
+                    self._stream_connections.inc()
+                    start = time.monotonic()
+                    try:
+                        self.video_streamer.stream(self._streaming)
+                    finally:
+                        self._stream_seconds.observe(time.monotonic() - start)
             except subprocess.CalledProcessError as e:
+                self._stream_errors.inc()
                 print("CalledProcessError while streaming: {}".format(e))
-                proc = None
             except KeyboardInterrupt:
                 break
             except Exception as e:
+                self._stream_errors.inc()
                 print("Exception while streaming: {}".format(e))
-                proc = None
-        if proc:
-            proc.terminate()
+            time.sleep(0.5)
+
+    def get_wifi_rssi(self):
+        return self.rssi_sampler.latest()
+
+    def get_attitude(self):
+        # (imu.Attitude or None, stale)
+        if self.imu is None:
+            return None, True
+        return self.imu.latest()
+
+    def stop(self):
+        self._stopped = True
+        self.rssi_sampler.stop()
+        if self.imu is not None:
+            self.imu.stop()
 
-    @staticmethod
-    def get_wifi_rssi():
-        wifi_link = subprocess.check_output(["/sbin/iw",  "dev", "wlan0", "link"])
-        match = re.search(r'Signal: (-?\d+) dBm', str(wifi_link, 'utf-8'))
-        if match:
-            return match.group(1)
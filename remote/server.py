@@ -0,0 +1,249 @@
+import asyncio
+import time
+
+import protocol
+from control import ControlState
+from metrics import Registry, encode_snapshot
+from publisher import TelemetryPublisher
+from secure import SecurityError
+from streaming import IPTOS_LOWDELAY, PRIORITY_INTERACTIVE, set_priority
+
+
+class ServerStats:
+    def __init__(self):
+        self.packets = 0
+        self.commands = 0
+        self.stale = 0
+        self.decode_errors = 0
+        self.unauthenticated = 0
+        self.telemetry_sent = 0
+        self.processing_time = 0.0
+        self.max_processing_time = 0.0
+
+    def record(self, duration):
+        self.commands += 1
+        self.processing_time += duration
+        self.max_processing_time = max(self.max_processing_time, duration)
+
+    def to_json(self):
+        return {"packets": self.packets,
+                "commands": self.commands,
+                "stale": self.stale,
+                "decode_errors": self.decode_errors,
+                "unauthenticated": self.unauthenticated,
+                "telemetry_sent": self.telemetry_sent,
+                "mean_processing_time": self.processing_time / self.commands if self.commands else 0.0,
+                "max_processing_time": self.max_processing_time}
+
+
+# Single-threaded control server: commands are decoded inline in the event loop,
+# and telemetry is sent from a periodic task on the same loop.
+class ControlServer(asyncio.DatagramProtocol):
+    TELEMETRY_HERTZ = 50
+    # After this long without a command any sequence number is accepted again, so a
+    # restarted client does not get ignored
+    SEQUENCE_RESET_TIMEOUT = 1.0
+
+    def __init__(self, control=None, sensors=None, telemetry_hertz=TELEMETRY_HERTZ, channel=None, metrics=None):
+        self.control = control
+        self.sensors = sensors
+        # secure.ServerChannel when the client talks to us directly instead of through the VPN
+        self.channel = channel
+        self.telemetry_period = 1.0 / telemetry_hertz
+
+        self.codec = protocol.Codec()
+        self.stats = ServerStats()
+        self.transport = None
+        self.client_address = None
+        # Telemetry is answered in the encoding of the last received command
+        self.client_encoding = protocol.BINARY
+        self.last_seq = None
+        self.last_command_time = 0.0
+        self.telemetry_seq = 0
+
+        # Observers subscribing next to the pilot's station
+        self.publisher = TelemetryPublisher(telemetry_hertz, self._send_to)
+
+        self.metrics = Registry() if metrics is None else metrics
+        self._add_metrics()
+
+        self.loop = asyncio.new_event_loop()
+        self._telemetry_task = None
+
+    def _add_metrics(self):
+        # Counted in ServerStats and PublisherStats already, read on a scrape
+        stats, publisher = self.stats, self.publisher.stats
+        for name, help in [("packets", "Datagrams received on the control socket"),
+                           ("commands", "Commands applied"),
+                           ("stale", "Commands dropped as duplicate or out of order"),
+                           ("decode_errors", "Packets that did not decode"),
+                           ("unauthenticated", "Packets dropped by the direct channel"),
+                           ("telemetry_sent", "Telemetry packets sent to the pilot")]:
+            self.metrics.collect("server_{}_total".format(name), help,
+                                 lambda name=name: getattr(stats, name), type="counter")
+        self.metrics.collect("publisher_subscribers", "Subscribed observers", lambda: len(self.publisher.subscribers))
+        self.metrics.collect("publisher_sends_total", "Telemetry packets sent to observers",
+                             lambda: publisher.sends, type="counter")
+        self.metrics.collect("publisher_rejected_total", "Subscriptions rejected",
+                             lambda: publisher.rejected, type="counter")
+        self._command_seconds = self.metrics.histogram("server_command_seconds",
+                                                       "Decoding and applying one command")
+        self._telemetry_seconds = self.metrics.histogram("server_telemetry_seconds",
+                                                         "Producing and sending one telemetry tick")
+        self._metrics_requests = self.metrics.counter("server_metrics_requests_total",
+                                                      "Metrics queried over the control channel")
+        self._metrics_rejected = self.metrics.counter("server_metrics_rejected_total",
+                                                      "Metrics requests over the direct channel, not served")
+
+    def set_instances(self, control, sensors):
+        self.control = control
+        self.sensors = sensors
+
+    def bind(self, address):
+        self.loop.run_until_complete(self.loop.create_datagram_endpoint(lambda: self, local_addr=address))
+        # Ahead of the video stream in the kernel's queues
+        set_priority(self.transport.get_extra_info("socket"), IPTOS_LOWDELAY, PRIORITY_INTERACTIVE)
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self._telemetry_task = self.loop.create_task(self._telemetry_loop())
+        try:
+            self.loop.run_forever()
+        finally:
+            self._telemetry_task.cancel()
+            self.loop.run_until_complete(asyncio.gather(self._telemetry_task, return_exceptions=True))
+            if self.transport is not None:
+                self.transport.close()
+            self.loop.close()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        print("Error on control socket: {}".format(exc))
+
+    def datagram_received(self, data, address):
+        start = time.perf_counter()
+        self.stats.packets += 1
+        if self.channel is not None:
+            try:
+                data, reply = self.channel.open(data)
+            except SecurityError as e:
+                self.stats.unauthenticated += 1
+                if self.stats.unauthenticated == 1:
+                    print("Dropping packet from {}: {}".format(address, e))
+                return
+            if reply is not None:
+                self.transport.sendto(reply, address)
+                return
+        type_ = protocol.packet_type(data)
+        if type_ == protocol.SUBSCRIBE:
+            self._subscribe(data, address)
+            return
+        if type_ == protocol.METRICS_REQUEST:
+            self._send_metrics(data, address)
+            return
+        # Everything that can reject the packet before it may move the sequence or the client
+        try:
+            header, command = protocol.decode_command(data)
+            state = ControlState(command.throttle, command.yaw, command.climb,
+                                 seq=header.seq or 0, timestamp=header.timestamp or 0.0)
+        except protocol.ProtocolError as e:
+            self.stats.decode_errors += 1
+            print("Dropping packet from {}: {}".format(address, e))
+            return
+
+        if not self._accept_sequence(header.seq, address):
+            self.stats.stale += 1
+            return
+
+        self.client_address = address
+        self.client_encoding = protocol.BINARY if protocol.is_binary(data) else protocol.JSON
+        if self.control is not None:
+            self.control.set_state(state)
+        duration = time.perf_counter() - start
+        self.stats.record(duration)
+        self._command_seconds.observe(duration)
+
+    def _subscribe(self, data, address):
+        if self.channel is not None:
+            # Sealed telemetry is for the session's client only
+            self.publisher.stats.rejected += 1
+            return
+        try:
+            _, subscription = protocol.decode_subscribe(data)
+        except protocol.ProtocolError as e:
+            self.stats.decode_errors += 1
+            print("Dropping subscription from {}: {}".format(address, e))
+            return
+        self.publisher.subscribe(address, subscription)
+
+    def _send_metrics(self, data, address):
+        if self.channel is not None:
+            # Like subscriptions, only through the tunnel
+            self._metrics_rejected.inc()
+            return
+        try:
+            header, prefix = protocol.decode_metrics_request(data)
+        except protocol.ProtocolError as e:
+            self.stats.decode_errors += 1
+            print("Dropping metrics request from {}: {}".format(address, e))
+            return
+        self._metrics_requests.inc()
+        payload = encode_snapshot(self.metrics, prefix, protocol.MAX_METRICS_PAYLOAD)
+        self.transport.sendto(self.codec.encode_metrics(header.seq, payload), address)
+
+    def _send_to(self, data, address):
+        self.transport.sendto(data, address)
+
+    def _accept_sequence(self, seq, address):
+        now = time.monotonic()
+        if seq is not None and self.last_seq is not None and address == self.client_address \
+                and now - self.last_command_time < self.SEQUENCE_RESET_TIMEOUT:
+            # Serial number arithmetic, so the 32 bit counter may wrap around
+            delta = (seq - self.last_seq) & 0xFFFFFFFF
+            if delta == 0 or delta >= 0x80000000:
+                return False
+        self.last_seq = seq
+        self.last_command_time = now
+        return True
+
+    def send_telemetry(self):
+        if self.transport is None or self.control is None:
+            return
+        if self.client_address is None and not self.publisher.subscribers:
+            return
+        # Once per tick, however many receive it, the pilot's station first
+        start = time.perf_counter()
+        telemetry = self.control.get_telemetry()
+        if self.client_address is not None:
+            self._send_client_telemetry(telemetry)
+        self.publisher.publish(telemetry)
+        self._telemetry_seconds.observe(time.perf_counter() - start)
+
+    def _send_client_telemetry(self, telemetry):
+        self.telemetry_seq += 1
+        if self.client_encoding == protocol.BINARY:
+            data = self.codec.encode_telemetry(self.telemetry_seq, telemetry)
+        else:
+            data = protocol.telemetry_to_json(self.telemetry_seq, telemetry)
+        if self.channel is not None:
+            if self.channel.session is None:
+                return
+            data = self.channel.seal(data)
+
+        self.transport.sendto(data, self.client_address)
+        self.stats.telemetry_sent += 1
+
+    async def _telemetry_loop(self):
+        deadline = self.loop.time()
+        while True:
+            deadline += self.telemetry_period
+            await asyncio.sleep(max(0.0, deadline - self.loop.time()))
+            self.send_telemetry()
+            if self.loop.time() - deadline > self.telemetry_period:
+                # Don't burst out stale telemetry after a stall
+                deadline = self.loop.time()
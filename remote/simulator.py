@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# Airship physics in place of the hardware, for testing Control, the mixer and the
+# failsafe without the pi, ESC and servo.
+#
+# AirshipBatch integrates any number of independent airships as NumPy arrays: two
+# motors with spin-up lag, the servo vectoring the thrust up and down, quadratic drag,
+# static heaviness (buoyancy minus weight), yaw from differential thrust and pitch with
+# the pendulum stability of a gondola below the envelope. Every parameter may be a
+# scalar or one value per airship, for sweeps.
+#
+# SimulatedFlight runs the real Control (ControlState, mixer, failsafe, the gpiozero
+# PWMLED and Servo on mock pins, which the physics reads back) and the real IMU pipeline
+# on a register-level simulated MPU-6050 and BMP280, in lock step on a virtual clock:
+# --speed 1 is real time, 10 ten times faster, 0 as fast as it goes. BatchFlight runs a
+# whole batch through Mixer.mix_batch and the ESC slew limit instead, for sweeping
+# mixer and airship parameters over hundreds of airships at once.
+#
+#   python3 remote/simulator.py fly script.json [--speed 1]
+#   python3 remote/simulator.py sweep script.json --parameter max_thrust=1,1.5,2 --yaw-mix 0,0.5
+# A script is a JSON list of segments: {"duration": s, "throttle": .., "yaw": .., "climb": ..,
+# "link": false to stop sending commands (the failsafe takes over)}.
+import json
+import math
+import time
+from collections import namedtuple
+
+import numpy
+from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+from actuators import Actuators
+from control import Control, ControlState
+from imu import STANDARD_GRAVITY, FakeI2cBus, Imu, Mpu6050
+from mixer import Mixer
+from sensors import Reading
+
+SEA_LEVEL_PRESSURE = 101325.0
+
+
+class AirshipParameters:
+    # A blimp of about 2 m, slightly heavier than air
+    MASS = 1.5                          # kg, including the air moved along with the envelope
+    LIFT = -0.3                         # N, buoyancy minus weight
+    MAX_THRUST = 1.5                    # N per motor
+    MOTOR_TIME_CONSTANT = 0.15          # s
+    ESC_MIN = 0.1                       # ESC duty cycle for stop ...
+    ESC_MAX = 0.2                       # ... and full thrust, as in mixer.DEFAULT_CALIBRATION
+    SERVO_MAX_ANGLE = math.radians(60)  # thrust vector at servo -1 / 1
+    MOTOR_SPACING = 0.25                # m, each motor from the centre line
+    DRAG_FORWARD = 0.8                  # N / (m/s)²
+    DRAG_LATERAL = 3.0
+    DRAG_VERTICAL = 2.0
+    YAW_INERTIA = 0.4                   # kg m²
+    YAW_DAMPING = 0.3                   # N m s
+    PITCH_INERTIA = 0.3
+    PITCH_DAMPING = 0.4
+    PITCH_RESTORING = 0.8               # N m at 90°, gondola below the centre of buoyancy
+    THRUST_ARM = 0.15                   # m from the thrust line's vertical part to the centre
+
+    NAMES = ("mass", "lift", "max_thrust", "motor_time_constant", "esc_min", "esc_max", "servo_max_angle",
+             "motor_spacing", "drag_forward", "drag_lateral", "drag_vertical", "yaw_inertia", "yaw_damping",
+             "pitch_inertia", "pitch_damping", "pitch_restoring", "thrust_arm", "wind_x", "wind_y")
+
+    def __init__(self, count, **overrides):
+        unknown = set(overrides) - set(self.NAMES)
+        if unknown:
+            raise ValueError("Unknown airship parameters {}".format(", ".join(sorted(unknown))))
+        for name in self.NAMES:
+            default = getattr(self, name.upper(), 0.0)
+            value = numpy.asarray(overrides.get(name, default), dtype=float)
+            setattr(self, name, numpy.broadcast_to(value, (count,)).copy())
+
+
+# Per airship: position x, y (m, north/east of the start), altitude z (m, ground at 0),
+# velocities, heading psi (rad), pitch theta (rad, nose up), their rates, and the thrust
+# each motor gives right now.
+class AirshipBatch:
+    def __init__(self, count, **parameters):
+        self.count = count
+        self.parameters = AirshipParameters(count, **parameters)
+        self.time = 0.0
+        for name in ("x", "y", "z", "vx", "vy", "vz", "psi", "yaw_rate", "theta", "pitch_rate",
+                     "thrust_left", "thrust_right", "accel_forward", "accel_lateral", "accel_up"):
+            setattr(self, name, numpy.zeros(count))
+
+    def step(self, dt, motor_left, motor_right, servo):
+        # Outputs as written to the pins: ESC duty cycles and the servo value -1..1
+        p = self.parameters
+        span = p.esc_max - p.esc_min
+        target_left = p.max_thrust * numpy.clip((motor_left - p.esc_min) / span, 0.0, 1.0) ** 2
+        target_right = p.max_thrust * numpy.clip((motor_right - p.esc_min) / span, 0.0, 1.0) ** 2
+        lag = numpy.minimum(dt / p.motor_time_constant, 1.0)
+        self.thrust_left += (target_left - self.thrust_left) * lag
+        self.thrust_right += (target_right - self.thrust_right) * lag
+        thrust = self.thrust_left + self.thrust_right
+        vector = numpy.clip(servo, -1.0, 1.0) * p.servo_max_angle
+        elevation = self.theta + vector
+
+        heading_x, heading_y = numpy.cos(self.psi), numpy.sin(self.psi)
+        air_x, air_y = self.vx - p.wind_x, self.vy - p.wind_y
+        along = air_x * heading_x + air_y * heading_y
+        lateral = -air_x * heading_y + air_y * heading_x
+        force_along = thrust * numpy.cos(elevation) - p.drag_forward * along * numpy.abs(along)
+        force_lateral = -p.drag_lateral * lateral * numpy.abs(lateral)
+        force_up = p.lift + thrust * numpy.sin(elevation) - p.drag_vertical * self.vz * numpy.abs(self.vz)
+
+        self.accel_forward = force_along / p.mass
+        self.accel_lateral = force_lateral / p.mass
+        self.accel_up = force_up / p.mass
+        yaw_torque = p.motor_spacing * (self.thrust_left - self.thrust_right) - p.yaw_damping * self.yaw_rate
+        pitch_torque = (p.thrust_arm * thrust * numpy.sin(vector) - p.pitch_restoring * numpy.sin(self.theta)
+                        - p.pitch_damping * self.pitch_rate)
+
+        # Semi-implicit Euler: velocities first, positions with the new velocities
+        self.vx += (self.accel_forward * heading_x - self.accel_lateral * heading_y) * dt
+        self.vy += (self.accel_forward * heading_y + self.accel_lateral * heading_x) * dt
+        self.vz += self.accel_up * dt
+        self.yaw_rate += yaw_torque / p.yaw_inertia * dt
+        self.pitch_rate += pitch_torque / p.pitch_inertia * dt
+        self.x += self.vx * dt
+        self.y += self.vy * dt
+        self.z += self.vz * dt
+        self.psi = numpy.remainder(self.psi + self.yaw_rate * dt + math.pi, 2 * math.pi) - math.pi
+        self.theta += self.pitch_rate * dt
+
+        # Resting on the ground
+        grounded = self.z <= 0.0
+        self.z[grounded] = 0.0
+        self.vz[grounded] = numpy.maximum(self.vz[grounded], 0.0)
+        self.accel_up[grounded] = numpy.maximum(self.accel_up[grounded], 0.0)
+        self.time += dt
+
+    def pressure(self):
+        return SEA_LEVEL_PRESSURE * (1 - self.z / 44330.0) ** 5.255
+
+    def specific_force(self, index):
+        # What an accelerometer in the gondola measures: forward, left, up in the body frame
+        up = self.accel_up[index] + STANDARD_GRAVITY
+        forward = self.accel_forward[index]
+        theta = self.theta[index]
+        return (forward * math.cos(theta) - up * math.sin(theta),
+                self.accel_lateral[index],
+                forward * math.sin(theta) + up * math.cos(theta))
+
+
+# The airship's MPU-6050 and BMP280 as the IMU driver sees them, with sensor noise
+class SimulatedI2cBus(FakeI2cBus):
+    ACCEL_NOISE = 0.05                  # m/s²
+    GYRO_NOISE = math.radians(0.1)      # rad/s
+    PRESSURE_NOISE = 1.0                # Pa
+
+    def __init__(self, airship, index=0, seed=0):
+        self.airship = airship
+        self.index = index
+        self.barometer = True
+        self.reads = 0
+        self.random = numpy.random.default_rng(seed)
+
+    def _next_sample(self):
+        noise = self.random.normal(0.0, 1.0, 6)
+        ax, ay, az = self.airship.specific_force(self.index)
+        raw = [(value + n * self.ACCEL_NOISE) / Mpu6050.ACCEL_SCALE for value, n in zip((ax, ay, az), noise)]
+        rates = (0.0, self.airship.pitch_rate[self.index], self.airship.yaw_rate[self.index])
+        raw += [(value + n * self.GYRO_NOISE) / Mpu6050.GYRO_SCALE for value, n in zip(rates, noise[3:])]
+        return [int(min(max(round(value), -32768), 32767)) for value in raw]
+
+    def _pressure(self):
+        return self.airship.pressure()[self.index] + self.random.normal(0.0, self.PRESSURE_NOISE)
+
+
+class SimulatedSensors:
+    # What Control asks Sensors for: the RSSI falls off with the distance from the
+    # start, where the ground station is
+    def __init__(self, airship, index=0, imu=None, clock=time.monotonic):
+        self.airship = airship
+        self.index = index
+        self.imu = imu
+        self.clock = clock
+
+    def get_wifi_rssi(self):
+        distance = math.hypot(self.airship.x[self.index], self.airship.y[self.index])
+        return Reading(int(-40 - 20 * math.log10(max(distance, 1.0))), self.clock(), False)
+
+    def get_attitude(self):
+        if self.imu is None:
+            return None, True
+        return self.imu.latest()
+
+    def stop(self):
+        pass
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Segment:
+    def __init__(self, duration, throttle=-1.0, yaw=0.0, climb=0.0, link=True):
+        self.duration = duration
+        self.throttle = throttle
+        self.yaw = yaw
+        self.climb = climb
+        self.link = link
+
+
+class Script:
+    def __init__(self, segments):
+        self.segments = [segment if isinstance(segment, Segment) else Segment(**segment) for segment in segments]
+        self.duration = sum(segment.duration for segment in self.segments)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return Script(json.load(f))
+
+    def at(self, t):
+        # The segment running at t, the last one after the end
+        for segment in self.segments:
+            if t < segment.duration:
+                return segment
+            t -= segment.duration
+        return self.segments[-1]
+
+
+# One row per control tick
+Trace = namedtuple("Trace", ["time", "x", "y", "altitude", "heading", "pitch", "speed", "vertical_speed",
+                             "motor_left", "servo", "failsafe", "imu_pitch", "imu_altitude"])
+
+
+class SimulatedFlight:
+    CONTROL_HERTZ = Control.CONTROL_LOOP_HERTZ
+    PHYSICS_HERTZ = Imu.SAMPLE_HERTZ
+    # The client repeats its command at least this often (Communicator.HEARTBEAT_INTERVAL)
+    HEARTBEAT_INTERVAL = 0.25
+
+    def __init__(self, parameters=None, speed=0.0, imu=True, seed=0):
+        self.speed = speed
+        self.clock = VirtualClock()
+        self.airship = AirshipBatch(1, **(parameters or {}))
+        self.pin_factory = MockFactory(pin_class=MockPWMPin)
+        self.imu = None
+        if imu:
+            self.imu = Imu(SimulatedI2cBus(self.airship, 0, seed), hertz=self.PHYSICS_HERTZ, clock=self.clock)
+        self.sensors = SimulatedSensors(self.airship, 0, self.imu, self.clock)
+        self.control = Control(self.sensors, hertz=self.CONTROL_HERTZ, pin_factory=self.pin_factory,
+                               clock=self.clock, scheduled=False)
+        self._motor_pin = self.pin_factory.pin(Actuators.MOTOR_LEFT_PIN)
+        self._servo_pin = self.pin_factory.pin(Actuators.SERVO_PITCH_PIN)
+        self._servo = self.control.actuators.servo_pitch.device
+
+    def outputs(self):
+        # Read back from the pins: the ESC duty cycle, and the servo pulse as -1..1
+        pulse = self._servo_pin.state * self._servo.frame_width
+        middle = (self._servo.min_pulse_width + self._servo.max_pulse_width) / 2
+        servo = (pulse - middle) / ((self._servo.max_pulse_width - self._servo.min_pulse_width) / 2)
+        return self._motor_pin.state, servo
+
+    def run(self, script):
+        control_period = 1.0 / self.CONTROL_HERTZ
+        substeps = int(round(self.PHYSICS_HERTZ / self.CONTROL_HERTZ))
+        dt = control_period / substeps
+        ticks = int(round(script.duration * self.CONTROL_HERTZ))
+        trace = numpy.zeros((ticks, len(Trace._fields)))
+        airship = self.airship
+        sent, last_sent = None, -math.inf
+        start = time.monotonic()
+
+        for tick in range(ticks):
+            now = self.clock.now
+            segment = script.at(now)
+            command = (segment.throttle, segment.yaw, segment.climb)
+            if segment.link and (command != sent or now - last_sent >= self.HEARTBEAT_INTERVAL):
+                self.control.set_state(ControlState(*command))
+                sent, last_sent = command, now
+            self.control.step()
+            if self.imu is not None:
+                self.imu.update()
+
+            motor, servo = self.outputs()
+            # Both motors hang on the one ESC signal, Actuators has no motor_right yet
+            motor = numpy.array([motor])
+            servo = numpy.array([servo])
+            for _ in range(substeps):
+                airship.step(dt, motor, motor, servo)
+                self.clock.now += dt
+                if self.imu is not None:
+                    self.imu._sample()
+            # Whole ticks, no drift from adding up the substeps
+            self.clock.now = (tick + 1) * control_period
+
+            attitude, stale = self.sensors.get_attitude()
+            trace[tick] = (self.clock.now, airship.x[0], airship.y[0], airship.z[0],
+                           math.degrees(airship.psi[0]), math.degrees(airship.theta[0]),
+                           math.hypot(airship.vx[0], airship.vy[0]), airship.vz[0],
+                           motor[0], servo[0], self.control.link_monitor.active,
+                           math.nan if stale else attitude.pitch, math.nan if stale else attitude.altitude)
+            if self.speed > 0:
+                delay = self.clock.now / self.speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        return trace
+
+    def close(self):
+        self.control.stop()
+
+
+# Many airships at once without gpiozero: the targets through Mixer.mix_batch, then
+# clamped and slew limited like Actuator.update. mixers may differ per airship, airships
+# with the same Mixer object are mixed in one call. twin_esc: both motors get the left
+# output, like the hardware today; False uses the mixer's motor_right, for yaw_mix sweeps.
+# The link is always up, the failsafe is SimulatedFlight's business.
+class BatchFlight:
+    CONTROL_HERTZ = Control.CONTROL_LOOP_HERTZ
+    PHYSICS_HERTZ = 200
+
+    def __init__(self, count, parameters=None, mixers=None, motor_slew_rate=Actuators.MOTOR_SLEW_RATE,
+                 twin_esc=True):
+        self.count = count
+        self.airship = AirshipBatch(count, **(parameters or {}))
+        mixers = [ControlState.MIXER] * count if mixers is None else mixers
+        if isinstance(mixers, Mixer):
+            mixers = [mixers] * count
+        groups = {}
+        for index, mixer in enumerate(mixers):
+            groups.setdefault(id(mixer), (mixer, []))[1].append(index)
+        self.groups = [(mixer, numpy.array(indices)) for mixer, indices in groups.values()]
+        self.motor_slew_rate = numpy.broadcast_to(numpy.asarray(
+            math.inf if motor_slew_rate is None else motor_slew_rate, dtype=float), (count,))
+        self.twin_esc = twin_esc
+
+    def _targets(self, segment):
+        throttle, yaw, climb = (numpy.broadcast_to(numpy.asarray(value, dtype=float), (self.count,))
+                                for value in (segment.throttle, segment.yaw, segment.climb))
+        left, right, servo = numpy.empty(self.count), numpy.empty(self.count), numpy.empty(self.count)
+        for mixer, indices in self.groups:
+            left[indices], right[indices], servo[indices] = mixer.mix_batch(throttle[indices], yaw[indices],
+                                                                            climb[indices])
+        return numpy.clip(left, 0.0, 1.0), numpy.clip(right, 0.0, 1.0), numpy.clip(servo, -1.0, 1.0)
+
+    def run(self, script, record=("z", "vz", "psi", "theta")):
+        # Returns {name: (ticks, count) array} of the airship state after every control tick
+        control_period = 1.0 / self.CONTROL_HERTZ
+        substeps = max(1, int(round(self.PHYSICS_HERTZ / self.CONTROL_HERTZ)))
+        dt = control_period / substeps
+        ticks = int(round(script.duration * self.CONTROL_HERTZ))
+        traces = {name: numpy.zeros((ticks, self.count)) for name in record}
+        # The first write sets the outputs directly, as in Actuator
+        left = right = servo = None
+        for tick in range(ticks):
+            target_left, target_right, target_servo = self._targets(script.at(tick * control_period))
+            if left is None:
+                left, right = target_left, target_right
+            else:
+                step = self.motor_slew_rate * control_period
+                left = left + numpy.clip(target_left - left, -step, step)
+                right = right + numpy.clip(target_right - right, -step, step)
+            servo = target_servo
+            for _ in range(substeps):
+                self.airship.step(dt, left, left if self.twin_esc else right, servo)
+            for name in record:
+                traces[name][tick] = getattr(self.airship, name)
+        return traces
+
+
+def summary(trace):
+    rows = [Trace(*row) for row in trace]
+    last = rows[-1]
+    return {"duration": last.time,
+            "distance": math.hypot(last.x, last.y),
+            "max_altitude": max(row.altitude for row in rows),
+            "final_altitude": last.altitude,
+            "final_heading": last.heading,
+            "max_pitch": max(abs(row.pitch) for row in rows),
+            "failsafe_ticks": sum(1 for row in rows if row.failsafe),
+            "imu_pitch_error": max((abs(row.imu_pitch - row.pitch) for row in rows
+                                    if not math.isnan(row.imu_pitch)), default=None)}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["fly", "sweep"])
+    parser.add_argument("script", help="JSON list of segments")
+    parser.add_argument("--speed", type=float, default=0.0, help="Multiple of real time, 0 as fast as possible")
+    parser.add_argument("--csv", action="store_true", help="fly: print every control tick as CSV")
+    parser.add_argument("--parameter", action="append", default=[],
+                        help="sweep: name=v1,v2,... of AirshipParameters, repeated for a grid")
+    parser.add_argument("--yaw-mix", default="0", help="sweep: comma separated yaw_mix values")
+    args = parser.parse_args()
+
+    script = Script.load(args.script)
+    if args.mode == "fly":
+        flight = SimulatedFlight(speed=args.speed)
+        trace = flight.run(script)
+        flight.close()
+        if args.csv:
+            print(",".join(Trace._fields))
+            for row in trace:
+                print(",".join("{:.4f}".format(value) for value in row))
+        else:
+            print(json.dumps(summary(trace), indent=2))
+    else:
+        axes = [("yaw_mix", [float(v) for v in args.yaw_mix.split(",")])]
+        for parameter in args.parameter:
+            name, _, values = parameter.partition("=")
+            axes.append((name, [float(v) for v in values.split(",")]))
+        grid = numpy.array(numpy.meshgrid(*[values for _, values in axes], indexing="ij")).reshape(len(axes), -1)
+        mixers = {value: Mixer(yaw_mix=value) for value in axes[0][1]}
+        flight = BatchFlight(grid.shape[1], parameters={name: grid[i] for i, (name, _) in enumerate(axes) if i},
+                             mixers=[mixers[value] for value in grid[0]], twin_esc=False)
+        traces = flight.run(script)
+        print(",".join(name for name, _ in axes) + ",max_altitude,final_altitude,final_heading")
+        for i in range(grid.shape[1]):
+            print(",".join("{:g}".format(value) for value in grid[:, i]) + ",{:.3f},{:.3f},{:.1f}".format(
+                traces["z"][:, i].max(), traces["z"][-1, i], math.degrees(traces["psi"][-1, i])))
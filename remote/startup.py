@@ -0,0 +1,148 @@
+import os
+import select
+import socket
+import threading
+import time
+
+# rtnetlink multicast group of IPv4 address changes
+RTMGRP_IPV4_IFADDR = 0x10
+
+
+class StartupError(RuntimeError):
+    pass
+
+
+def wait_until(probe, timeout, interval=0.01):
+    # For things the kernel has no notification for, e.g. a device node showing up
+    deadline = time.monotonic() + timeout
+    while not probe():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def address_present(address):
+    # Binding only works once the address is configured on an interface that is up
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind((address, 0))
+        return True
+    except OSError:
+        return False
+
+
+def wait_for_address(address, timeout):
+    # Sleeps on the kernel's address notifications instead of polling
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as netlink:
+        # Subscribed before the first check, so no change can slip through in between
+        netlink.bind((0, RTMGRP_IPV4_IFADDR))
+        deadline = time.monotonic() + timeout
+        while not address_present(address):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([netlink], [], [], remaining)[0]:
+                return False
+            netlink.recv(65536)
+    return True
+
+
+def wait_for_path(path, timeout):
+    return wait_until(lambda: os.path.exists(path), timeout)
+
+
+class Stage:
+    def __init__(self, name, function, requires, optional=False):
+        self.name = name
+        self.function = function
+        self.requires = list(requires)
+        self.optional = optional
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.done = threading.Event()
+
+    def duration(self):
+        return self.finished - self.started if self.started is not None else 0.0
+
+    def to_json(self):
+        return {"requires": self.requires,
+                "optional": self.optional,
+                "started": self.started,
+                "finished": self.finished,
+                "duration": self.duration(),
+                "error": None if self.error is None else str(self.error)}
+
+
+# Runs the startup stages, each one as soon as the stages it requires are done, all
+# independent ones at the same time. Times are seconds since run() was called. A
+# failed optional stage (and whatever requires it) only shows up in the report, any
+# other failure fails the startup.
+class Startup:
+    def __init__(self, parallel=True):
+        self.parallel = parallel
+        self.stages = {}
+        self.total = None
+        self._start = None
+
+    def add(self, name, function, requires=(), optional=False):
+        for required in requires:
+            if required not in self.stages:
+                raise ValueError("Stage {} requires unknown stage {}".format(name, required))
+        self.stages[name] = Stage(name, function, requires, optional)
+
+    def ready(self, name):
+        # Seconds until the stage was done, None if it did not finish
+        stage = self.stages[name]
+        return stage.finished if stage.error is None else None
+
+    def _run_stage(self, stage):
+        for required in stage.requires:
+            self.stages[required].done.wait()
+        failed = [r for r in stage.requires if self.stages[r].error is not None]
+        stage.started = time.monotonic() - self._start
+        if failed:
+            stage.error = StartupError("{} failed".format(", ".join(failed)))
+        else:
+            try:
+                stage.function()
+            except Exception as e:
+                stage.error = e
+                print("Startup stage {} failed: {}".format(stage.name, e))
+        stage.finished = time.monotonic() - self._start
+        stage.done.set()
+
+    def run(self):
+        self._start = time.monotonic()
+        if self.parallel:
+            threads = [threading.Thread(target=self._run_stage, args=(stage,), name="startup-" + stage.name)
+                       for stage in self.stages.values()]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            # One after another in the order they were added, for comparison
+            for stage in self.stages.values():
+                self._run_stage(stage)
+        self.total = time.monotonic() - self._start
+
+        failed = [stage for stage in self.stages.values() if stage.error is not None and not stage.optional]
+        if failed:
+            raise StartupError("Startup failed in {}: {}".format(failed[0].name, failed[0].error))
+
+    def report(self):
+        lines = ["Startup took {:.3f} s".format(self.total)]
+        for stage in sorted(self.stages.values(), key=lambda s: (s.started is None, s.started)):
+            if stage.started is None:
+                lines.append("  {:<16} not run".format(stage.name))
+                continue
+            lines.append("  {:<16} {:7.3f} -> {:7.3f} s  {:7.3f} s{}".format(
+                stage.name, stage.started, stage.finished, stage.duration(),
+                "" if stage.error is None else "  FAILED{}: {}".format(" (optional)" if stage.optional else "",
+                                                                       stage.error)))
+        return "\n".join(lines)
+
+    def to_json(self):
+        return {"total": self.total,
+                "parallel": self.parallel,
+                "stages": {name: stage.to_json() for name, stage in self.stages.items()}}
@@ -0,0 +1,252 @@
+import fcntl
+import select
+import socket
+import struct
+import subprocess
+import termios
+import time
+
+from h264 import NalRingBuffer
+from ratecontrol import LinkSample, RateController
+from rtp import Packetizer
+from startup import wait_for_path
+from supervisor import Supervisor
+
+# Socket priorities of the kernel's default queueing (pfifo_fast), the control server
+# marks its socket interactive, video is bulk: when the tunnel backs up, control
+# packets leave first
+PRIORITY_INTERACTIVE = 6
+PRIORITY_BULK = 2
+IPTOS_LOWDELAY = 0x10
+IPTOS_THROUGHPUT = 0x08
+
+# tcpi_rtt (microseconds) in struct tcp_info, after 8 one byte and 15 four byte fields
+TCP_INFO_RTT = struct.Struct("=68xI")
+
+
+def set_priority(sock, tos, priority):
+    # IP_TOS also sets the priority, so SO_PRIORITY has to come second
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, tos)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY, priority)
+
+
+def send_queue_bytes(sock):
+    # Bytes written to the socket but not yet acknowledged by the client
+    return struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0" * 4))[0]
+
+
+def tcp_rtt(sock):
+    info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_RTT.size)
+    return TCP_INFO_RTT.unpack_from(info)[0] / 1e6
+
+
+# The camera through the bcm2835-v4l2 driver. Bitrate and framerate are V4L2 controls
+# that can be changed while the capture runs, the resolution only between captures.
+class V4l2Camera:
+    DEVICE = "/dev/video0"
+    # Seconds for the driver to create the device after modprobe
+    DEVICE_TIMEOUT = 5.0
+
+    def __init__(self, device=DEVICE):
+        self.device = device
+        self.mode = None
+
+    def _ctl(self, *args):
+        return subprocess.call(["v4l2-ctl", "-d", self.device] + list(args))
+
+    def setup(self, mode):
+        subprocess.call(['modprobe', 'bcm2835-v4l2'])
+        if not wait_for_path(self.device, self.DEVICE_TIMEOUT):
+            print("No camera at {}".format(self.device))
+        self.set_format(mode)
+        return self._ctl("--set-ctrl=exposure_dynamic_framerate=1",
+                         "--set-ctrl=scene_mode=8",
+                         # SPS/PPS with every keyframe and a keyframe per second, so
+                         # the client can start decoding at any time
+                         "--set-ctrl=repeat_sequence_header=1",
+                         "--set-ctrl=h264_i_frame_period={}".format(mode.fps))
+
+    def set_format(self, mode):
+        ret = self._ctl("-v", "width={},height={},pixelformat=H264".format(mode.width, mode.height),
+                        "-p", str(mode.fps),
+                        "--set-ctrl=video_bitrate={}".format(mode.bitrate))
+        self.mode = mode
+        return ret
+
+    def set_rate(self, mode):
+        ret = self._ctl("--set-ctrl=video_bitrate={}".format(mode.bitrate), "-p", str(mode.fps))
+        self.mode = mode
+        return ret
+
+    def capture(self):
+        return subprocess.Popen(["v4l2-ctl", "-d", self.device,
+                                 "--stream-mmap=3", "--stream-count=0", "--stream-to=-"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+
+# Sends the H.264 stream of the camera to the client over TCP and adapts the video
+# mode to the link every RATE_INTERVAL seconds. The socket is non-blocking with a
+# small send buffer: while the link is slow, the capture pipe backs up and the driver
+# drops frames, instead of seconds of video queueing up in the tunnel. The capture
+# runs under the supervisor, which restarts it the moment it exits.
+class VideoStreamer:
+    RATE_INTERVAL = 0.5
+    SEND_BUFFER = 32 * 1024
+    CHUNK = 64 * 1024
+
+    def __init__(self, address, rssi_sampler, camera=None, controller=None, supervisor=None):
+        self.address = address
+        self.rssi_sampler = rssi_sampler
+        self.camera = V4l2Camera() if camera is None else camera
+        self.controller = RateController() if controller is None else controller
+        self.supervisor = Supervisor() if supervisor is None else supervisor
+        self.capture = self.supervisor.add("camera", self.camera.capture, autostart=False)
+
+    @property
+    def capture_restarts(self):
+        return self.capture.stats.failures
+
+    def setup(self):
+        return self.camera.setup(self.controller.mode)
+
+    def link_sample(self, sock, pending):
+        rssi = self.rssi_sampler.latest()
+        try:
+            queue = send_queue_bytes(sock) + pending
+        except OSError:
+            queue = None
+        try:
+            rtt = tcp_rtt(sock)
+        except OSError:
+            rtt = None
+        return LinkSample(None if rssi.stale else rssi.value, queue, rtt)
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, timeout=2)
+        set_priority(sock, IPTOS_THROUGHPUT, PRIORITY_BULK)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SEND_BUFFER)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        return sock
+
+    def _apply(self, mode):
+        if (mode.width, mode.height) == (self.camera.mode.width, self.camera.mode.height):
+            self.camera.set_rate(mode)
+            return
+        self.capture.stop()
+        self.camera.set_format(mode)
+        self.capture.start()
+
+    def _wait_for_capture(self, generation):
+        # After the capture ended: wait for the supervisor to bring up the next one
+        self.capture.wait_for_start(generation, 0.1)
+
+    def stream(self, running):
+        # Streams one connection until it fails or running() turns False
+        sock = self._connect()
+        self.capture.start()
+        pending = memoryview(b"")
+        next_rate_check = time.monotonic() + self.RATE_INTERVAL
+        try:
+            while running():
+                generation, capture = self.capture.generation, self.capture.process
+                if capture is None and not pending:
+                    self._wait_for_capture(generation)
+                    continue
+
+                # Only read from the camera when everything read so far went out
+                readable, writable, _ = select.select([] if pending else [capture.stdout],
+                                                      [sock] if pending else [], [], 0.1)
+                if readable:
+                    data = capture.stdout.read1(self.CHUNK)
+                    if data:
+                        pending = memoryview(data)
+                    else:
+                        self._wait_for_capture(generation)
+                if pending:
+                    try:
+                        pending = pending[sock.send(pending):]
+                    except BlockingIOError:
+                        pass
+
+                now = time.monotonic()
+                if now >= next_rate_check:
+                    next_rate_check = now + self.RATE_INTERVAL
+                    mode = self.controller.update(self.link_sample(sock, len(pending)), now)
+                    if mode is not None:
+                        self._apply(mode)
+        finally:
+            self.capture.stop()
+            sock.close()
+
+
+# Sends the stream as RTP-style datagrams with XOR FEC (see rtp.py) instead of TCP,
+# so a lost packet costs at most the frames until the next keyframe instead of
+# stalling the whole stream until it is retransmitted. Datagrams that do not fit
+# into the socket buffer are dropped right away.
+class RtpVideoStreamer(VideoStreamer):
+    # A frame is complete once the camera pipe has been idle this long
+    FRAME_GAP = 0.003
+
+    def __init__(self, address, rssi_sampler, camera=None, controller=None, packetizer=None, supervisor=None):
+        super().__init__(address, rssi_sampler, camera, controller, supervisor)
+        self.packetizer = Packetizer() if packetizer is None else packetizer
+        self.ring = NalRingBuffer()
+        self.packets_sent = 0
+        self.packets_dropped = 0
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        set_priority(sock, IPTOS_THROUGHPUT, PRIORITY_BULK)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SEND_BUFFER)
+        sock.connect(self.address)
+        sock.setblocking(False)
+        return sock
+
+    def _send(self, sock, unit, key):
+        for packet in self.packetizer.packetize(unit, key):
+            try:
+                sock.send(packet)
+                self.packets_sent += 1
+            except (BlockingIOError, ConnectionRefusedError):
+                # Refused: the client is not listening (yet), ICMP from an earlier datagram
+                self.packets_dropped += 1
+
+    def stream(self, running):
+        sock = self._connect()
+        self.capture.start()
+        capture = None
+        next_rate_check = time.monotonic() + self.RATE_INTERVAL
+        try:
+            while running():
+                generation = self.capture.generation
+                if self.capture.process is not capture:
+                    # A new capture starts a new stream
+                    capture = self.capture.process
+                    self.ring.reset()
+                if capture is None:
+                    self._wait_for_capture(generation)
+                    continue
+
+                timeout = self.FRAME_GAP if self.ring.unit_has_slice else 0.1
+                if select.select([capture.stdout], [], [], timeout)[0]:
+                    # readinto1: one read of what is there, readinto would wait for a full buffer
+                    if self.ring.receive(capture.stdout.readinto1):
+                        for unit, key in self.ring.units():
+                            self._send(sock, unit, key)
+                    else:
+                        self._wait_for_capture(generation)
+                else:
+                    unit = self.ring.flush()
+                    if unit is not None:
+                        self._send(sock, *unit)
+
+                now = time.monotonic()
+                if now >= next_rate_check:
+                    next_rate_check = now + self.RATE_INTERVAL
+                    mode = self.controller.update(self.link_sample(sock, 0), now)
+                    if mode is not None:
+                        self._apply(mode)
+        finally:
+            self.capture.stop()
+            sock.close()
@@ -0,0 +1,262 @@
+# Shared between remote and client (client/supervisor.py links here).
+#
+# Runs child processes and restarts them when they exit. Exits are noticed the
+# moment they happen: every child gets a pidfd (Linux 5.3+), which becomes readable
+# when the child exits, and one thread waits on all of them. Where pidfds are not
+# available, a thread per child blocks in wait() instead. Restarts back off
+# exponentially with jitter, a child that ran for STABLE_AFTER seconds counts as
+# healthy again and is restarted right away next time.
+import os
+import random
+import selectors
+import socket
+import subprocess
+import threading
+import time
+
+
+class ServiceStats:
+    def __init__(self):
+        self.starts = 0
+        self.restarts = 0
+        self.failures = 0           # exits that were not asked for
+        self.last_exit_code = None
+        self.uptime = 0.0           # of exited runs, see Service.uptime() for the total
+        self.last_start = None
+
+    def to_json(self):
+        return dict(vars(self))
+
+
+class Service:
+    MIN_BACKOFF = 0.1
+    MAX_BACKOFF = 10.0
+    STABLE_AFTER = 10.0
+    STOP_TIMEOUT = 2.0
+
+    def __init__(self, supervisor, name, start, on_start=None, on_exit=None,
+                 min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF):
+        # start: a callable returning a subprocess.Popen, or the arguments for one
+        self.supervisor = supervisor
+        self.name = name
+        self.start_process = start if callable(start) else (lambda: subprocess.Popen(start))
+        self.on_start = on_start
+        self.on_exit = on_exit
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stats = ServiceStats()
+
+        self.process = None
+        self.running = False            # should be running, i.e. restart on exit
+        self.generation = 0             # counts started processes
+        self._consecutive_failures = 0
+        self._restart_at = None
+        self._changed = threading.Condition(supervisor.lock)
+
+    def uptime(self, now=None):
+        now = time.monotonic() if now is None else now
+        current = now - self.stats.last_start if self.process is not None else 0.0
+        return self.stats.uptime + current
+
+    def start(self):
+        self.supervisor.start()
+        with self.supervisor.lock:
+            self.running = True
+            if self.process is None:
+                self._restart_at = None
+                self._spawn(time.monotonic())
+        self.supervisor.wakeup()
+
+    def restart(self):
+        # Replaces the running process, e.g. to apply a new configuration
+        self.supervisor.start()
+        with self.supervisor.lock:
+            self.running = True
+            process = self.process
+        if process is not None:
+            self._terminate(process)
+        with self.supervisor.lock:
+            if self.process is process:
+                self._exited(process, time.monotonic(), requested=True)
+            if self.process is None:
+                self._spawn(time.monotonic())
+        self.supervisor.wakeup()
+
+    def stop(self):
+        with self.supervisor.lock:
+            self.running = False
+            self._restart_at = None
+            process = self.process
+        if process is not None:
+            self._terminate(process)
+            with self.supervisor.lock:
+                if self.process is process:
+                    self._exited(process, time.monotonic(), requested=True)
+
+    def wait_for_start(self, generation, timeout):
+        # Waits until a process newer than generation runs, returns it (or None)
+        with self._changed:
+            self._changed.wait_for(lambda: self.generation > generation or not self.running, timeout)
+            return self.process if self.generation > generation else None
+
+    def _terminate(self, process):
+        process.terminate()
+        try:
+            process.wait(self.STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def _spawn(self, now):
+        # Called with the lock held
+        try:
+            process = self.start_process()
+        except OSError as e:
+            print("Could not start {}: {}".format(self.name, e))
+            self.stats.failures += 1
+            self._consecutive_failures += 1
+            self._schedule_restart(now)
+            return
+        self.process = process
+        self.generation += 1
+        if self.stats.starts:
+            self.stats.restarts += 1
+        self.stats.starts += 1
+        self.stats.last_start = now
+        self.supervisor.watch(self, process)
+        if self.on_start is not None:
+            self.on_start(process)
+        self._changed.notify_all()
+
+    def _schedule_restart(self, now):
+        # Full jitter: anywhere between half and all of the exponential delay, so
+        # services failing together do not restart in lockstep
+        delay = min(self.max_backoff, self.min_backoff * 2 ** max(0, self._consecutive_failures - 1))
+        self._restart_at = now + random.uniform(delay / 2, delay)
+        print("Restarting {} in {:.2f} s".format(self.name, self._restart_at - now))
+
+    def _exited(self, process, now, requested=False):
+        # Called with the lock held, when the process is gone
+        if process is not self.process:
+            return
+        self.process = None
+        self.stats.last_exit_code = process.returncode
+        run_time = now - self.stats.last_start
+        self.stats.uptime += run_time
+        if self.on_exit is not None:
+            self.on_exit(process.returncode)
+        self._changed.notify_all()
+        if requested or not self.running:
+            return
+
+        self.stats.failures += 1
+        print("{} exited with {} after {:.1f} s".format(self.name, process.returncode, run_time))
+        if run_time >= self.STABLE_AFTER:
+            self._consecutive_failures = 0
+        self._consecutive_failures += 1
+        if self._consecutive_failures == 1:
+            # First failure after a stable run: straight back up
+            self._spawn(now)
+        else:
+            self._schedule_restart(now)
+
+
+class Supervisor:
+    def __init__(self, name="supervisor"):
+        self.name = name
+        self.lock = threading.RLock()
+        self.services = {}
+        self.use_pidfd = hasattr(os, "pidfd_open")
+
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_receive, self._wakeup_send = socket.socketpair()
+        self._wakeup_receive.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_receive, selectors.EVENT_READ)
+        self._shutdown = False
+        self._thread = None
+
+    def add(self, name, start, autostart=True, **kwargs):
+        service = Service(self, name, start, **kwargs)
+        self.services[name] = service
+        if autostart:
+            service.start()
+        return service
+
+    def start(self):
+        # The thread only runs once there is something to watch
+        with self.lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def wakeup(self):
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            pass
+
+    def watch(self, service, process):
+        if self.use_pidfd:
+            try:
+                fd = os.pidfd_open(process.pid)
+                self._selector.register(fd, selectors.EVENT_READ, (service, process))
+                self.wakeup()
+                return
+            except OSError:
+                self.use_pidfd = False
+        waiter = threading.Thread(target=self._wait, args=(service, process), name="wait-" + service.name)
+        waiter.daemon = True
+        waiter.start()
+
+    def _wait(self, service, process):
+        process.wait()
+        with self.lock:
+            service._exited(process, time.monotonic())
+        self.wakeup()
+
+    def _run(self):
+        while not self._shutdown:
+            with self.lock:
+                due = [s._restart_at for s in self.services.values() if s._restart_at is not None]
+            timeout = max(0.0, min(due) - time.monotonic()) if due else None
+            for key, _ in self._selector.select(timeout):
+                if key.fileobj is self._wakeup_receive:
+                    try:
+                        while self._wakeup_receive.recv(64):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                service, process = key.data
+                self._selector.unregister(key.fileobj)
+                os.close(key.fileobj)
+                # Reaps the child, the pidfd says it has exited already
+                process.wait()
+                with self.lock:
+                    service._exited(process, time.monotonic())
+
+            now = time.monotonic()
+            with self.lock:
+                for service in self.services.values():
+                    if service._restart_at is not None and now >= service._restart_at:
+                        service._restart_at = None
+                        if service.running and service.process is None:
+                            service._spawn(now)
+
+    def stop(self):
+        for service in list(self.services.values()):
+            service.stop()
+        self._shutdown = True
+        self.wakeup()
+        if self._thread is not None:
+            self._thread.join()
+        self._selector.close()
+        self._wakeup_receive.close()
+        self._wakeup_send.close()
+
+    def to_json(self):
+        now = time.monotonic()
+        return {name: dict(service.stats.to_json(), uptime=service.uptime(now), running=service.process is not None)
+                for name, service in self.services.items()}